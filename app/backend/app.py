@@ -1,11 +1,11 @@
-import dataclasses
 import datetime
 import io
 import json
 import mimetypes
 import os
+import tempfile
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast, List
+from typing import Any, AsyncGenerator, Dict, Optional, Union, cast, List
 import logging
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -29,17 +29,19 @@ from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
+from quart.wrappers.response import IterableBody
 from quart_cors import cors
 
 from approaches.approach import Approach
+from approaches.approachfactory import ChatApproachFactory
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
@@ -49,13 +51,22 @@ from config import (
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
     CONFIG_BLOB_CONTAINER_CLIENT,
+    CONFIG_CACHE_STATS,
     CONFIG_CHAT_APPROACH,
+    CONFIG_CHAT_APPROACH_FACTORY,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_SESSION,
+    CONFIG_IMAGE_CACHE,
     CONFIG_INGESTER,
+    CONFIG_NDJSON_COALESCE_LATENCY,
+    CONFIG_NDJSON_ENCODER,
     CONFIG_OPENAI_CLIENT,
     CONFIG_SEARCH_CLIENT,
+    CONFIG_SEARCH_CLIENT_POOL,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
+    CONFIG_SHARED_CACHE,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
@@ -63,8 +74,21 @@ from config import (
     CONFIG_SHOW_THOUGHT_PROCESS
 )
 from cachetools import TTLCache
+from core.theme.application.theme_registry import ThemeRegistry
 from core.theme.application.use_cases.list_themes import ListTheme
 from core.authentication import AuthenticationHelper
+from core.answercache import AnswerCache
+from core.contenthelper import ContentResponse, download_content, get_mime_type
+from core.embeddingcache import EmbeddingCache
+from core.groupcache import GroupMembershipCache
+from core.httpsession import HttpSessionManager
+from core.imagecache import ImageCache
+from core.ndjson import NdjsonEncoder, coalesce
+from core.pathauthcache import PathAuthCache
+from core.querycache import QueryRewriteCache
+from core.searchclientpool import SearchClientPool
+from core.singleflight import SingleFlight
+from core.sharedcache import FileSharedCache, InMemorySharedCache, SharedCache
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from services.cosmosDB.cosmosRepository import CosmosRepository
@@ -86,6 +110,12 @@ mimetypes.add_type("text/css", ".css")
 logging.basicConfig(level=logging.INFO)
 # Define a cache with a maximum size and TTL of 24 hours (86400 seconds)
 cache = TTLCache(maxsize=100, ttl=24 * 3600)
+# Index of the cached themes by themeId
+theme_registry = ThemeRegistry()
+# Key of the themes in the cache shared by all workers
+THEMES_CACHE_KEY = "themes"
+# Coalesces concurrent theme loads, so a cache miss reaches Cosmos once
+theme_loads = SingleFlight()
 
 
 def add_to_cache(key, value):
@@ -125,7 +155,7 @@ async def content_file(file: str, auth_claims: Dict[str, Any]):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    The file is streamed from storage, honouring Range requests (used by PDF viewers) and conditional GETs.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     # This shouldn't typically be necessary as browsers don't send hash fragments to servers
@@ -136,9 +166,10 @@ async def content_file(file: str, auth_claims: Dict[str, Any]):
         path = path_parts[0]
     logging.info(f"Opening file {path}")
     blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
-    blob: Union[BlobDownloader, DatalakeDownloader]
+    content: ContentResponse
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        blob_client = blob_container_client.get_blob_client(path)
+        content = await download_content(blob_client.download_blob, blob_client.get_blob_properties, request.headers)
     except ResourceNotFoundError:
         logging.info(f"Path not found in general Blob container: {path}", )
         if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:  
@@ -147,28 +178,44 @@ async def content_file(file: str, auth_claims: Dict[str, Any]):
                 user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
                 user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
                 file_client = user_directory_client.get_file_client(path)
-                blob = await file_client.download_file()
+                content = await download_content(
+                    file_client.download_file, file_client.get_file_properties, request.headers
+                )
             except ResourceNotFoundError:
                 logging.error(f"Path not found in DataLake: {str(path)}")
                 abort(404)
         else:
             abort(404)
+    if content.downloader is None:
+        return Response(status=content.status, headers=content.headers)
+    blob: Union[BlobDownloader, DatalakeDownloader] = content.downloader
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    response = Response(
+        IterableBody(content.chunks()),
+        status=content.status,
+        headers=content.headers,
+        mimetype=get_mime_type(path, blob.properties),
+    )
+    # Large or slow downloads are streamed for as long as they take
+    response.timeout = None  # type: ignore
+    return response
 
 @bp.route("/clearcache", methods=["POST"])
 async def clear_cache():
     cache.clear()
+    # Bumping the shared version makes every worker reload its themes on the next request
+    current_app.config[CONFIG_SHARED_CACHE].invalidate(THEMES_CACHE_KEY)
+    current_app.config[CONFIG_CHAT_APPROACH_FACTORY].clear()
+    current_app.config[CONFIG_CHAT_APPROACH_FACTORY].answer_cache.invalidate()
     return jsonify({"message": "Cache cleared"}), 200
 
 
+@bp.route("/cachestats", methods=["GET"])
+async def cache_stats():
+    return jsonify({name: stats.to_dict() for name, stats in current_app.config[CONFIG_CACHE_STATS].items()}), 200
+
+
 @bp.route("/ask", methods=["POST"])
 @authenticated
 async def ask(auth_claims: Dict[str, Any]):
@@ -192,57 +239,85 @@ async def ask(auth_claims: Dict[str, Any]):
         return error_response(error, "/ask")
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
-
 cosmos_repository = None
+list_themes = None
 
 if os.getenv("MONGODB_CONN_STRING"):
         DATABASE_NAME = os.getenv('DATABASE_NAME')
         CONN_STRING = os.getenv('MONGODB_CONN_STRING')
-        cosmos_repository = CosmosRepository(connection_string=CONN_STRING, database_name=DATABASE_NAME)
+        cosmos_repository = CosmosRepository(
+            connection_string=CONN_STRING,
+            database_name=DATABASE_NAME,
+            max_workers=int(os.getenv("COSMOS_MAX_WORKERS", 4)),
+        )
+        list_themes = ListTheme(ThemeRepository(cosmos_repository))
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], encoder: Optional[NdjsonEncoder] = None
+) -> AsyncGenerator[str, None]:
+    encoder = encoder or NdjsonEncoder()
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield encoder.encode(event)
     except Exception as error:
         logging.error(f"Exception while generating response stream: {str(error)}")
 
         yield json.dumps(error_dict(error))
 
-async def fetch_themes() -> List[Dict[str, Any]]:
-    themes = get_from_cache("themes")
+async def publish_themes(themes: List[Dict[str, Any]], version: int):
+    theme_registry.replace(themes, version)
+    add_to_cache("themes", themes)
+    search_client_pool: SearchClientPool = current_app.config[CONFIG_SEARCH_CLIENT_POOL]
+    await search_client_pool.refresh(theme["assistantConfig"].get("searchIndexName") for theme in themes)
 
-    if not themes:
-        if not cosmos_repository:
-            return jsonify({'error': 'Cosmos DB not configured'}), 400
 
-        else:
-            use_case = ListTheme(ThemeRepository(cosmos_repository))
-            try:
-                response = use_case.execute()
-                themes_json = [theme.to_dict() for theme in response.data]
-                logging.info("Themes retrieved successfully")
-                add_to_cache("themes", themes_json)
-                logging.info("Themes cached successfully")
-                themes = themes_json
-            except Exception as e:
-                logging.error(f"Error getting themes: {str(e)}")
-                return jsonify({'error': str(e)}), 400
+async def load_themes() -> List[Dict[str, Any]]:
+    shared_cache: SharedCache = current_app.config[CONFIG_SHARED_CACHE]
+    shared_version = shared_cache.version(THEMES_CACHE_KEY)
+
+    # Another worker may already have loaded the current themes
+    entry = shared_cache.read(THEMES_CACHE_KEY, max_age=cache.ttl)
+    if entry:
+        await publish_themes(entry.value, entry.version)
+        logging.info(f"Themes loaded from the shared cache at version {entry.version}")
+        return entry.value
 
-    return themes
+    if not list_themes:
+        raise ValueError("Cosmos DB not configured")
 
+    try:
+        response = await list_themes.execute_async()
+        # Themes are shared with the other workers as JSON, so serialize them through their output DTO
+        themes_json = response.to_dict()
+        logging.info("Themes retrieved successfully")
+        # Only publish if nobody invalidated or replaced the themes while they were loading
+        version = shared_cache.write(THEMES_CACHE_KEY, themes_json, if_version=shared_version)
+        await publish_themes(themes_json, version if version is not None else shared_version)
+        logging.info("Themes cached successfully")
+        return themes_json
+    except Exception as e:
+        logging.error(f"Error getting themes: {str(e)}")
+        raise
+
+
+async def fetch_themes() -> List[Dict[str, Any]]:
+    shared_cache: SharedCache = current_app.config[CONFIG_SHARED_CACHE]
+    themes = theme_registry.all()
+    if themes and theme_registry.version == shared_cache.version(THEMES_CACHE_KEY):
+        if get_from_cache("themes") is None:
+            # The TTL expired: keep serving the loaded themes while a single background load refreshes them
+            theme_loads.start(THEMES_CACHE_KEY, load_themes)
+        return themes
+
+    # Concurrent misses share one load
+    try:
+        return await theme_loads.do(THEMES_CACHE_KEY, load_themes)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
 
 
 @bp.route("/themes", methods=["GET"])
 async def themes():
-    if get_from_cache("themes"):
-        return get_from_cache("themes"), 200
-
     return await fetch_themes()
 
 
@@ -262,66 +337,24 @@ async def chat(auth_claims: Dict[str, Any]):
         return jsonify({'error': 'theme_id not found'}), 400
     
     themes = await fetch_themes()
+    if not isinstance(themes, list):
+        # Error response from fetch_themes
+        return themes
 
-    selected_theme = next(
-        (theme for theme in themes if theme["themeId"] == theme_id), None)
+    selected_theme = theme_registry.get(theme_id)
 
     if not selected_theme:
         return jsonify({'error': 'Theme not found'}), 400
 
-    AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
-    AZURE_KEY_VAULT_NAME = os.getenv("AZURE_KEY_VAULT_NAME")
-    AZURE_SEARCH_SECRET_NAME = os.getenv("AZURE_SEARCH_SECRET_NAME")
-
-    # azure_credential = DefaultAzureCredential(
-    #     exclude_shared_token_cache_credential=True)
-
-    # # Fetch any necessary secrets from Key Vault
-    # search_key = None
-    # if AZURE_KEY_VAULT_NAME:
-    #     async with SecretClient(
-    #         vault_url=f"https://{AZURE_KEY_VAULT_NAME}.vault.azure.net", credential=azure_credential
-    #     ) as key_vault_client:
-    #         search_key = (
-    #             # type: ignore[attr-defined]
-    #             AZURE_SEARCH_SECRET_NAME and (await key_vault_client.get_secret(AZURE_SEARCH_SECRET_NAME)).value
-    #         )
-
-    # # Set up clients for AI Search and Storage
-    # search_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
-    #     AzureKeyCredential(search_key) if search_key else azure_credential
-    # )
-
-    AZURE_SEARCH_SERVICE_QUERY_KEY = os.environ["AZURE_SEARCH_SERVICE_QUERY_KEY"]
-
-    if not AZURE_SEARCH_SERVICE_QUERY_KEY:
-        return jsonify({'error': 'Azure Search Service Query Key not found'}), 400
-    
-    if not AZURE_SEARCH_SERVICE:
-        return jsonify({'error': 'Azure Search Service not found'}), 400
-    
     index_name = selected_theme["assistantConfig"]["searchIndexName"]
 
     if not index_name:
         return jsonify({'error': 'Index name not found'}), 400
 
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=index_name,
-        credential=AzureKeyCredential(AZURE_SEARCH_SERVICE_QUERY_KEY),
-    )
-
-    current_app.config[CONFIG_CHAT_APPROACH].set_search_client(search_client)
-    current_app.config[CONFIG_SEARCH_CLIENT] = search_client
-
     try:
         use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
-        approach: Approach
-        if use_gpt4v and CONFIG_CHAT_VISION_APPROACH in current_app.config:
-            approach = cast(
-                Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
-        else:
-            approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
+        approach_factory: ChatApproachFactory = current_app.config[CONFIG_CHAT_APPROACH_FACTORY]
+        approach = approach_factory.get_approach(selected_theme, theme_registry.version, use_gpt4v=use_gpt4v)
 
         result = await approach.run(
             request_json["messages"],
@@ -333,7 +366,8 @@ async def chat(auth_claims: Dict[str, Any]):
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
+            lines = format_as_ndjson(result, current_app.config[CONFIG_NDJSON_ENCODER])
+            response = await make_response(coalesce(lines, current_app.config[CONFIG_NDJSON_COALESCE_LATENCY]))
             response.timeout = None  # type: ignore
             response.mimetype = "application/json-lines"
             return response
@@ -387,6 +421,8 @@ async def upload(auth_claims: dict[str, Any]):
     file_io.seek(0)
     ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
     await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
+    # The index changed, so cached answers may be outdated
+    current_app.config[CONFIG_CHAT_APPROACH_FACTORY].answer_cache.invalidate()
     return jsonify({"message": "File uploaded successfully"}), 200
 
 
@@ -402,6 +438,7 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     await file_client.delete_file()
     ingester = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
+    current_app.config[CONFIG_CHAT_APPROACH_FACTORY].answer_cache.invalidate()
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
@@ -495,6 +532,11 @@ async def setup_clients():
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
     USE_USER_UPLOAD = os.getenv("USE_USER_UPLOAD", "").lower() == "true"
+    # Debug flag: stream the full chunks of the OpenAI API instead of their deltas
+    STREAM_FULL_CHUNKS = os.getenv("STREAM_FULL_CHUNKS", "").lower() == "true"
+
+    # Directory for the caches shared by the workers of this host, empty to only cache in memory
+    SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chatapp-cache"))
 
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -513,6 +555,7 @@ async def setup_clients():
             )
     
     AZURE_OPENAISERVICE_KEY = os.getenv("AZURE_OPENAISERVICE_KEY")
+    AZURE_SEARCH_SERVICE_QUERY_KEY = os.getenv("AZURE_SEARCH_SERVICE_QUERY_KEY")
     # Set up clients for AI Search and Storage
     search_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
         AzureKeyCredential(search_key) if search_key else azure_credential
@@ -522,6 +565,13 @@ async def setup_clients():
         index_name=AZURE_SEARCH_INDEX,
         credential=search_credential,
     )
+    # One long-lived client per theme index, queried with the read-only query key when available
+    search_client_pool = SearchClientPool(
+        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+        credential=(
+            AzureKeyCredential(AZURE_SEARCH_SERVICE_QUERY_KEY) if AZURE_SEARCH_SERVICE_QUERY_KEY else search_credential
+        ),
+    )
 
     BLOB_CONTAINER_CLIENT_CONNECTION_STRING = os.getenv("AZURE_STORAGE_ACCOUNT_CONN_STRING")
     blob_container_client = ContainerClient.from_connection_string(
@@ -541,6 +591,33 @@ async def setup_clients():
         )
         search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
         await search_index_client.close()
+
+    # Shared between the workers of this host: the themes, so a restarted worker starts warm,
+    # and the versions that invalidate every worker's caches at once
+    shared_cache = FileSharedCache(SHARED_CACHE_DIR) if SHARED_CACHE_DIR else InMemorySharedCache()
+    current_app.config[CONFIG_SHARED_CACHE] = shared_cache
+
+    # Access checks of /content, a PDF viewer makes several for the same file
+    path_auth_cache = PathAuthCache(
+        shared_cache,
+        ttl=int(os.getenv("PATH_AUTH_CACHE_TTL", 60)),
+        negative_ttl=int(os.getenv("PATH_AUTH_CACHE_NEGATIVE_TTL", 10)),
+    )
+    # Pooled HTTP session shared by the calls to AI Vision, Microsoft Graph and the Entra keys endpoint
+    http_session = HttpSessionManager(
+        limit=int(os.getenv("HTTP_POOL_LIMIT", 100)),
+        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20)),
+        keepalive_timeout=int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30)),
+        ttl_dns_cache=int(os.getenv("HTTP_DNS_CACHE_TTL", 300)),
+    )
+    current_app.config[CONFIG_HTTP_SESSION] = http_session
+
+    # Groups of the users with a groups overage claim, listed from Microsoft Graph
+    group_cache = GroupMembershipCache(
+        http_session=http_session,
+        ttl=int(os.getenv("GROUP_CACHE_TTL", 300)),
+        refresh_after=int(os.getenv("GROUP_CACHE_REFRESH_AFTER", 240)),
+    )
     auth_helper = AuthenticationHelper(
         search_index=search_index,
         use_authentication=AZURE_USE_AUTHENTICATION,
@@ -551,6 +628,10 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        path_auth_cache=path_auth_cache,
+        group_cache=group_cache,
+        http_session=http_session,
+        obo_max_workers=int(os.getenv("AUTH_OBO_MAX_WORKERS", 4)),
     )
 
     if USE_USER_UPLOAD:
@@ -632,6 +713,7 @@ async def setup_clients():
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
+    current_app.config[CONFIG_SEARCH_CLIENT_POOL] = search_client_pool
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
@@ -640,9 +722,36 @@ async def setup_clients():
     current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
     current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
     current_app.config[CONFIG_SHOW_THOUGHT_PROCESS] = os.getenv("SHOW_THOUGHT_PROCESS", "").lower() == "true"
+    # Streamed chat events are serialized by the encoder, and the token deltas arriving within
+    # NDJSON_COALESCE_MS milliseconds of each other are written together (0 writes each one as it arrives)
+    current_app.config[CONFIG_NDJSON_ENCODER] = NdjsonEncoder()
+    current_app.config[CONFIG_NDJSON_COALESCE_LATENCY] = int(os.getenv("NDJSON_COALESCE_MS", 0)) / 1000
     current_app.config[CONFIG_SHOW_SUPPORTING_CONTENT] = os.getenv("SHOW_SUPPORTING_CONTENT", "").lower() == "true"
     current_app.config[AZURE_STORAGE_CONTAINER_ORIGINAL_DOCUMENTS] = blob_container_original_documents_client
 
+    # Query embeddings are cached in memory, and also in a database shared by the workers
+    # when EMBEDDING_CACHE_PERSISTENT is true and SHARED_CACHE_DIR is set
+    embedding_cache = EmbeddingCache(
+        maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", 10000)),
+        path=(
+            os.path.join(SHARED_CACHE_DIR, "embeddings.sqlite3")
+            if SHARED_CACHE_DIR and os.getenv("EMBEDDING_CACHE_PERSISTENT", "").lower() == "true"
+            else None
+        ),
+        max_persistent_entries=int(os.getenv("EMBEDDING_CACHE_PERSISTENT_SIZE", 100000)),
+        ttl=int(os.getenv("EMBEDDING_CACHE_PERSISTENT_TTL", 7 * 24 * 3600)),
+    )
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    # Page images sent to GPT-4V, spilled to disk when they no longer fit in memory and SHARED_CACHE_DIR is set
+    image_cache = ImageCache(
+        max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+        spill_directory=os.path.join(SHARED_CACHE_DIR, "images") if SHARED_CACHE_DIR else None,
+        max_spill_bytes=int(os.getenv("IMAGE_CACHE_MAX_SPILL_BYTES", 1024 * 1024 * 1024)),
+        revalidate_after=int(os.getenv("IMAGE_CACHE_REVALIDATE_AFTER", 60)),
+    )
+    current_app.config[CONFIG_IMAGE_CACHE] = image_cache
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -658,10 +767,10 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
     )
 
-    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
-        search_client=search_client,
+    chat_approach_kwargs: dict[str, Any] = dict(
         openai_client=openai_client,
         auth_helper=auth_helper,
         chatgpt_model=OPENAI_CHATGPT_MODEL,
@@ -673,7 +782,13 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        stream_full_chunks=STREAM_FULL_CHUNKS,
     )
+    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
+        search_client=search_client, **chat_approach_kwargs
+    )
+    vision_approach_kwargs: Optional[dict[str, Any]] = None
 
     if USE_GPT4V:
         current_app.logger.info("USE_GPT4V is true, setting up GPT4V approach")
@@ -697,10 +812,12 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            image_cache=image_cache,
+            http_session=http_session,
         )
 
-        current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
-            search_client=search_client,
+        vision_approach_kwargs = dict(
             openai_client=openai_client,
             blob_container_client=blob_container_client,
             auth_helper=auth_helper,
@@ -715,15 +832,61 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            image_cache=image_cache,
+            http_session=http_session,
+            stream_full_chunks=STREAM_FULL_CHUNKS,
+        )
+        current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
+            search_client=search_client, **vision_approach_kwargs
         )
 
+    # Chat approaches are built per theme, with the theme's prompts and search index bound at construction
+    current_app.config[CONFIG_CHAT_APPROACH_FACTORY] = ChatApproachFactory(
+        search_client_pool=search_client_pool,
+        chat_approach_kwargs=chat_approach_kwargs,
+        vision_approach_kwargs=vision_approach_kwargs,
+        query_rewrite_cache=QueryRewriteCache(
+            maxsize=int(os.getenv("QUERY_REWRITE_CACHE_SIZE", 1000)),
+            ttl=int(os.getenv("QUERY_REWRITE_CACHE_TTL", 3600)),
+        ),
+        answer_cache=AnswerCache(
+            shared_cache,
+            maxsize=int(os.getenv("ANSWER_CACHE_SIZE", 1000)),
+            ttl=int(os.getenv("ANSWER_CACHE_TTL", 600)),
+        ),
+    )
+
+    current_app.config[CONFIG_CACHE_STATS] = {
+        "embeddings": embedding_cache.stats,
+        "embeddings_persistent": embedding_cache.persistent_stats,
+        "search_queries": current_app.config[CONFIG_CHAT_APPROACH_FACTORY].query_rewrite_cache.stats,
+        "answers": current_app.config[CONFIG_CHAT_APPROACH_FACTORY].answer_cache.stats,
+        "query_rewrites": current_app.config[CONFIG_CHAT_APPROACH_FACTORY].query_rewrite_stats,
+        "images": image_cache.stats,
+        "images_spilled": image_cache.spill_stats,
+        "path_auth": path_auth_cache.stats,
+        "groups": group_cache.stats,
+    }
+
+    # Load the themes up front so that their search clients are created and warmed before the first chat
+    if cosmos_repository:
+        await fetch_themes()
+
 
 @bp.after_app_serving
 async def close_clients():
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
+    await current_app.config[CONFIG_SEARCH_CLIENT_POOL].close()
+    await current_app.config[CONFIG_EMBEDDING_CACHE].close()
+    await current_app.config[CONFIG_IMAGE_CACHE].close()
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
+    await current_app.config[CONFIG_HTTP_SESSION].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    if cosmos_repository:
+        cosmos_repository.close()
 
 
 def create_app():
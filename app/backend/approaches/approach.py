@@ -25,6 +25,8 @@ from azure.search.documents.models import (
 from openai import AsyncOpenAI
 
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.httpsession import HttpSessionManager
 from text import nonewlines
 
 
@@ -97,6 +99,8 @@ class ThoughtStep:
 
 
 class Approach(ABC):
+    embedding_cache: Optional[EmbeddingCache] = None
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -110,6 +114,7 @@ class Approach(ABC):
         openai_host: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[HttpSessionManager] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -122,6 +127,7 @@ class Approach(ABC):
         self.openai_host = openai_host
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category")
@@ -133,6 +139,12 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def preauthorize_citations(self, results: List[Document], auth_claims: dict[str, Any]):
+        # The search applied the security filter, so the user is allowed to open the files of every result
+        self.auth_helper.preauthorize_paths(
+            (path for result in results for path in (result.sourcepage, result.sourcefile) if path), auth_claims
+        )
+
     async def search(
         self,
         top: int,
@@ -233,13 +245,23 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q
-            # **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+        query_vector = None
+        if self.embedding_cache:
+            query_vector = await self.embedding_cache.get(
+                self.embedding_model, self.embedding_deployment, self.embedding_dimensions, q
+            )
+        if query_vector is None:
+            embedding = await self.openai_client.embeddings.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=q
+                # **dimensions_args,
+            )
+            query_vector = embedding.data[0].embedding
+            if self.embedding_cache:
+                self.embedding_cache.set(
+                    self.embedding_model, self.embedding_deployment, self.embedding_dimensions, q, query_vector
+                )
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="contentvector")
 
     async def compute_image_embedding(self, q: str):
@@ -250,14 +272,24 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        if self.http_session is None:
+            async with aiohttp.ClientSession() as session:
+                image_query_vector = await self.post_image_embedding(session, endpoint, params, headers, data)
+        else:
+            image_query_vector = await self.post_image_embedding(
+                self.http_session.get_session(), endpoint, params, headers, data
+            )
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
+    async def post_image_embedding(
+        self, session: aiohttp.ClientSession, endpoint: str, params: dict, headers: dict, data: dict
+    ) -> list[float]:
+        async with session.post(
+            url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+        ) as response:
+            json = await response.json()
+            return json["vector"]
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -0,0 +1,87 @@
+from typing import Any, Optional
+
+from approaches.chatapproach import ChatApproach
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from core.answercache import AnswerCache
+from core.querycache import QueryRewriteCache
+from core.rewritepolicy import QueryRewritePolicy, QueryRewriteStats
+from core.searchclientpool import SearchClientPool
+
+
+class ChatApproachFactory:
+    """
+    Builds and caches one chat approach per theme version. The theme's prompts, few-shots and search client
+    are bound when the approach is constructed, so the instances can be shared by concurrent requests.
+    The version is the one the themes were loaded at from the shared cache (see ThemeRegistry.version),
+    so looking up the approach of a request doesn't need to look at the theme's contents.
+    """
+
+    def __init__(
+        self,
+        *,
+        search_client_pool: SearchClientPool,
+        chat_approach_kwargs: dict[str, Any],
+        vision_approach_kwargs: Optional[dict[str, Any]] = None,
+        query_rewrite_cache: Optional[QueryRewriteCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+    ):
+        self.search_client_pool = search_client_pool
+        self.chat_approach_kwargs = chat_approach_kwargs
+        self.vision_approach_kwargs = vision_approach_kwargs
+        self.query_rewrite_cache = query_rewrite_cache
+        self.answer_cache = answer_cache
+        # Shared by the query rewrite policies of all themes
+        self.query_rewrite_stats = QueryRewriteStats()
+        # (themeId, use_gpt4v) -> (theme version, approach). Only the latest version of a theme is kept.
+        self.approaches: dict[tuple[str, bool], tuple[int, ChatApproach]] = {}
+
+    def get_approach(self, theme: dict[str, Any], version: int, use_gpt4v: bool = False) -> ChatApproach:
+        use_gpt4v = use_gpt4v and self.vision_approach_kwargs is not None
+        key = (theme["themeId"], use_gpt4v)
+        cached = self.approaches.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        approach = self.create_approach(theme, use_gpt4v, str(version))
+        if use_gpt4v and self.vision_approach_kwargs is not None:
+            approach.warm_token_counts(self.vision_approach_kwargs["gpt4v_model"])
+        else:
+            approach.warm_token_counts(self.chat_approach_kwargs["chatgpt_model"])
+        self.approaches[key] = (version, approach)
+        return approach
+
+    def create_approach(self, theme: dict[str, Any], use_gpt4v: bool, version: str = "") -> ChatApproach:
+        assistant_config = theme["assistantConfig"]
+        search_client = self.search_client_pool.get(assistant_config["searchIndexName"])
+        # Answers are only cached for the themes that opt in, under the theme version so edits invalidate them
+        answer_cache = self.answer_cache if assistant_config.get("cacheAnswers") else None
+        query_rewrite_policy = QueryRewritePolicy.from_config(
+            assistant_config.get("queryRewritePolicy"), theme["language"], self.query_rewrite_stats
+        )
+        if use_gpt4v and self.vision_approach_kwargs is not None:
+            return ChatReadRetrieveReadVisionApproach(
+                search_client=search_client,
+                theme_version=version,
+                answer_cache=answer_cache,
+                query_rewrite_policy=query_rewrite_policy,
+                **self.vision_approach_kwargs,
+            )
+        return ChatReadRetrieveReadApproach(
+            search_client=search_client,
+            theme_version=version,
+            answer_cache=answer_cache,
+            query_rewrite_policy=query_rewrite_policy,
+            system_message_chat_conversation=assistant_config["systemMessageConversationPrompt"],
+            query_prompt_template=assistant_config["queryPromptTemplate"],
+            query_prompt_few_shots=assistant_config["queryPromptFewShots"],
+            follow_up_questions_prompt_content=assistant_config["followUpQuestionsPrompt"],
+            theme_id=theme["themeId"],
+            # Generated search queries are only cached for the themes that opt in
+            query_rewrite_cache=self.query_rewrite_cache if assistant_config.get("cacheSearchQuery") else None,
+            **self.chat_approach_kwargs,
+        )
+
+    def clear(self):
+        self.approaches = {}
+        if self.query_rewrite_cache:
+            self.query_rewrite_cache.clear()
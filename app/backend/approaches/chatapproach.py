@@ -1,17 +1,26 @@
+import asyncio
+import difflib
 import json
+import time
+import unicodedata
 from core.log import Logger
 import re
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Optional, Sequence, Union
 
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
 )
 
-from approaches.approach import Approach
-from core.messagebuilder import MessageBuilder
+from approaches.approach import Approach, ThoughtStep
+from core.answercache import AnswerCache, CachedAnswer
+from core.followupparser import FollowupQuestionParser
+from core.messagebuilder import HistoryPacker, MessageBuilder
+from core.modelhelper import num_tokens_from_messages
+from core.rewritepolicy import QueryRewriteDecision, QueryRewritePolicy
 
 
 class ChatApproach(Approach, ABC):
@@ -20,14 +29,29 @@ class ChatApproach(Approach, ABC):
     USER = "user"
     ASSISTANT = "assistant"
 
-    query_prompt_few_shots = [
+    # A tuple, as the few-shots are shared by the concurrent requests of a theme
+    query_prompt_few_shots: tuple[dict[str, str], ...] = (
         {"role": USER, "content": "How did crypto do last year?"},
         {"role": ASSISTANT,
             "content": "Summarize Cryptocurrency Market Dynamics from last year"},
         {"role": USER, "content": "What are my health plans?"},
         {"role": ASSISTANT, "content": "Show available health plans"},
-    ]
+    )
     NO_RESPONSE = "0"
+    # Minimum similarity between the question and the generated search query to keep the speculative search results
+    SPECULATIVE_SIMILARITY = 0.8
+
+    # Only set for themes that opted in to caching their answers, with the version of the theme
+    answer_cache: Optional[AnswerCache] = None
+    theme_version: str = ""
+    # Only set for themes that allow skipping the search query generation
+    query_rewrite_policy: Optional[QueryRewritePolicy] = None
+    # Streams the full chunks from the OpenAI API rather than their deltas, for debugging
+    stream_full_chunks: bool = False
+
+    # Stages of run_until_final_call streamed to the client as they complete, before the answer
+    STAGE_SEARCH_QUERY = "search_query"
+    STAGE_SEARCH_RESULTS = "search_results"
 
     follow_up_questions_prompt_content = """Generate 3 very brief follow-up questions that the user would likely ask next.
     Enclose the follow-up questions in double angle brackets. Example:
@@ -54,9 +78,18 @@ class ChatApproach(Approach, ABC):
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, history, overrides, auth_claims, theme, should_stream) -> tuple:
+    async def run_until_final_call(
+        self, history, overrides, auth_claims, theme, should_stream, stages: Optional[asyncio.Queue] = None
+    ) -> tuple:
         pass
 
+    @staticmethod
+    def report_stage(stages: Optional[asyncio.Queue], stage: str, context: dict[str, Any]):
+        # A stage only carries what it added, the whole context is sent once the answer starts.
+        # The thoughts are copied, as the list keeps growing until the event is serialized
+        if stages is not None:
+            stages.put_nowait((stage, {**context, "thoughts": list(context.get("thoughts", []))}))
+
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
         if override_prompt is None:
             return self.system_message_chat_conversation.format(
@@ -69,6 +102,24 @@ class ChatApproach(Approach, ABC):
         else:
             return override_prompt.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+    def warm_token_counts(self, model_id: str):
+        """
+        Counts the tokens of the theme's fixed messages (system prompts and few-shots) once, when the approach is built,
+        so that building the prompts of a request finds them in the token count cache.
+        """
+        system_prompts = [self.query_prompt_template]
+        try:
+            system_prompts.append(self.get_system_prompt(None, ""))
+            system_prompts.append(self.get_system_prompt(None, self.follow_up_questions_prompt_content))
+        except (IndexError, KeyError, ValueError):
+            # A prompt that can't be formatted fails the requests instead
+            pass
+        messages = [{"role": self.SYSTEM, "content": prompt} for prompt in system_prompts]
+        messages.extend({"role": shot["role"], "content": shot["content"]} for shot in self.query_prompt_few_shots)
+        for message in messages:
+            message["content"] = unicodedata.normalize("NFC", message["content"])
+            num_tokens_from_messages(message, model_id)
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -87,6 +138,24 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    def get_query_rewrite_decision(self, history: list[dict[str, str]]) -> QueryRewriteDecision:
+        if self.query_rewrite_policy is None:
+            return QueryRewriteDecision(True, "no query rewrite policy")
+        return self.query_rewrite_policy.evaluate(history)
+
+    @staticmethod
+    def get_query_similarity(question: str, search_query: str) -> float:
+        # Compare words rather than characters, ignoring case and punctuation
+        question_words = re.findall(r"\w+", question.lower())
+        search_query_words = re.findall(r"\w+", search_query.lower())
+        return difflib.SequenceMatcher(None, question_words, search_query_words).ratio()
+
+    @staticmethod
+    def discard_task(task: asyncio.Task):
+        task.cancel()
+        # Retrieve the exception of a task that failed before it was cancelled, so it isn't logged as unhandled
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
 
@@ -98,37 +167,31 @@ class ChatApproach(Approach, ABC):
         user_content: Union[str, list[ChatCompletionContentPartParam]],
         max_tokens: int,
         few_shots=[],
+        history_packer: Optional[HistoryPacker] = None,
+        image_dims: Sequence[Optional[tuple[int, int]]] = (),
     ) -> list[ChatCompletionMessageParam]:
         logging = Logger()
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(
-                shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
+        for shot in few_shots:
+            message_builder.append_message(shot.get("role"), shot.get("content"))
 
-        message_builder.insert_message(
-            self.USER, user_content, index=append_index)
+        user_message = message_builder.create_message(self.USER, user_content)
 
-        total_token_count = 0
+        # The dimensions of the images of the user content, when known, spare reading them from the images
+        total_token_count = message_builder.count_tokens_for_message(user_message, image_dims)
         for existing_message in message_builder.messages:
-            total_token_count += message_builder.count_tokens_for_message(
-                existing_message)
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(
-                message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.info(
-                    "Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.insert_message(
-                message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
-        return message_builder.messages
+            total_token_count += message_builder.count_tokens_for_message(existing_message)
+
+        # The packer is shared by the prompts of a request, so the history is only normalized and counted once
+        if history_packer is None or history_packer.model != model_id:
+            history_packer = HistoryPacker(history[:-1], model_id)
+        history_messages = history_packer.pack(max_tokens - total_token_count)
+        if len(history_messages) < len(history) - 1:
+            logging.info(f"Reached max tokens of {max_tokens}, history will be truncated")
+
+        return [*message_builder.messages, *history_messages, user_message]
 
     async def run_without_streaming(
         self,
@@ -137,6 +200,7 @@ class ChatApproach(Approach, ABC):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        answer_cache_key: Optional[str] = None,
     ) -> dict[str, Any]:
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, theme=theme, should_stream=False
@@ -151,6 +215,10 @@ class ChatApproach(Approach, ABC):
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
         chat_resp["choices"][0]["session_state"] = session_state
+        if self.answer_cache is not None and answer_cache_key:
+            self.answer_cache.set(
+                answer_cache_key, chat_resp["choices"][0]["message"]["content"], dict(chat_resp["choices"][0]["context"])
+            )
         return chat_resp
 
     async def run_with_streaming(
@@ -160,10 +228,21 @@ class ChatApproach(Approach, ABC):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        answer_cache_key: Optional[str] = None,
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, theme=theme, should_stream=True
+        # Each stage of the retrieval is streamed as soon as it completes, rather than nothing until the answer starts
+        stages: asyncio.Queue = asyncio.Queue()
+        final_call = asyncio.ensure_future(
+            self.run_until_final_call(history, overrides, auth_claims, theme=theme, should_stream=True, stages=stages)
         )
+        final_call.add_done_callback(lambda _: stages.put_nowait(None))
+        try:
+            while (stage := await stages.get()) is not None:
+                yield self.stage_event(*stage)
+        finally:
+            if not final_call.done():
+                self.discard_task(final_call)
+        extra_info, chat_coroutine = await final_call
         yield {
             "choices": [
                 {
@@ -177,40 +256,155 @@ class ChatApproach(Approach, ABC):
             "object": "chat.completion.chunk",
         }
 
-        followup_questions_started = False
-        followup_content = ""
+        # Follow-up questions are parsed out of the deltas, and streamed one event per question as each one completes
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
+        followup_questions: list[str] = []
+        # Answer content streamed so far, kept to cache the whole answer once the stream completes
+        answer_content: list[str] = []
         async for event_chunk in await chat_coroutine:
+            event = self.get_delta_event(event_chunk)
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
             if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<"):]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
+                delta = event["choices"][0]["delta"]
+                content = delta.get("content") or ""  # content may either not exist in delta, or explicitly be None
+                if followup_parser is None:
+                    answer_content.append(content)
+                    yield event
+                    continue
+                answer_part, questions = followup_parser.feed(content)
+                # Once the follow-up questions started, only the answer content left in a delta is streamed
+                if answer_part or not followup_parser.in_followups:
+                    if answer_part != content:
+                        delta["content"] = answer_part
+                    answer_content.append(answer_part)
                     yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(
-                followup_content)
-            yield {
-                "choices": [
-                    {
-                        "delta": {"role": self.ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
-                "object": "chat.completion.chunk",
-            }
+                for question in questions:
+                    followup_questions.append(question)
+                    yield self.followup_questions_event(list(followup_questions))
+        if followup_parser:
+            remaining_content = followup_parser.close()
+            if remaining_content:
+                answer_content.append(remaining_content)
+                yield self.content_event(remaining_content)
+        if self.answer_cache is not None and answer_cache_key:
+            context = {**extra_info, "followup_questions": followup_questions} if followup_questions else dict(extra_info)
+            self.answer_cache.set(answer_cache_key, "".join(answer_content), context)
+
+    def get_delta_event(self, chunk: ChatCompletionChunk) -> dict[str, Any]:
+        """
+        Reads the delta of the first choice of a streamed chunk into a minimal event,
+        rather than dumping the whole pydantic model for each token.
+        """
+        if self.stream_full_chunks:
+            return chunk.model_dump()
+        if not chunk.choices:
+            return {"choices": [], "object": "chat.completion.chunk"}
+        choice = chunk.choices[0]
+        return {
+            "choices": [
+                {
+                    "delta": {"role": choice.delta.role, "content": choice.delta.content},
+                    "finish_reason": choice.finish_reason,
+                    "index": choice.index,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    def stage_event(self, stage: str, context: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT},
+                    "context": {"stage": stage, **context},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    def content_event(self, content: str) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT, "content": content},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    def followup_questions_event(self, followup_questions: list[str]) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT},
+                    "context": {"followup_questions": followup_questions},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    def get_cached_answer_context(self, answer: CachedAnswer) -> dict[str, Any]:
+        return {
+            **answer.context,
+            "thoughts": [
+                *answer.context.get("thoughts", []),
+                ThoughtStep(
+                    "Answer cache",
+                    "Answer served from the answer cache",
+                    {"age_seconds": round(time.time() - answer.stored_at)},
+                ),
+            ],
+        }
+
+    def replay_answer(self, answer: CachedAnswer, session_state: Any = None) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": self.ASSISTANT, "content": answer.content},
+                    "context": self.get_cached_answer_context(answer),
+                    "session_state": session_state,
+                    "finish_reason": "stop",
+                }
+            ],
+            "object": "chat.completion",
+        }
+
+    async def replay_answer_stream(
+        self, answer: CachedAnswer, session_state: Any = None
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        context = self.get_cached_answer_context(answer)
+        followup_questions = context.pop("followup_questions", None)
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT},
+                    "context": context,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT, "content": answer.content},
+                    "finish_reason": "stop",
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        if followup_questions:
+            yield self.followup_questions_event(followup_questions)
 
     async def run(
         self, messages: list[dict], theme: any, stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
@@ -218,7 +412,22 @@ class ChatApproach(Approach, ABC):
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
 
+        answer_cache_key = None
+        if self.answer_cache is not None:
+            answer_cache_key = self.answer_cache.make_key(
+                self.theme_version, self.build_filter(overrides, auth_claims), overrides, messages
+            )
+            cached_answer = self.answer_cache.get(answer_cache_key)
+            if cached_answer:
+                if stream is False:
+                    return self.replay_answer(cached_answer, session_state)
+                return self.replay_answer_stream(cached_answer, session_state)
+
         if stream is False:
-            return await self.run_without_streaming(theme, messages, overrides, auth_claims, session_state)
+            return await self.run_without_streaming(
+                theme, messages, overrides, auth_claims, session_state, answer_cache_key=answer_cache_key
+            )
         else:
-            return self.run_with_streaming(theme, messages, overrides, auth_claims, session_state)
+            return self.run_with_streaming(
+                theme, messages, overrides, auth_claims, session_state, answer_cache_key=answer_cache_key
+            )
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
@@ -9,10 +10,15 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.messagebuilder import HistoryPacker
 from core.modelhelper import get_token_limit
+from core.querycache import QueryRewriteCache
+from core.rewritepolicy import QueryRewritePolicy
 import logging
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -38,6 +44,17 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        system_message_chat_conversation: str = "",
+        query_prompt_template: Optional[str] = None,
+        query_prompt_few_shots: Optional[list[dict[str, str]]] = None,
+        follow_up_questions_prompt_content: Optional[str] = None,
+        theme_id: str = "",
+        query_rewrite_cache: Optional[QueryRewriteCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        theme_version: str = "",
+        answer_cache: Optional[AnswerCache] = None,
+        query_rewrite_policy: Optional[QueryRewritePolicy] = None,
+        stream_full_chunks: bool = False,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -47,21 +64,32 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
+        self.theme_version = theme_version
+        self.answer_cache = answer_cache
+        self.query_rewrite_policy = query_rewrite_policy
+        self.stream_full_chunks = stream_full_chunks
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
-        self.system_message_chat_conversation_string = ""
-        
-    # setter for search_client
-    
-    def set_search_client(self, search_client: SearchClient):
-        self.search_client = search_client
+        # Prompts are bound once at construction (one instance per theme) and never changed afterwards,
+        # so concurrent requests for different themes can't see each other's prompts
+        self.system_message_chat_conversation_string = system_message_chat_conversation
+        if query_prompt_template is not None:
+            self.query_prompt_template = query_prompt_template
+        if query_prompt_few_shots is not None:
+            self.query_prompt_few_shots = tuple(query_prompt_few_shots)
+        if follow_up_questions_prompt_content is not None:
+            self.follow_up_questions_prompt_content = follow_up_questions_prompt_content
+        self.theme_id = theme_id
+        # Only set for themes that opted in to caching their generated search queries
+        self.query_rewrite_cache = query_rewrite_cache
 
     @property
     def system_message_chat_conversation(self):
-        return f"{self.system_message_chat_conversation_string}"
+        return self.system_message_chat_conversation_string
 
     @overload
     async def run_until_final_call(
@@ -70,6 +98,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        stages: Optional[asyncio.Queue] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
 
     @overload
@@ -80,6 +109,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         auth_claims: dict[str, Any],
         theme: str,
         should_stream: Literal[True],
+        stages: Optional[asyncio.Queue] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
@@ -89,13 +119,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         auth_claims: dict[str, Any],
         theme: any,
         should_stream: bool = False,
+        stages: Optional[asyncio.Queue] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
-        self.system_message_chat_conversation_string = theme["assistantConfig"]["systemMessageConversationPrompt"]
-        self.query_prompt_few_shots = theme["assistantConfig"]["queryPromptFewShots"]
-        self.follow_up_questions_prompt_content = theme["assistantConfig"]["followUpQuestionsPrompt"]
-        self.query_prompt_template = theme["assistantConfig"]["queryPromptTemplate"]
-
-
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in [
             "vectors", "hybrid", None]
@@ -110,6 +135,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             "semantic_ranker") and has_text else False
 
         original_user_query = history[-1]["content"]
+        # Shared by both prompts, so the history is normalized and counted once
+        history_packer = HistoryPacker(history[:-1], self.chatgpt_model)
         user_query_request = "Generate search query for: " + original_user_query
 
         tools: List[ChatCompletionToolParam] = [
@@ -132,57 +159,150 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             }
         ]
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        query_messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question,
+        # unless the theme's policy lets the question be searched as asked
+        rewrite_decision = self.get_query_rewrite_decision(history)
+        query_messages: list = []
+        query_text = None
+        query_cache_key = None
+        if rewrite_decision.rewrite:
+            query_messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.chatgpt_model,
+                history=history,
+                history_packer=history_packer,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
+            if self.query_rewrite_cache:
+                query_cache_key = self.query_rewrite_cache.make_key(
+                    self.theme_id, self.chatgpt_model, self.query_prompt_template, query_messages
+                )
+                query_text = self.query_rewrite_cache.get(query_cache_key)
+        else:
+            query_text = original_user_query
+        query_from_cache = rewrite_decision.rewrite and query_text is not None
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            # Setting too low risks malformed JSON, setting too high may affect performance
-            max_tokens=100,
-            n=1,
-            tools=tools,
-            tool_choice="auto",
-        )
+        async def retrieve(search_query: str) -> list[Document]:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors: list[VectorQuery] = []
+            if has_vector:
+                vectors.append(await self.compute_text_embedding(search_query))
 
-        query_text = self.get_search_query(
-            chat_completion, original_user_query)
+            # Only keep the text query if the retrieval mode uses text, otherwise drop it
+            return await self.search(
+                top,
+                search_query if has_text else None,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+            )
 
-       
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        # Speculatively search for the question as asked while the search query is being generated
+        speculative_search: Optional[asyncio.Task] = None
+        if overrides.get("speculative_retrieval") and query_text is None:
+            speculative_search = asyncio.create_task(retrieve(original_user_query))
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
+        if query_text is None:
+            try:
+                chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                    messages=query_messages,  # type: ignore
+                    # Azure OpenAI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,  # Minimize creativity for search query generation
+                    # Setting too low risks malformed JSON, setting too high may affect performance
+                    max_tokens=100,
+                    n=1,
+                    tools=tools,
+                    tool_choice="auto",
+                )
+            except BaseException:
+                if speculative_search:
+                    self.discard_task(speculative_search)
+                raise
 
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
+            query_text = self.get_search_query(
+                chat_completion, original_user_query)
+            if self.query_rewrite_cache and query_cache_key:
+                self.query_rewrite_cache.set(query_cache_key, query_text)
+
+        # The thoughts are built as each step completes, and each stage streams the ones it added
+        thoughts: list[ThoughtStep] = [
+            ThoughtStep(
+                "Prompt to generate search query",
+                [str(message) for message in query_messages],
+                {
+                    **(
+                        {"model": self.chatgpt_model,
+                            "deployment": self.chatgpt_deployment}
+                        if self.chatgpt_deployment
+                        else {"model": self.chatgpt_model}
+                    ),
+                    **({"cached": True} if query_from_cache else {}),
+                    **({"skipped": True, "reason": rewrite_decision.reason} if not rewrite_decision.rewrite else {}),
+                },
+            )
+        ]
 
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        search_props: dict[str, Any] = {}
+        if speculative_search:
+            # Keep the speculative results when the generated query barely differs from the question
+            query_similarity = self.get_query_similarity(original_user_query, query_text)
+            speculative_search_kept = query_similarity >= overrides.get(
+                "speculative_similarity", self.SPECULATIVE_SIMILARITY
+            )
+            search_props = {
+                "speculative_retrieval": "kept" if speculative_search_kept else "discarded",
+                "query_similarity": round(query_similarity, 3),
+            }
+            if speculative_search_kept:
+                query_text = original_user_query
+            else:
+                self.discard_task(speculative_search)
+                speculative_search = None
+        # Reported once the query that is actually searched is known
+        self.report_stage(
+            stages, self.STAGE_SEARCH_QUERY, {"search_query": query_text if has_text else None, "thoughts": thoughts}
         )
+        results: list[Document] = await speculative_search if speculative_search else await retrieve(query_text)
+        self.preauthorize_citations(results, auth_claims)
+
+        # Only show the text query if the retrieval mode uses text
+        if not has_text:
+            query_text = None
 
         sources_content = self.get_sources_content(
             results, use_semantic_captions, use_image_citation=False)
         content = "\n".join(sources_content)
+        thoughts.extend(
+            [
+                ThoughtStep(
+                    "Search using generated search query",
+                    query_text,
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "use_semantic_ranker": use_semantic_ranker,
+                        "top": top,
+                        "filter": filter,
+                        "has_vector": has_vector,
+                        **search_props,
+                    },
+                ),
+                ThoughtStep(
+                    "Search results",
+                    [result.serialize_for_results() for result in results],
+                ),
+            ]
+        )
+        data_points = {"text": sources_content}
+        self.report_stage(
+            stages, self.STAGE_SEARCH_RESULTS, {"result_count": len(sources_content), "thoughts": thoughts[1:]}
+        )
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -199,53 +319,25 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             system_prompt=system_message,
             model_id=self.chatgpt_model,
             history=history,
+            history_packer=history_packer,
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
             user_content=original_user_query + "\n\nSources:\n" + content,
             max_tokens=messages_token_limit,
         )
 
-        data_points = {"text": sources_content}
-
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.chatgpt_model,
-                            "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
-                    ),
+        thoughts.append(
+            ThoughtStep(
+                "Prompt to generate answer",
+                [str(message) for message in messages],
+                (
+                    {"model": self.chatgpt_model,
+                        "deployment": self.chatgpt_deployment}
+                    if self.chatgpt_deployment
+                    else {"model": self.chatgpt_model}
                 ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "has_vector": has_vector,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.chatgpt_model,
-                            "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
-                    ),
-                ),
-            ],
-        }
+            )
+        )
+        extra_info = {"data_points": data_points, "thoughts": thoughts}
 
         if results and len(results) > 0:
             results_dict = dict()
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Awaitable, Callable, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
@@ -12,9 +13,15 @@ from openai.types.chat import (
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.embeddingcache import EmbeddingCache
+from core.httpsession import HttpSessionManager
+from core.imagecache import ImageCache
+from core.imageshelper import FetchedImage, fetch_images
+from core.messagebuilder import HistoryPacker
 from core.modelhelper import get_token_limit
+from core.rewritepolicy import QueryRewritePolicy
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -42,7 +49,14 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[EmbeddingCache] = None,
+        image_cache: Optional[ImageCache] = None,
+        http_session: Optional[HttpSessionManager] = None,
+        theme_version: str = "",
+        answer_cache: Optional[AnswerCache] = None,
+        query_rewrite_policy: Optional[QueryRewritePolicy] = None,
+        stream_full_chunks: bool = False,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -53,6 +67,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
+        self.image_cache = image_cache
+        self.http_session = http_session
+        self.theme_version = theme_version
+        self.answer_cache = answer_cache
+        self.query_rewrite_policy = query_rewrite_policy
+        self.stream_full_chunks = stream_full_chunks
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
@@ -85,6 +106,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         auth_claims: dict[str, Any],
         theme: str,
         should_stream: bool = False,
+        stages: Optional[asyncio.Queue] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in [
@@ -105,30 +127,59 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             "textAndImages", "images", None]
 
         original_user_query = history[-1]["content"]
+        # Shared by both prompts, so the history is normalized and counted once
+        history_packer = HistoryPacker(history[:-1], self.gpt4v_model)
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question,
+        # unless the theme's policy lets the question be searched as asked
         user_query_request = "Generate search query for: " + original_user_query
 
-        query_messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.gpt4v_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit -
-            len(" ".join(user_query_request)),
-            few_shots=self.query_prompt_few_shots,
-        )
+        rewrite_decision = self.get_query_rewrite_decision(history)
+        query_messages: list = []
+        if rewrite_decision.rewrite:
+            query_messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.gpt4v_model,
+                history=history,
+                history_packer=history_packer,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit -
+                len(" ".join(user_query_request)),
+                few_shots=self.query_prompt_few_shots,
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=query_messages,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,
-            n=1,
-        )
+            chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                messages=query_messages,
+                temperature=0.0,  # Minimize creativity for search query generation
+                max_tokens=100,
+                n=1,
+            )
 
-        query_text = self.get_search_query(
-            chat_completion, original_user_query)
+            query_text = self.get_search_query(
+                chat_completion, original_user_query)
+        else:
+            query_text = original_user_query
+
+        # The thoughts are built as each step completes, and each stage streams the ones it added
+        thoughts: list[ThoughtStep] = [
+            ThoughtStep(
+                "Prompt to generate search query",
+                [str(message) for message in query_messages],
+                {
+                    **(
+                        {"model": self.gpt4v_model,
+                            "deployment": self.gpt4v_deployment}
+                        if self.gpt4v_deployment
+                        else {"model": self.gpt4v_model}
+                    ),
+                    **({"skipped": True, "reason": rewrite_decision.reason} if not rewrite_decision.rewrite else {}),
+                },
+            )
+        ]
+        self.report_stage(
+            stages, self.STAGE_SEARCH_QUERY, {"search_query": query_text if has_text else None, "thoughts": thoughts}
+        )
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
@@ -157,9 +208,32 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             minimum_search_score,
             minimum_reranker_score,
         )
+        self.preauthorize_citations(results, auth_claims)
         sources_content = self.get_sources_content(
             results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
+        thoughts.extend(
+            [
+                ThoughtStep(
+                    "Search using generated search query",
+                    query_text,
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "use_semantic_ranker": use_semantic_ranker,
+                        "top": top,
+                        "filter": filter,
+                        "vector_fields": vector_fields,
+                    },
+                ),
+                ThoughtStep(
+                    "Search results",
+                    [result.serialize_for_results() for result in results],
+                ),
+            ]
+        )
+        self.report_stage(
+            stages, self.STAGE_SEARCH_RESULTS, {"result_count": len(sources_content), "thoughts": thoughts[1:]}
+        )
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -180,19 +254,22 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         if include_gtpV_text:
             user_content.append(
                 {"text": "\n\nSources:\n" + content, "type": "text"})
+        fetched_images: list[FetchedImage] = []
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            fetched_images = await fetch_images(self.blob_container_client, results, image_cache=self.image_cache)
+            for image in fetched_images:
+                if image.image_url:
+                    image_list.append({"image_url": image.image_url, "type": "image_url"})
             user_content.extend(image_list)
 
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.gpt4v_model,
             history=history,
+            history_packer=history_packer,
             user_content=user_content,
             max_tokens=messages_token_limit,
+            image_dims=[image.dims for image in fetched_images if image.image_url],
         )
 
         data_points = {
@@ -200,46 +277,26 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        if fetched_images:
+            thoughts.append(
                 ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.gpt4v_model,
-                            "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
-                    ),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "vector_fields": vector_fields,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.gpt4v_model,
-                            "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
-                    ),
+                    "Fetch page images",
+                    [image.serialize_for_thoughts() for image in fetched_images],
+                )
+            )
+        thoughts.append(
+            ThoughtStep(
+                "Prompt to generate answer",
+                [str(message) for message in messages],
+                (
+                    {"model": self.gpt4v_model,
+                        "deployment": self.gpt4v_deployment}
+                    if self.gpt4v_deployment
+                    else {"model": self.gpt4v_model}
                 ),
-            ],
-        }
+            )
+        )
+        extra_info = {"data_points": data_points, "thoughts": thoughts}
 
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
@@ -6,6 +6,7 @@ from openai import AsyncOpenAI
 
 from approaches.approach import Approach, ThoughtStep
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
 
 
@@ -52,6 +53,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -60,6 +62,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.chatgpt_model = chatgpt_model
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
@@ -104,6 +107,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             minimum_search_score,
             minimum_reranker_score,
         )
+        self.preauthorize_citations(results, auth_claims)
 
         user_content = [q]
 
@@ -10,7 +10,10 @@ from openai.types.chat import (
 
 from approaches.approach import Approach, ThoughtStep
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.embeddingcache import EmbeddingCache
+from core.httpsession import HttpSessionManager
+from core.imagecache import ImageCache
+from core.imageshelper import FetchedImage, fetch_images
 from core.messagebuilder import MessageBuilder
 
 
@@ -49,7 +52,10 @@ class RetrieveThenReadVisionApproach(Approach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[EmbeddingCache] = None,
+        image_cache: Optional[ImageCache] = None,
+        http_session: Optional[HttpSessionManager] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -58,6 +64,9 @@ class RetrieveThenReadVisionApproach(Approach):
         self.embedding_model = embedding_model
         self.embedding_deployment = embedding_deployment
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
+        self.image_cache = image_cache
+        self.http_session = http_session
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.gpt4v_deployment = gpt4v_deployment
@@ -116,6 +125,7 @@ class RetrieveThenReadVisionApproach(Approach):
             minimum_search_score,
             minimum_reranker_score,
         )
+        self.preauthorize_citations(results, auth_claims)
 
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
@@ -131,11 +141,12 @@ class RetrieveThenReadVisionApproach(Approach):
         if include_gtpV_text:
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
+        fetched_images: list[FetchedImage] = []
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            fetched_images = await fetch_images(self.blob_container_client, results, image_cache=self.image_cache)
+            for image in fetched_images:
+                if image.image_url:
+                    image_list.append({"image_url": image.image_url, "type": "image_url"})
             user_content.extend(image_list)
 
         # Append user message
@@ -174,6 +185,16 @@ class RetrieveThenReadVisionApproach(Approach):
                     "Search results",
                     [result.serialize_for_results() for result in results],
                 ),
+                *(
+                    [
+                        ThoughtStep(
+                            "Fetch page images",
+                            [image.serialize_for_thoughts() for image in fetched_images],
+                        )
+                    ]
+                    if fetched_images
+                    else []
+                ),
                 ThoughtStep(
                     "Prompt to generate answer",
                     [str(message) for message in updated_messages],
@@ -15,4 +15,13 @@ CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
 CONFIG_INGESTER = "ingester"
 CONFIG_SHOW_THOUGHT_PROCESS="show_thought_process"
-CONFIG_SHOW_SUPPORTING_CONTENT="show_supporting_content"
\ No newline at end of file
+CONFIG_SHOW_SUPPORTING_CONTENT="show_supporting_content"
+CONFIG_SEARCH_CLIENT_POOL = "search_client_pool"
+CONFIG_CHAT_APPROACH_FACTORY = "chat_approach_factory"
+CONFIG_SHARED_CACHE = "shared_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_IMAGE_CACHE = "image_cache"
+CONFIG_CACHE_STATS = "cache_stats"
+CONFIG_HTTP_SESSION = "http_session"
+CONFIG_NDJSON_ENCODER = "ndjson_encoder"
+CONFIG_NDJSON_COALESCE_LATENCY = "ndjson_coalesce_latency"
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+from cachetools import TTLCache
+
+from core.cachestats import CacheStats
+from core.sharedcache import SharedCache
+
+# Shared cache key whose version is bumped whenever the content of the search indexes changes
+INDEX_GENERATION_KEY = "index_generation"
+
+
+@dataclass
+class CachedAnswer:
+    content: str
+    context: dict[str, Any]
+    stored_at: float
+
+
+class AnswerCache:
+    """
+    TTL cache of complete chat answers, keyed by theme version, security filter, overrides and normalized history.
+    The key also includes the index generation kept in the shared cache, so bumping it
+    (on upload, delete or /clearcache) invalidates the answers cached by every worker.
+    """
+
+    def __init__(self, shared_cache: SharedCache, maxsize: int = 1000, ttl: float = 600):
+        self.shared_cache = shared_cache
+        self.answers: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stats = CacheStats()
+
+    @staticmethod
+    def normalize_content(content: Any) -> Any:
+        if isinstance(content, str):
+            return " ".join(content.split())
+        return content
+
+    def make_key(
+        self,
+        theme_version: str,
+        security_filter: Optional[str],
+        overrides: dict[str, Any],
+        history: Sequence[dict[str, Any]],
+    ) -> str:
+        normalized_history = [
+            [message.get("role"), self.normalize_content(message.get("content"))] for message in history
+        ]
+        payload = json.dumps(
+            [
+                self.shared_cache.version(INDEX_GENERATION_KEY),
+                theme_version,
+                security_filter,
+                overrides,
+                normalized_history,
+            ],
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        answer = self.answers.get(key)
+        if answer is None:
+            self.stats.miss()
+        else:
+            self.stats.hit()
+        return answer
+
+    def set(self, key: str, content: str, context: dict[str, Any]):
+        self.answers[key] = CachedAnswer(content=content, context=context, stored_at=time.time())
+
+    def invalidate(self):
+        self.shared_cache.invalidate(INDEX_GENERATION_KEY)
+        self.answers.clear()
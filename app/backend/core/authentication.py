@@ -1,22 +1,28 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import functools
+import hashlib
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from core.log import Logger
-from typing import Any, Optional
+from typing import Any, Iterable, Optional, Sequence
 
 import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchIndex
+from cachetools import TLRUCache
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTClaimsError
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
-from tenacity import (
-    AsyncRetrying,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_random_exponential,
-)
+
+from core.groupcache import GroupMembershipCache
+from core.httpsession import HttpSessionManager
+from core.jwkscache import JwksCache, JwksError
+from core.pathauthcache import PathAuthCache
+from core.singleflight import SingleFlight
 
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
@@ -43,8 +49,16 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        path_auth_cache: Optional[PathAuthCache] = None,
+        group_cache: Optional[GroupMembershipCache] = None,
+        http_session: Optional[HttpSessionManager] = None,
+        obo_max_workers: int = 4,
+        auth_claims_cache_size: int = 10000,
     ):
         self.use_authentication = use_authentication
+        self.path_auth_cache = path_auth_cache
+        self.group_cache = group_cache
+        self.http_session = http_session
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
@@ -59,6 +73,15 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        self.jwks_cache = JwksCache(self.key_url, http_session=http_session)
+        # The MSAL on-behalf-of exchange is synchronous, so it runs in its own threads rather than on the event loop
+        self.obo_executor = ThreadPoolExecutor(max_workers=obo_max_workers, thread_name_prefix="obo")
+        # Claims read from the validated access tokens, keyed by token hash until the token expires.
+        # The groups of users with a groups overage claim aren't part of them, they are read on every request.
+        self.auth_claims_cache: TLRUCache = TLRUCache(
+            maxsize=auth_claims_cache_size, ttu=lambda key, value, now: value[0], timer=time.time
+        )
+        self.auth_claims_exchanges = SingleFlight()
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -177,32 +200,39 @@ class AuthenticationHelper:
         return security_filter
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await AuthenticationHelper.list_groups(graph_resource_access_token, session)
+
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            resp_json = None
-            resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
-                resp_json = await resp.json()
-                resp_status = resp.status
-                if resp_status != 200:
-                    raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
-
-            while resp_status == 200:
-                value = resp_json["value"]
-                for group in value:
-                    groups.append(group["id"])
-                next_link = resp_json.get("@odata.nextLink")
-                if next_link:
-                    async with session.get(url=next_link) as resp:
-                        resp_json = await resp.json()
-                        resp_status = resp.status
-                else:
-                    break
+        resp_json = None
+        resp_status = None
+        async with session.get(
+            url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id", headers=headers
+        ) as resp:
+            resp_json = await resp.json()
+            resp_status = resp.status
             if resp_status != 200:
                 raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
+        while resp_status == 200:
+            value = resp_json["value"]
+            for group in value:
+                groups.append(group["id"])
+            next_link = resp_json.get("@odata.nextLink")
+            if next_link:
+                async with session.get(url=next_link, headers=headers) as resp:
+                    resp_json = await resp.json()
+                    resp_status = resp.status
+            else:
+                break
+        if resp_status != 200:
+            raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
+
         return groups
 
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
@@ -214,35 +244,22 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            # Validate the token before use
-            await self.validate_access_token(auth_token)
-
-            # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
-            # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
-            if "error" in graph_resource_access_token:
-                raise AuthError(error=str(graph_resource_access_token), status_code=401)
-
-            # Read the claims from the response. The oid and groups claims are used for security filtering
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
-            id_token_claims = graph_resource_access_token["id_token_claims"]
-            auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups", [])}
-
-            # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
-            # or a groups overage claim may have been emitted.
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
-            missing_groups_claim = "groups" not in id_token_claims
-            has_group_overage_claim = (
-                missing_groups_claim
-                and "_claim_names" in id_token_claims
-                and "groups" in id_token_claims["_claim_names"]
-            )
-            if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
-            return auth_claims
+            token_key = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            cached = self.auth_claims_cache.get(token_key)
+            if cached is None:
+                # Concurrent requests with the same token share a single validation and exchange
+                cached = await self.auth_claims_exchanges.do(token_key, lambda: self.exchange_token(auth_token))
+                # Only tokens with an expiry are cached, until they expire
+                if cached[0]:
+                    self.auth_claims_cache[token_key] = cached
+            _, token_claims, graph_resource_access_token = cached
+            if graph_resource_access_token is not None:
+                # Served by the group cache for GROUP_CACHE_TTL, so that group changes are seen before the token expires
+                return {
+                    "oid": token_claims["oid"],
+                    "groups": await self.get_overage_groups(token_claims["oid"], graph_resource_access_token),
+                }
+            return {"oid": token_claims["oid"], "groups": list(token_claims["groups"])}
         except AuthError as e:
             logging.error("Exception getting authorization information - " + json.dumps(e.error))
             if self.require_access_control and not self.enable_unauthenticated_access:
@@ -254,7 +271,76 @@ class AuthenticationHelper:
                 raise
             return {}
 
-    async def check_path_auth(self, path: str, auth_claims: dict[str, Any], search_client: SearchClient) -> bool:
+    async def exchange_token(self, auth_token: str) -> tuple[float, dict[str, Any], Optional[dict]]:
+        """
+        Validates the access token and exchanges it for the user's claims.
+        Returns the expiry of the token (0 when the token has none) along with the claims read from the token,
+        and the Microsoft Graph token when the user's groups have to be listed from Graph.
+        """
+        # Validate the token before use
+        token_claims = await self.validate_access_token(auth_token)
+
+        # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
+        # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
+        graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+            self.obo_executor,
+            functools.partial(
+                self.confidential_client.acquire_token_on_behalf_of,
+                user_assertion=auth_token,
+                scopes=["https://graph.microsoft.com/.default"],
+            ),
+        )
+        if "error" in graph_resource_access_token:
+            raise AuthError(error=str(graph_resource_access_token), status_code=401)
+
+        # Read the claims from the response. The oid and groups claims are used for security filtering
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
+        id_token_claims = graph_resource_access_token["id_token_claims"]
+        auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups", [])}
+        expiry = (token_claims or {}).get("exp", 0)
+
+        # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
+        # or a groups overage claim may have been emitted.
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
+        missing_groups_claim = "groups" not in id_token_claims
+        has_group_overage_claim = (
+            missing_groups_claim
+            and "_claim_names" in id_token_claims
+            and "groups" in id_token_claims["_claim_names"]
+        )
+        if missing_groups_claim or has_group_overage_claim:
+            # The user's groups are read from Microsoft Graph with this token on each request
+            return expiry, auth_claims, graph_resource_access_token
+        return expiry, auth_claims, None
+
+    async def get_overage_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        # Read the user's groups from Microsoft Graph
+        group_cache = self.group_cache
+        if group_cache is not None:
+            return await group_cache.get(
+                oid,
+                lambda: AuthenticationHelper.list_groups(graph_resource_access_token, group_cache.get_session()),
+            )
+        return await AuthenticationHelper.list_groups(
+            graph_resource_access_token, self.http_session.get_session() if self.http_session else None
+        )
+
+    async def close(self):
+        self.obo_executor.shutdown(wait=False)
+        if self.group_cache:
+            await self.group_cache.close()
+
+    async def check_path_auth(
+        self,
+        path: str,
+        auth_claims: dict[str, Any],
+        search_client: SearchClient,
+        other_search_clients: Sequence[SearchClient] = (),
+    ) -> bool:
+        """
+        Checks that the user can access the file in the index of search_client or in one of other_search_clients,
+        such as the indexes of the themes. Decisions are cached for the path as a whole.
+        """
         # Start with the standard security filter for all queries
         security_filter = self.build_security_filters(overrides={}, auth_claims=auth_claims)
         # If there was no security filter or no path, then the path is allowed
@@ -262,9 +348,14 @@ class AuthenticationHelper:
             return True
 
         # Remove any fragment string from the path before checking
-        fragment_index = path.find("#")
-        if fragment_index != -1:
-            path = path[:fragment_index]
+        path = PathAuthCache.normalize_path(path)
+
+        cache_key = None
+        if self.path_auth_cache:
+            cache_key = self.path_auth_cache.make_key(auth_claims, path)
+            cached_allowed = self.path_auth_cache.get(cache_key)
+            if cached_allowed is not None:
+                return cached_allowed
 
         # Filter down to only chunks that are from the specific source file
         # Sourcepage is used for GPT-4V
@@ -273,41 +364,50 @@ class AuthenticationHelper:
         path_for_filter = path.replace("'", "''")
         filter = f"{security_filter} and ((sourcefile eq '{path_for_filter}') or (sourcepage eq '{path_for_filter}'))"
 
-        # If the filter returns any results, the user is allowed to access the document
-        # Otherwise, access is denied
-        results = await search_client.search(search_text="*", top=1, filter=filter)
+        # If the filter returns any results in one of the indexes, the user is allowed to access the document
+        # Otherwise, access is denied. The indexes are searched together, and the first one that allows wins.
         allowed = False
-        async for _ in results:
-            allowed = True
-            break
+        searches = [
+            asyncio.ensure_future(self.has_search_results(client, filter))
+            for client in (search_client, *other_search_clients)
+        ]
+        try:
+            for search in asyncio.as_completed(searches):
+                if await search:
+                    allowed = True
+                    break
+        finally:
+            for search in searches:
+                search.cancel()
 
+        if self.path_auth_cache:
+            self.path_auth_cache.set(cache_key, allowed)
         return allowed
 
+    @staticmethod
+    async def has_search_results(search_client: SearchClient, filter: str) -> bool:
+        results = await search_client.search(search_text="*", top=1, filter=filter)
+        async for _ in results:
+            return True
+        return False
+
+    def preauthorize_paths(self, paths: Iterable[str], auth_claims: dict[str, Any]):
+        """
+        Caches the paths of search results as allowed: they were returned by a search with the security filter,
+        so the user is going to be allowed to open their citations.
+        """
+        if not self.path_auth_cache or not self.build_security_filters(overrides={}, auth_claims=auth_claims):
+            return
+        for path in paths:
+            if path:
+                self.path_auth_cache.set(self.path_auth_cache.make_key(auth_claims, path), True)
+
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
     async def validate_access_token(self, token: str):
         """
         Validate an access token is issued by Entra
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError({"code": "invalid_keys", "description": "Unable to get keys to validate auth token."}, 401)
-
-        rsa_key = None
+        rsa_key: Optional[dict[str, Any]] = None
         issuer = None
         audience = None
         try:
@@ -315,14 +415,17 @@ class AuthenticationHelper:
             unverified_claims = jwt.get_unverified_claims(token)
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            for key in jwks["keys"]:
-                if key["kid"] == unverified_header["kid"]:
-                    rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
-                    break
+            kid = unverified_header["kid"]
         except Exception as exc:
             raise AuthError(
                 {"code": "invalid_header", "description": "Unable to parse authorization token."}, 401
             ) from exc
+        try:
+            key = await self.jwks_cache.get_key(kid)
+        except JwksError as error:
+            raise AuthError(error.error, error.status_code) from error
+        if key:
+            rsa_key = {field: key[field] for field in ("kty", "kid", "use", "n", "e") if field in key}
         if not rsa_key:
             raise AuthError({"code": "invalid_header", "description": "Unable to find appropriate key"}, 401)
 
@@ -341,7 +444,7 @@ class AuthenticationHelper:
             )
 
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except ExpiredSignatureError as jwt_expired_exc:
             raise AuthError({"code": "token_expired", "description": "token is expired"}, 401) from jwt_expired_exc
         except JWTClaimsError as jwt_claims_exc:
@@ -0,0 +1,25 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheStats:
+    """
+    Hit and miss counters of one cache, exposed by the /cachestats route
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self) -> dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hit_ratio, 4)}
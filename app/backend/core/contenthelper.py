@@ -0,0 +1,139 @@
+import mimetypes
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Mapping, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
+from werkzeug.http import (
+    http_date,
+    parse_date,
+    parse_etags,
+    parse_if_range_header,
+    parse_range_header,
+)
+
+
+@dataclass
+class ContentResponse:
+    status: int
+    headers: Dict[str, str] = field(default_factory=dict)
+    # Blob or DataLake StorageStreamDownloader, for the responses with a body
+    downloader: Optional[Any] = None
+
+    async def chunks(self) -> AsyncGenerator[bytes, None]:
+        # The responses without a downloader have no body
+        if self.downloader is None:
+            return
+        async for chunk in self.downloader.chunks():
+            yield chunk
+
+
+def get_mime_type(path: str, properties: Any) -> str:
+    mime_type = properties["content_settings"]["content_type"]
+    if mime_type == "application/octet-stream":
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return mime_type
+
+
+def get_validator_headers(properties: Any) -> Dict[str, str]:
+    headers = {"Accept-Ranges": "bytes"}
+    if properties.etag:
+        headers["ETag"] = properties.etag
+    if properties.last_modified:
+        headers["Last-Modified"] = http_date(properties.last_modified)
+    return headers
+
+
+def get_total_size(properties: Any) -> Optional[int]:
+    # Blob downloads report the range as "bytes <start>-<end>/<total>", DataLake downloads don't
+    content_range = properties.get("content_range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
+
+
+def get_conditions(headers: Mapping[str, str]) -> Dict[str, Any]:
+    """
+    Turns the conditional GET headers into the keywords of download_blob and download_file,
+    so that the storage service answers 304 itself. Storage compares a single entity tag,
+    so a list of them is ignored and the file is sent.
+    """
+    if headers.get("If-None-Match"):
+        etags = parse_etags(headers["If-None-Match"]).as_set(include_weak=True)
+        if len(etags) == 1:
+            return {"etag": f'"{etags.pop()}"', "match_condition": MatchConditions.IfModified}
+        return {}
+    if headers.get("If-Modified-Since"):
+        if_modified_since = parse_date(headers["If-Modified-Since"])
+        if if_modified_since:
+            return {"if_modified_since": if_modified_since}
+    return {}
+
+
+async def download_content(
+    download: Callable[..., Awaitable[Any]],
+    get_properties: Callable[[], Awaitable[Any]],
+    headers: Mapping[str, str],
+) -> ContentResponse:
+    """
+    Starts streaming a blob or DataLake file for the request headers, honouring a single byte Range
+    (with If-Range), If-None-Match and If-Modified-Since. Only the requested range is downloaded.
+    Multiple ranges aren't supported, the whole file is sent instead as the RFC allows.
+    """
+    conditions = get_conditions(headers)
+    byte_range = parse_range_header(headers.get("Range"))
+    if byte_range and (byte_range.units != "bytes" or len(byte_range.ranges) != 1):
+        byte_range = None
+    range_conditions: Dict[str, Any] = {}
+    if byte_range and headers.get("If-Range"):
+        if_range = parse_if_range_header(headers["If-Range"])
+        if if_range.etag and not conditions:
+            # Only send the range of the version the client has, otherwise the whole file
+            range_conditions = {"etag": f'"{if_range.etag}"', "match_condition": MatchConditions.IfNotModified}
+        else:
+            byte_range = None
+
+    offset: Optional[int] = None
+    length: Optional[int] = None
+    if byte_range:
+        start, stop = byte_range.ranges[0]
+        if start < 0:
+            # A suffix range needs the size of the file
+            size = (await get_properties()).size
+            resolved = byte_range.range_for_length(size)
+            if resolved is None:
+                return ContentResponse(416, {"Content-Range": f"bytes */{size}"})
+            start, stop = resolved
+        offset, length = start, (stop - start if stop is not None else None)
+
+    # Storage errors are matched on status, as it reports both 304 and 412 as ConditionNotMet
+    try:
+        try:
+            range_options = {"offset": offset, "length": length} if offset is not None else {}
+            downloader = await download(**range_options, **conditions, **range_conditions)
+        except HttpResponseError as error:
+            if error.status_code != 412 or not range_conditions:
+                raise
+            # The file changed since the client got its part of it, so it gets the whole file
+            offset = length = None
+            downloader = await download(**conditions)
+    except HttpResponseError as error:
+        if error.status_code == 304:
+            return ContentResponse(304, {"ETag": conditions["etag"]} if "etag" in conditions else {})
+        if error.status_code == 416:
+            size = (await get_properties()).size
+            return ContentResponse(416, {"Content-Range": f"bytes */{size}"})
+        raise
+
+    properties = downloader.properties
+    response_headers = get_validator_headers(properties)
+    response_headers["Content-Length"] = str(downloader.size)
+    if offset is None:
+        return ContentResponse(200, response_headers, downloader)
+    total_size = get_total_size(properties)
+    response_headers["Content-Range"] = (
+        f"bytes {offset}-{offset + downloader.size - 1}/{total_size if total_size is not None else '*'}"
+    )
+    return ContentResponse(206, response_headers, downloader)
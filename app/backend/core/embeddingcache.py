@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+from cachetools import LRUCache
+
+from core.cachestats import CacheStats
+from core.log import Logger
+
+
+class EmbeddingCache:
+    """
+    Caches query embeddings keyed by (model, deployment, dimensions, normalized text).
+    Vectors are kept as float32 arrays in a bounded in-process LRU. With a path, they are also written to
+    a SQLite database, which the workers of a host share, so a vector computed by one worker is reused by all.
+    The database keeps at most max_persistent_entries vectors, each for ttl seconds since it was last used:
+    every insert drops the expired rows, then the least recently used ones beyond the limit.
+    The database is only used from a single thread of its own, so that waiting on its lock doesn't block
+    the event loop. Reads are awaited, writes are queued there without holding up the request.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        path: Optional[str] = None,
+        max_persistent_entries: int = 100000,
+        ttl: float = 7 * 24 * 3600,
+        timer: Callable[[], float] = time.time,
+    ):
+        self.logging = Logger()
+        self.vectors: LRUCache = LRUCache(maxsize=maxsize)
+        self.stats = CacheStats()
+        self.persistent_stats = CacheStats()
+        self.max_persistent_entries = max_persistent_entries
+        self.ttl = ttl
+        self.timer = timer
+        self.connection: Optional[sqlite3.Connection] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if path:
+            try:
+                self.connection = sqlite3.connect(path, timeout=1, check_same_thread=False)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, used_at REAL)"
+                )
+                self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+                self.connection.commit()
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+            except sqlite3.Error as error:
+                self.logging.warning(f"Embedding cache database {path} unavailable, only caching in memory: {error}")
+                self.connection = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def make_key(self, model: str, deployment: Optional[str], dimensions: int, text: str) -> str:
+        payload = json.dumps([model, deployment, dimensions, self.normalize(text)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, model: str, deployment: Optional[str], dimensions: int, text: str) -> Optional[List[float]]:
+        key = self.make_key(model, deployment, dimensions, text)
+        vector = self.vectors.get(key)
+        if vector is None and self.executor:
+            vector = await asyncio.get_running_loop().run_in_executor(self.executor, self.read, key)
+            if vector is not None:
+                self.vectors[key] = vector
+        if vector is None:
+            self.stats.miss()
+            return None
+        self.stats.hit()
+        return vector.tolist()
+
+    def set(self, model: str, deployment: Optional[str], dimensions: int, text: str, embedding: Sequence[float]):
+        key = self.make_key(model, deployment, dimensions, text)
+        vector = array("f", embedding)
+        self.vectors[key] = vector
+        if self.executor:
+            self.executor.submit(self.write, key, vector, self.timer())
+
+    def read(self, key: str) -> Optional[array]:
+        connection = self.connection
+        if connection is None:
+            return None
+        now = self.timer()
+        try:
+            row = connection.execute(
+                "SELECT vector FROM embeddings WHERE key = ? AND used_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                connection.execute("UPDATE embeddings SET used_at = ? WHERE key = ?", (now, key))
+                connection.commit()
+        except sqlite3.Error as error:
+            self.logging.warning(f"Error reading the embedding cache: {error}")
+            return None
+        if row is None:
+            self.persistent_stats.miss()
+            return None
+        self.persistent_stats.hit()
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector
+
+    def write(self, key: str, vector: array, used_at: float):
+        connection = self.connection
+        if connection is None:
+            return
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, used_at) VALUES (?, ?, ?)",
+                (key, vector.tobytes(), used_at),
+            )
+            connection.execute("DELETE FROM embeddings WHERE used_at <= ?", (used_at - self.ttl,))
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_persistent_entries,),
+            )
+            connection.commit()
+        except sqlite3.Error as error:
+            self.logging.warning(f"Error writing the embedding cache: {error}")
+
+    def close_connection(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    async def close(self):
+        if self.executor:
+            # Runs after the writes queued before it
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.close_connection)
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,73 @@
+from typing import List
+
+
+class FollowupQuestionParser:
+    """
+    Splits a streamed answer into its content and the follow-up questions enclosed in << and >>, as the deltas arrive.
+    Everything from the first << on belongs to the follow-up questions, as with ChatApproach.extract_followup_questions.
+    Each delta is scanned once, and a < or > ending a delta is held back until the next one tells
+    whether it is half of a delimiter. Questions are returned as soon as their closing >> arrives.
+    """
+
+    def __init__(self):
+        # Whether the first << was seen, the content ends there
+        self.in_followups = False
+        # Whether a << was opened and not yet closed
+        self.in_question = False
+        self.question: List[str] = []
+        # Trailing < or > of the previous delta, which may start a delimiter
+        self.held = ""
+
+    def feed(self, delta: str) -> tuple[str, List[str]]:
+        """
+        Returns the part of the delta that belongs to the answer, and the follow-up questions completed by it
+        """
+        text = self.held + delta
+        self.held = ""
+        content = ""
+        if not self.in_followups:
+            start = text.find("<<")
+            if start == -1:
+                if text.endswith("<"):
+                    self.held, text = "<", text[:-1]
+                return text, []
+            self.in_followups = True
+            content, text = text[:start], text[start:]
+
+        questions: List[str] = []
+        position = 0
+        while position < len(text):
+            if not self.in_question:
+                start = text.find("<<", position)
+                if start == -1:
+                    if text.endswith("<"):
+                        self.held = "<"
+                    break
+                self.in_question = True
+                position = start + 2
+                continue
+            end = text.find(">", position)
+            if end == -1:
+                self.question.append(text[position:])
+                break
+            self.question.append(text[position:end])
+            if end + 1 == len(text):
+                self.held = ">"
+                break
+            if text[end + 1] == ">":
+                question = "".join(self.question)
+                # As with the regular expression, <<>> isn't a question
+                if question:
+                    questions.append(question)
+            # A single > can't be part of a question, the text up to it is dropped
+            self.question = []
+            self.in_question = False
+            position = end + 2 if text[end + 1] == ">" else end + 1
+        return content, questions
+
+    def close(self) -> str:
+        """
+        Returns the content held back at the end of the stream
+        """
+        held, self.held = self.held, ""
+        return held if not self.in_followups else ""
@@ -0,0 +1,64 @@
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import aiohttp
+from cachetools import TTLCache
+
+from core.cachestats import CacheStats
+from core.httpsession import HttpSessionManager
+from core.singleflight import SingleFlight
+
+
+class GroupMembershipCache:
+    """
+    Caches the groups of users with a groups overage claim, read from Microsoft Graph, keyed by oid.
+    Groups are served for up to ttl seconds. After refresh_after seconds they are still served,
+    while a request refreshes them in the background with its own Graph token.
+    Concurrent lookups for the same user are coalesced into a single listing.
+    The Graph pages are read through the persistent session of http_session, its own one when not given.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        refresh_after: float = 240,
+        maxsize: int = 10000,
+        timer: Callable[[], float] = time.monotonic,
+        http_session: Optional[HttpSessionManager] = None,
+    ):
+        self.refresh_after = refresh_after
+        self.timer = timer
+        # Groups along with the time they were listed
+        self.groups: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.listings = SingleFlight()
+        # A session manager shared with the rest of the app is closed by the app
+        self.owns_http_session = http_session is None
+        self.http_session = http_session or HttpSessionManager()
+        self.stats = CacheStats()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        return self.http_session.get_session()
+
+    async def refresh(self, oid: str, list_groups: Callable[[], Awaitable[List[str]]]) -> List[str]:
+        groups = await list_groups()
+        self.groups[oid] = (groups, self.timer())
+        return groups
+
+    async def get(self, oid: str, list_groups: Callable[[], Awaitable[List[str]]]) -> List[str]:
+        cached: Optional[Tuple[List[str], float]] = self.groups.get(oid)
+        if cached is None:
+            self.stats.miss()
+            groups = await self.listings.do(oid, lambda: self.refresh(oid, list_groups))
+            return list(groups)
+        self.stats.hit()
+        groups, listed_at = cached
+        if self.timer() - listed_at >= self.refresh_after:
+            self.listings.start(oid, lambda: self.refresh(oid, list_groups))
+        return list(groups)
+
+    def clear(self):
+        self.groups.clear()
+
+    async def close(self):
+        if self.owns_http_session:
+            await self.http_session.close()
@@ -0,0 +1,48 @@
+from typing import Optional
+
+import aiohttp
+
+
+class HttpSessionManager:
+    """
+    Owns the aiohttp session shared by the HTTP calls of the app (AI Vision, Microsoft Graph, Entra keys),
+    so that their connections, DNS lookups and TLS sessions are reused rather than set up for every call.
+    The connection pool is bounded overall by limit and per host by limit_per_host, idle connections
+    are kept alive for keepalive_timeout seconds and DNS answers are cached for ttl_dns_cache seconds.
+    The session is created on first use, within the running event loop, and no default headers are set,
+    as the callers send their own credentials.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300,
+        timeout: float = 60,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = self.create_session()
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
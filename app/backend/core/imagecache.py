@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from cachetools import LRUCache
+
+from core.cachestats import CacheStats
+from core.log import Logger
+
+
+@dataclass
+class CachedImage:
+    etag: str
+    data: str
+    validated_at: float
+
+
+class EvictingLRUCache(LRUCache):
+    """
+    LRU cache calling on_evict with the items it drops to stay within its size
+    """
+
+    def __init__(self, maxsize: int, getsizeof: Callable[[Any], int], on_evict: Optional[Callable[[Any, Any], None]]):
+        super().__init__(maxsize=maxsize, getsizeof=getsizeof)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self.on_evict:
+            self.on_evict(key, value)
+        return key, value
+
+
+class ImageCache:
+    """
+    Caches the page images sent to GPT-4V as base64 data URIs, keyed by blob name along with the blob's ETag.
+    The in-memory LRU is bounded by the total size of the images rather than their count.
+    Images are served without a request for revalidate_after seconds, then revalidated with a conditional download.
+    With a spill_directory, images evicted from memory are written to disk, up to max_spill_bytes for all the
+    workers of a host. Each worker spills to a subdirectory of its own, which only it reads and trims, and keeps
+    an equal share of the limit among the workers spilling there. The files are written, read and removed on a
+    thread of the cache's own, so that the event loop doesn't wait on the disk.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 256 * 1024 * 1024,
+        spill_directory: Optional[str] = None,
+        max_spill_bytes: int = 1024 * 1024 * 1024,
+        revalidate_after: float = 60,
+        worker_pid: Optional[int] = None,
+    ):
+        self.logging = Logger()
+        self.revalidate_after = revalidate_after
+        self.shared_spill_directory = spill_directory
+        self.spill_directory = (
+            os.path.join(spill_directory, f"worker-{worker_pid or os.getpid()}") if spill_directory else None
+        )
+        self.max_spill_bytes = max_spill_bytes
+        # Sizes of the spilled files, least recently written first, only used on the spill thread
+        self.spilled: OrderedDict[str, int] = OrderedDict()
+        self.spilled_bytes = 0
+        self.images = EvictingLRUCache(
+            maxsize=max_bytes,
+            getsizeof=lambda image: len(image.data),
+            on_evict=self.spill if spill_directory else None,
+        )
+        self.stats = CacheStats()
+        self.spill_stats = CacheStats()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.spill_directory:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-cache")
+            os.makedirs(self.spill_directory, exist_ok=True)
+            self.remove_orphans()
+            # Files left by an earlier worker with the same pid count towards the limit
+            entries = sorted(
+                (entry for entry in os.scandir(self.spill_directory) if entry.name.endswith(".b64")),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            for entry in entries:
+                self.track(entry.path, entry.stat().st_size)
+            self.trim()
+
+    @staticmethod
+    def get_worker_pid(name: str) -> Optional[int]:
+        prefix, _, pid = name.partition("-")
+        return int(pid) if prefix == "worker" and pid.isdigit() else None
+
+    @staticmethod
+    def is_running(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, OverflowError):
+            # Owned by another user, or not a pid at all: left alone
+            pass
+        return True
+
+    def remove_orphans(self):
+        # The subdirectories of workers that exited, such as those recycled by gunicorn, are no longer trimmed
+        for entry in os.scandir(self.shared_spill_directory):
+            pid = self.get_worker_pid(entry.name)
+            if pid is not None and entry.path != self.spill_directory and not self.is_running(pid):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def get_spill_limit(self) -> int:
+        try:
+            workers = sum(
+                1 for entry in os.scandir(self.shared_spill_directory) if self.get_worker_pid(entry.name) is not None
+            )
+        except OSError:
+            workers = 1
+        return self.max_spill_bytes // max(workers, 1)
+
+    def path(self, blob_name: str) -> str:
+        if self.spill_directory is None:
+            raise ValueError("Images are only spilled to disk with a spill directory")
+        return os.path.join(self.spill_directory, hashlib.sha256(blob_name.encode("utf-8")).hexdigest() + ".b64")
+
+    def is_stale(self, image: CachedImage) -> bool:
+        return time.time() - image.validated_at > self.revalidate_after
+
+    async def get(self, blob_name: str) -> Optional[CachedImage]:
+        image = self.images.get(blob_name)
+        if image is None and self.executor:
+            image = await asyncio.get_running_loop().run_in_executor(self.executor, self.read, blob_name)
+            if image is not None:
+                self.put(blob_name, image)
+        return image
+
+    def set(self, blob_name: str, etag: str, data: str):
+        self.put(blob_name, CachedImage(etag=etag, data=data, validated_at=time.time()))
+
+    def put(self, blob_name: str, image: CachedImage):
+        try:
+            self.images[blob_name] = image
+        except ValueError:
+            # Larger than the whole cache
+            self.images.pop(blob_name, None)
+
+    def revalidated(self, blob_name: str, image: CachedImage):
+        image.validated_at = time.time()
+        if blob_name not in self.images:
+            self.put(blob_name, image)
+
+    def read(self, blob_name: str) -> Optional[CachedImage]:
+        path = self.path(blob_name)
+        try:
+            with open(path, encoding="utf-8") as image_file:
+                etag = image_file.readline().rstrip("\n")
+                data = image_file.read()
+        except OSError:
+            self.spill_stats.miss()
+            return None
+        self.spill_stats.hit()
+        # Back in memory, the copy on disk is no longer needed
+        self.remove(path)
+        # Revalidate images read from disk before serving them
+        return CachedImage(etag=etag, data=data, validated_at=0)
+
+    def spill(self, blob_name: str, image: CachedImage):
+        # Queued behind the reads and writes before it, so a read of the image finds its file.
+        # Images evicted once the cache is closed are dropped.
+        if self.executor is not None:
+            self.executor.submit(self.write, blob_name, image)
+
+    def write(self, blob_name: str, image: CachedImage):
+        path = self.path(blob_name)
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as image_file:
+                image_file.write(f"{image.etag}\n")
+                image_file.write(image.data)
+            os.replace(temp_path, path)
+        except OSError as error:
+            self.logging.warning(f"Error spilling image {blob_name} to disk: {error}")
+            return
+        self.track(path, len(image.etag) + 1 + len(image.data))
+        self.trim()
+
+    def track(self, path: str, size: int):
+        self.spilled_bytes -= self.spilled.pop(path, 0)
+        self.spilled[path] = size
+        self.spilled_bytes += size
+
+    def remove(self, path: str):
+        self.spilled_bytes -= self.spilled.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def trim(self):
+        limit = self.get_spill_limit()
+        while self.spilled_bytes > limit and self.spilled:
+            self.remove(next(iter(self.spilled)))
+
+    def remove_spilled(self):
+        for path in list(self.spilled):
+            self.remove(path)
+
+    async def clear(self):
+        self.images.clear()
+        if self.executor:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.remove_spilled)
+
+    def remove_spill_directory(self):
+        if self.spill_directory is not None:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+
+    async def close(self):
+        if self.executor is not None:
+            # Runs after the spills queued before it, then lets the workers left share the limit
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.remove_spill_directory)
+            self.executor.shutdown(wait=False)
+            self.executor = None
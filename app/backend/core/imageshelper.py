@@ -1,17 +1,36 @@
+import asyncio
 import base64
 from core.log import Logger
 import math
 import os
 import re
+import struct
+import time
+from dataclasses import dataclass
 from io import BytesIO
-from typing import Optional
+from typing import Any, Mapping, Optional, Sequence
 
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.storage.blob.aio import ContainerClient
+from cachetools import LRUCache
 from PIL import Image
 from typing_extensions import Literal, Required, TypedDict
 
 from approaches.approach import Document
+from core.imagecache import ImageCache
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# JPEG start of frame markers, which hold the dimensions (0xC4, 0xC8 and 0xCC are other segments)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Base64 characters decoded to look for the dimensions: enough for a PNG header, then for most JPEG headers
+IMAGE_HEADER_BASE64_SIZES = (44, 87384)
+
+# Dimensions of the page images downloaded recently, keyed by blob name
+image_dims_cache: LRUCache = LRUCache(maxsize=4096)
+
+# Most page images downloaded at once for a single request
+IMAGE_FETCH_CONCURRENCY = 8
 
 
 class ImageURL(TypedDict, total=False):
@@ -22,25 +41,72 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+@dataclass
+class FetchedImage:
+    sourcepage: str
+    image_url: Optional[ImageURL]
+    latency: float
+    # Looked up by blob name, as recorded at ingestion or read from the image when it was downloaded
+    dims: Optional[tuple[int, int]] = None
+
+    def serialize_for_thoughts(self) -> dict[str, Any]:
+        return {
+            "sourcepage": self.sourcepage,
+            "found": self.image_url is not None,
+            "latency_ms": round(self.latency * 1000, 1),
+            **({"width": self.dims[0], "height": self.dims[1]} if self.dims else {}),
+        }
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient, file_path: str, image_cache: Optional[ImageCache] = None
+) -> Optional[str]:
     logging = Logger()
     base_name, _ = os.path.splitext(file_path)
     image_filename = base_name + ".png"
+    cached = await image_cache.get(image_filename) if image_cache else None
+    if image_cache and cached and not image_cache.is_stale(cached):
+        image_cache.stats.hit()
+        return cached.data
     try:
-        blob = await blob_container_client.get_blob_client(image_filename).download_blob()
+        blob_client = blob_container_client.get_blob_client(image_filename)
+        if cached:
+            # Only download the image again if it changed since it was cached
+            blob = await blob_client.download_blob(etag=cached.etag, match_condition=MatchConditions.IfModified)
+        else:
+            blob = await blob_client.download_blob()
         if not blob.properties:
             logging.info(f"No blob exists for {image_filename}")
             return None
-        img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        image_bytes = await blob.readall()
+        if image_filename not in image_dims_cache:
+            dims = get_image_dims_from_metadata(blob.properties.metadata) or get_image_dims_from_bytes(image_bytes)
+            if dims:
+                image_dims_cache[image_filename] = dims
+        img = base64.b64encode(image_bytes).decode("utf-8")
+        data = f"data:image/png;base64,{img}"
+        if image_cache:
+            image_cache.stats.miss()
+            if blob.properties.etag:
+                image_cache.set(image_filename, blob.properties.etag, data)
+        return data
     except ResourceNotFoundError:
         logging.info(f"No blob exists for {image_filename}")
         return None
+    except HttpResponseError as error:
+        # Storage reports a 304 with the ConditionNotMet error code, so it is matched on status
+        if not (image_cache is not None and cached and error.status_code == 304):
+            raise
+        image_cache.revalidated(image_filename, cached)
+        image_cache.stats.hit()
+        return cached.data
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
+async def fetch_image(
+    blob_container_client: ContainerClient, result: Document, image_cache: Optional[ImageCache] = None
+) -> Optional[ImageURL]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache)
         if img:
             return {"url": img, "detail": "auto"}
         else:
@@ -48,22 +114,94 @@ async def fetch_image(blob_container_client: ContainerClient, result: Document)
     return None
 
 
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: Sequence[Document],
+    max_concurrency: int = IMAGE_FETCH_CONCURRENCY,
+    image_cache: Optional[ImageCache] = None,
+) -> list[FetchedImage]:
+    """
+    Downloads the page images of the search results concurrently, at most max_concurrency at a time.
+    Results sharing a source page get a single image, and the images keep the order of the results.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(result: Document) -> FetchedImage:
+        async with semaphore:
+            start = time.perf_counter()
+            image_url = await fetch_image(blob_container_client, result, image_cache)
+            latency = time.perf_counter() - start
+            base_name, _ = os.path.splitext(result.sourcepage or "")
+            dims = get_blob_image_dims(base_name + ".png") if image_url else None
+            return FetchedImage(result.sourcepage or "", image_url, latency, dims)
+
+    unique_results: dict[str, Document] = {}
+    for result in results:
+        if result.sourcepage and result.sourcepage not in unique_results:
+            unique_results[result.sourcepage] = result
+    return await asyncio.gather(*(fetch(result) for result in unique_results.values()))
+
+
+def get_blob_image_dims(blob_name: str) -> Optional[tuple[int, int]]:
+    return image_dims_cache.get(blob_name)
+
+
+def get_image_dims_from_metadata(metadata: Optional[Mapping[str, str]]) -> Optional[tuple[int, int]]:
+    # Recorded by BlobManager.upload_pdf_blob_images when the page images are ingested
+    if metadata and "width" in metadata and "height" in metadata:
+        return int(metadata["width"]), int(metadata["height"])
+    return None
+
+
+def get_image_dims_from_bytes(data: bytes) -> Optional[tuple[int, int]]:
+    """
+    Reads the dimensions of a PNG or JPEG image from its header, without decoding the image.
+    Returns None for other formats, or when the header is cut off.
+    """
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b"IHDR" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+    if data[:2] == b"\xff\xd8":
+        index = 2
+        while index + 9 <= len(data):
+            if data[index] != 0xFF:
+                return None
+            marker = data[index + 1]
+            if marker == 0xFF:
+                # Fill byte
+                index += 1
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # Markers without a length
+                index += 2
+            elif marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[index + 5 : index + 9])
+                return width, height
+            else:
+                index += 2 + struct.unpack(">H", data[index + 2 : index + 4])[0]
+    return None
+
+
 def get_image_dims(image_uri: str) -> tuple[int, int]:
     # From https://github.com/openai/openai-cookbook/pull/881/files
-    if re.match(r"data:image\/\w+;base64", image_uri):
-        image_uri = re.sub(r"data:image\/\w+;base64,", "", image_uri)
-        image = Image.open(BytesIO(base64.b64decode(image_uri)))
+    if match := re.match(r"data:image\/\w+;base64,", image_uri):
+        encoded = image_uri[match.end() :]
+        # Only decode the header, growing it for JPEGs with large metadata segments
+        for size in IMAGE_HEADER_BASE64_SIZES:
+            dims = get_image_dims_from_bytes(base64.b64decode(encoded[: size - size % 4]))
+            if dims or size >= len(encoded):
+                break
+        if dims:
+            return dims
+        image = Image.open(BytesIO(base64.b64decode(encoded)))
         return image.size
     else:
         raise ValueError("Image must be a base64 string.")
 
 
-def calculate_image_token_cost(image_uri: str, detail: str = "auto") -> int:
+def calculate_image_token_cost(image_uri: str, detail: str = "auto", dims: Optional[tuple[int, int]] = None) -> int:
     # From https://github.com/openai/openai-cookbook/pull/881/files
     # Based on https://platform.openai.com/docs/guides/vision
     LOW_DETAIL_COST = 85
-    HIGH_DETAIL_COST_PER_TILE = 170
-    ADDITIONAL_COST = 85
 
     if detail == "auto":
         # assume high detail for now
@@ -73,24 +211,31 @@ def calculate_image_token_cost(image_uri: str, detail: str = "auto") -> int:
         # Low detail images have a fixed cost
         return LOW_DETAIL_COST
     elif detail == "high":
-        # Calculate token cost for high detail images
-        width, height = get_image_dims(image_uri)
-        # Check if resizing is needed to fit within a 2048 x 2048 square
-        if max(width, height) > 2048:
-            # Resize dimensions to fit within a 2048 x 2048 square
-            ratio = 2048 / max(width, height)
-            width = int(width * ratio)
-            height = int(height * ratio)
-        # Further scale down to 768px on the shortest side
-        if min(width, height) > 768:
-            ratio = 768 / min(width, height)
-            width = int(width * ratio)
-            height = int(height * ratio)
-        # Calculate the number of 512px squares
-        num_squares = math.ceil(width / 512) * math.ceil(height / 512)
-        # Calculate the total token cost
-        total_cost = num_squares * HIGH_DETAIL_COST_PER_TILE + ADDITIONAL_COST
-        return total_cost
+        # Calculate token cost for high detail images, only reading the dimensions from the image when not known
+        width, height = dims or get_image_dims(image_uri)
+        return calculate_high_detail_token_cost(width, height)
     else:
         # Invalid detail_option
         raise ValueError("Invalid value for detail parameter. Use 'low' or 'high'.")
+
+
+def calculate_high_detail_token_cost(width: int, height: int) -> int:
+    HIGH_DETAIL_COST_PER_TILE = 170
+    ADDITIONAL_COST = 85
+
+    # Check if resizing is needed to fit within a 2048 x 2048 square
+    if max(width, height) > 2048:
+        # Resize dimensions to fit within a 2048 x 2048 square
+        ratio = 2048 / max(width, height)
+        width = int(width * ratio)
+        height = int(height * ratio)
+    # Further scale down to 768px on the shortest side
+    if min(width, height) > 768:
+        ratio = 768 / min(width, height)
+        width = int(width * ratio)
+        height = int(height * ratio)
+    # Calculate the number of 512px squares
+    num_squares = math.ceil(width / 512) * math.ceil(height / 512)
+    # Calculate the total token cost
+    total_cost = num_squares * HIGH_DETAIL_COST_PER_TILE + ADDITIONAL_COST
+    return total_cost
@@ -0,0 +1,116 @@
+import time
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+import aiohttp
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+
+from core.httpsession import HttpSessionManager
+from core.log import Logger
+from core.singleflight import SingleFlight
+
+
+class JwksError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+    def __str__(self) -> str:
+        return str(self.error or "")
+
+
+class JwksCache:
+    """
+    Caches the JSON Web Key Set used to validate access tokens, for as long as its Cache-Control max-age allows
+    (at least min_max_age seconds, default_max_age without the header).
+    Expired keys are still served while they are refreshed in the background. A token signed with an unknown key
+    forces a refresh, as the keys may have been rotated, but at most once every min_refetch_interval seconds.
+    Concurrent refreshes are coalesced into a single request.
+    """
+
+    def __init__(
+        self,
+        key_url: str,
+        default_max_age: float = 3600,
+        min_max_age: float = 300,
+        min_refetch_interval: float = 60,
+        timer: Callable[[], float] = time.monotonic,
+        http_session: Optional[HttpSessionManager] = None,
+    ):
+        self.logging = Logger()
+        self.key_url = key_url
+        self.default_max_age = default_max_age
+        self.min_max_age = min_max_age
+        self.min_refetch_interval = min_refetch_interval
+        self.timer = timer
+        self.http_session = http_session
+        self.keys: Dict[str, Dict[str, Any]] = {}
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self.refreshes = SingleFlight()
+
+    def get_max_age(self, headers: Mapping[str, str]) -> float:
+        cache_control = parse_cache_control_header(headers.get("Cache-Control", ""), None, ResponseCacheControl)
+        max_age = cache_control.max_age
+        if max_age is None:
+            return self.default_max_age
+        return max(max_age, self.min_max_age)
+
+    async def download(self) -> Tuple[Dict[str, Any], float]:
+        if self.http_session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.download_with(session)
+        return await self.download_with(self.http_session.get_session())
+
+    async def download_with(self, session: aiohttp.ClientSession) -> Tuple[Dict[str, Any], float]:
+        async with session.get(url=self.key_url) as resp:
+            if resp.status in [500, 502, 503, 504]:
+                raise JwksError(error=f"Failed to get keys info: {await resp.text()}", status_code=resp.status)
+            return await resp.json(), self.get_max_age(resp.headers)
+
+    async def fetch(self):
+        jwks = None
+        max_age = self.default_max_age
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(JwksError),
+            wait=wait_random_exponential(multiplier=0.5, max=5),
+            stop=stop_after_attempt(3),
+            reraise=True,
+        ):
+            with attempt:
+                jwks, max_age = await self.download()
+
+        if not jwks or "keys" not in jwks:
+            raise JwksError({"code": "invalid_keys", "description": "Unable to get keys to validate auth token."}, 401)
+        self.keys = {key["kid"]: key for key in jwks["keys"] if "kid" in key}
+        self.fetched_at = self.timer()
+        self.expires_at = self.fetched_at + max_age
+
+    async def fetch_in_background(self):
+        try:
+            await self.fetch()
+        except Exception:
+            # Nobody awaits a background refresh: the last good keys keep being served until one succeeds
+            self.logging.exception(f"Error refreshing the keys from {self.key_url}")
+
+    async def refresh(self):
+        await self.refreshes.do(self.key_url, self.fetch)
+
+    async def get_key(self, kid: str) -> Optional[Dict[str, Any]]:
+        if not self.keys:
+            await self.refresh()
+        elif self.timer() >= self.expires_at:
+            # Keep validating with the current keys while they are refreshed
+            self.refreshes.start(self.key_url, self.fetch_in_background)
+        key = self.keys.get(kid)
+        if key is None and self.timer() - self.fetched_at >= self.min_refetch_interval:
+            self.logging.info(f"Key {kid} not found, refreshing the keys")
+            await self.refresh()
+            key = self.keys.get(kid)
+        return key
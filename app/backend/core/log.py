@@ -12,4 +12,7 @@ class Logger:
         self.logger.error(message)
 
     def warning(self, message):
-        self.logger.warning(message)
\ No newline at end of file
+        self.logger.warning(message)
+
+    def exception(self, message):
+        self.logger.exception(message)
\ No newline at end of file
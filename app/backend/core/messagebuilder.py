@@ -1,6 +1,7 @@
 import unicodedata
+from bisect import bisect_right
 from collections.abc import Mapping
-from typing import List, Union
+from typing import List, Optional, Sequence, Union, cast
 
 from openai.types.chat import (
     ChatCompletionAssistantMessageParam,
@@ -40,6 +41,14 @@ class MessageBuilder:
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
             index (int): The index at which to insert the message.
         """
+        self.messages.insert(index, self.create_message(role, content))
+
+    def append_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]):
+        self.messages.append(self.create_message(role, content))
+
+    def create_message(
+        self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]
+    ) -> ChatCompletionMessageParam:
         message: ChatCompletionMessageParam
         if role == "user":
             message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
@@ -51,10 +60,12 @@ class MessageBuilder:
             )
         else:
             raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
+        return message
 
-    def count_tokens_for_message(self, message: Mapping[str, object]):
-        return num_tokens_from_messages(message, self.model)
+    def count_tokens_for_message(
+        self, message: Mapping[str, object], image_dims: Sequence[Optional[tuple[int, int]]] = ()
+    ) -> int:
+        return num_tokens_from_messages(message, self.model, image_dims)
 
     def normalize_content(self, content: Union[str, List[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
@@ -64,3 +75,40 @@ class MessageBuilder:
                 if "image_url" not in part:
                     part["text"] = unicodedata.normalize("NFC", part["text"])
             return content
+
+
+class HistoryPacker:
+    """
+    Packs as much of the conversation history as fits in a token budget, keeping the newest messages.
+    Messages are normalized and counted once, newest first and only as far back as a budget requires,
+    so the prompts built for the same request (search query and answer) share the work.
+    Attributes:
+        history (list): The earlier messages of the conversation, oldest first, without the question being asked.
+        model (str): The name of the ChatGPT model the tokens are counted for.
+        messages (list): The normalized messages counted so far, newest first.
+        suffix_tokens (list): suffix_tokens[k] is the number of tokens of the k newest messages.
+    """
+
+    def __init__(self, history: Sequence[Mapping[str, object]], chatgpt_model: str):
+        self.history = history
+        self.model = chatgpt_model
+        self.builder = MessageBuilder("", chatgpt_model)
+        self.messages: list[ChatCompletionMessageParam] = []
+        self.suffix_tokens: list[int] = [0]
+
+    def count_until(self, max_tokens: int) -> None:
+        while self.suffix_tokens[-1] <= max_tokens and len(self.messages) < len(self.history):
+            entry = self.history[-1 - len(self.messages)]
+            message = self.builder.create_message(
+                cast(str, entry["role"]), cast(Union[str, List[ChatCompletionContentPartParam]], entry["content"])
+            )
+            self.messages.append(message)
+            self.suffix_tokens.append(self.suffix_tokens[-1] + self.builder.count_tokens_for_message(message))
+
+    def pack(self, max_tokens: int) -> list[ChatCompletionMessageParam]:
+        """
+        Returns the newest messages that fit in max_tokens, oldest first.
+        """
+        self.count_until(max_tokens)
+        count = bisect_right(self.suffix_tokens, max_tokens) - 1
+        return self.messages[count - 1 :: -1] if count > 0 else []
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
-from collections.abc import Mapping
+import hashlib
+import json
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
 
 import tiktoken
+from cachetools import LRUCache
 
 from .imageshelper import calculate_image_token_cost
 
@@ -19,6 +23,10 @@ MODELS_2_TOKEN_LIMITS = {
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
+# Token counts of the messages seen recently, keyed by model and a hash of the message
+TOKEN_COUNT_CACHE_SIZE = 10000
+token_count_cache: LRUCache = LRUCache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -26,12 +34,15 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
-def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
+def num_tokens_from_messages(
+    message: Mapping[str, object], model: str, image_dims: Sequence[tuple[int, int] | None] = ()
+) -> int:
     """
     Calculate the number of tokens required to encode a message.
     Args:
         message (Mapping): The message to encode, in a dictionary-like object.
         model (str): The name of the model to use for encoding.
+        image_dims (Sequence): The dimensions of the images of the message in order, when already known.
     Returns:
         int: The total number of tokens required to encode the message.
     Example:
@@ -41,8 +52,31 @@ def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    key = get_message_key(message, model)
+    num_tokens = token_count_cache.get(key)
+    if num_tokens is None:
+        num_tokens = count_tokens_for_message(message, model, image_dims)
+        token_count_cache[key] = num_tokens
+    return num_tokens
+
+
+def get_message_key(message: Mapping[str, object], model: str) -> str:
+    payload = json.dumps([model, message], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Loads the encoding of a model once per process"""
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def count_tokens_for_message(
+    message: Mapping[str, object], model: str, image_dims: Sequence[tuple[int, int] | None] = ()
+) -> int:
+    encoding = get_encoding(model)
     num_tokens = 2  # For "role" and "content" keys
+    image_index = 0
     for value in message.values():
         if isinstance(value, list):
             # For GPT-4-vision support, based on https://github.com/openai/openai-cookbook/pull/881/files
@@ -51,7 +85,11 @@ def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
                 if item["type"] == "text":
                     num_tokens += len(encoding.encode(item["text"]))
                 elif item["type"] == "image_url":
-                    num_tokens += calculate_image_token_cost(item["image_url"]["url"], item["image_url"]["detail"])
+                    dims = image_dims[image_index] if image_index < len(image_dims) else None
+                    image_index += 1
+                    num_tokens += calculate_image_token_cost(
+                        item["image_url"]["url"], item["image_url"]["detail"], dims
+                    )
         elif isinstance(value, str):
             num_tokens += len(encoding.encode(value))
         else:
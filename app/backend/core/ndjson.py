@@ -0,0 +1,126 @@
+import asyncio
+import dataclasses
+import json
+from typing import Any, AsyncGenerator, AsyncIterator, Hashable, List, Optional
+
+from cachetools import LRUCache
+
+# Stands in for the content of a token delta when its event is serialized as a template
+CONTENT_PLACEHOLDER = "\x00ndjson-content\x00"
+SERIALIZED_PLACEHOLDER = json.dumps(CONTENT_PLACEHOLDER)
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def json_default(o: Any) -> Any:
+    # Only the fields of the dataclass itself are copied, the values are serialized in place
+    # rather than deep copied by dataclasses.asdict
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class NdjsonEncoder:
+    """
+    Serializes the events of a chat stream as lines of NDJSON, identical to
+    json.dumps(event, ensure_ascii=False) with dataclasses serialized as dicts.
+    Token deltas, events with a single choice whose delta has a string content and otherwise only scalar
+    values, are the bulk of a stream. Their serialization is cached as a template per shape, so that only
+    the content is serialized for each of them. Other events, such as the one carrying the context,
+    are serialized once without copying their ThoughtSteps.
+    """
+
+    def __init__(self, max_templates: int = 64):
+        self.templates: LRUCache = LRUCache(maxsize=max_templates)
+
+    @staticmethod
+    def get_delta_shape(event: dict[str, Any]) -> Optional[Hashable]:
+        choices = event.get("choices")
+        if not isinstance(choices, list) or len(choices) != 1 or not isinstance(choices[0], dict):
+            return None
+        choice = choices[0]
+        delta = choice.get("delta")
+        if not isinstance(delta, dict) or not isinstance(delta.get("content"), str):
+            return None
+        shape: List[Any] = []
+        for items, templated_key in ((event, "choices"), (choice, "delta"), (delta, "content")):
+            for key, value in items.items():
+                if key == templated_key:
+                    shape.append(key)
+                elif isinstance(value, SCALAR_TYPES):
+                    # The type tells apart the values that compare equal, such as True, 1 and 1.0
+                    shape.append((key, type(value), value))
+                else:
+                    return None
+            shape.append(None)
+        return tuple(shape)
+
+    def get_template(self, shape: Hashable, event: dict[str, Any]) -> Optional[tuple[str, str]]:
+        template = self.templates.get(shape)
+        if template is None:
+            choice = event["choices"][0]
+            serialized = json.dumps(
+                {**event, "choices": [{**choice, "delta": {**choice["delta"], "content": CONTENT_PLACEHOLDER}}]},
+                ensure_ascii=False,
+            )
+            if serialized.count(SERIALIZED_PLACEHOLDER) != 1:
+                return None
+            prefix, suffix = serialized.split(SERIALIZED_PLACEHOLDER)
+            template = (prefix, suffix + "\n")
+            self.templates[shape] = template
+        return template
+
+    def encode(self, event: dict[str, Any]) -> str:
+        shape = self.get_delta_shape(event)
+        template = self.get_template(shape, event) if shape is not None else None
+        if template is not None:
+            content = event["choices"][0]["delta"]["content"]
+            return template[0] + json.dumps(content, ensure_ascii=False) + template[1]
+        return json.dumps(event, ensure_ascii=False, default=json_default) + "\n"
+
+
+async def coalesce(
+    lines: AsyncIterator[str], max_latency: float, max_size: int = 64 * 1024
+) -> AsyncGenerator[str, None]:
+    """
+    Joins the lines that arrive within max_latency seconds of the first one into a single write,
+    sooner once they reach max_size characters. With a max_latency of 0 every line is written as it arrives.
+    """
+    if max_latency <= 0:
+        async for line in lines:
+            yield line
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = lines.__aiter__()
+    buffer: List[str] = []
+    buffer_size = 0
+    flush_at = 0.0
+    next_line: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_line is None:
+                next_line = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(flush_at - loop.time(), 0) if buffer else None
+            done, _ = await asyncio.wait({next_line}, timeout=timeout)
+            if not done:
+                # The next line is still awaited, the buffered ones have waited long enough
+                yield "".join(buffer)
+                buffer, buffer_size = [], 0
+                continue
+            finished, next_line = next_line, None
+            try:
+                line = finished.result()
+            except StopAsyncIteration:
+                break
+            if not buffer:
+                flush_at = loop.time() + max_latency
+            buffer.append(line)
+            buffer_size += len(line)
+            if buffer_size >= max_size:
+                yield "".join(buffer)
+                buffer, buffer_size = [], 0
+    finally:
+        if next_line is not None:
+            next_line.cancel()
+    if buffer:
+        yield "".join(buffer)
@@ -0,0 +1,57 @@
+import hashlib
+import json
+from typing import Any, Hashable, Optional
+
+from cachetools import TLRUCache
+
+from core.answercache import INDEX_GENERATION_KEY
+from core.cachestats import CacheStats
+from core.sharedcache import SharedCache
+
+
+class PathAuthCache:
+    """
+    Short-lived cache of the decisions of AuthenticationHelper.check_path_auth, keyed by
+    (oid, hash of the groups, path, index generation). Denials are cached too, for a shorter time.
+    Bumping the index generation in the shared cache (on upload, delete or /clearcache)
+    invalidates the decisions of every worker, as the documents they were based on changed.
+    """
+
+    def __init__(self, shared_cache: SharedCache, maxsize: int = 10000, ttl: float = 60, negative_ttl: float = 10):
+        self.shared_cache = shared_cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.decisions: TLRUCache = TLRUCache(maxsize=maxsize, ttu=self.get_expiry)
+        self.stats = CacheStats()
+
+    def get_expiry(self, key: Hashable, allowed: bool, now: float) -> float:
+        return now + (self.ttl if allowed else self.negative_ttl)
+
+    @staticmethod
+    def normalize_path(path: str) -> str:
+        # The fragment is removed before checking, so filename.pdf#page=2 is the same file as filename.pdf
+        fragment_index = path.find("#")
+        return path[:fragment_index] if fragment_index != -1 else path
+
+    def make_key(self, auth_claims: dict[str, Any], path: str) -> Hashable:
+        groups = json.dumps(sorted(auth_claims.get("groups", [])))
+        return (
+            auth_claims.get("oid", ""),
+            hashlib.sha256(groups.encode("utf-8")).hexdigest(),
+            self.normalize_path(path),
+            self.shared_cache.version(INDEX_GENERATION_KEY),
+        )
+
+    def get(self, key: Hashable) -> Optional[bool]:
+        allowed = self.decisions.get(key)
+        if allowed is None:
+            self.stats.miss()
+        else:
+            self.stats.hit()
+        return allowed
+
+    def set(self, key: Hashable, allowed: bool):
+        self.decisions[key] = allowed
+
+    def clear(self):
+        self.decisions.clear()
@@ -0,0 +1,48 @@
+import hashlib
+import json
+from typing import Any, Optional, Sequence
+
+from cachetools import TTLCache
+
+from core.cachestats import CacheStats
+
+
+class QueryRewriteCache:
+    """
+    LRU cache, with a TTL, of the search queries generated from a conversation.
+    The key covers everything the query generation call depends on: the theme, the model,
+    the query prompt template and the (token-budgeted) messages sent to the model.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600):
+        self.queries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stats = CacheStats()
+
+    @staticmethod
+    def normalize_template(template: str) -> str:
+        return " ".join(template.split())
+
+    def make_key(self, theme_id: str, model: str, query_prompt_template: str, messages: Sequence[Any]) -> str:
+        # The system message repeats the template verbatim, so only the other messages are hashed with it
+        conversation = [message for message in messages if message.get("role") != "system"]
+        payload = json.dumps(
+            [theme_id, model, self.normalize_template(query_prompt_template), conversation],
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        query_text = self.queries.get(key)
+        if query_text is None:
+            self.stats.miss()
+        else:
+            self.stats.hit()
+        return query_text
+
+    def set(self, key: str, query_text: str):
+        self.queries[key] = query_text
+
+    def clear(self):
+        self.queries.clear()
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+
+@dataclass
+class QueryRewriteDecision:
+    rewrite: bool
+    reason: str
+
+
+@dataclass
+class QueryRewriteStats:
+    """
+    Counts of the search queries rewritten by the model and of those searched as asked,
+    exposed by the /cachestats route
+    """
+
+    rewritten: int = 0
+    skipped: int = 0
+
+    def count(self, decision: QueryRewriteDecision):
+        if decision.rewrite:
+            self.rewritten += 1
+        else:
+            self.skipped += 1
+
+    def to_dict(self) -> dict[str, int]:
+        return {"rewritten": self.rewritten, "skipped": self.skipped}
+
+
+class QueryRewritePolicy:
+    """
+    Decides per request whether the search query has to be generated by the model,
+    or whether the question can be searched as asked. Configured per theme in assistantConfig.queryRewritePolicy:
+    - enabled: whether the rewrite may be skipped at all (default false)
+    - maxHistoryLength: most messages in the history, including the question (default 1, a first question)
+    - maxQuestionLength: longest question in characters (default 200)
+    - languages: theme languages whose questions can be searched as asked (default ["en-us"]),
+      as the query prompt translates other languages to English
+    """
+
+    def __init__(
+        self,
+        language: str,
+        max_history_length: int = 1,
+        max_question_length: int = 200,
+        languages: Sequence[str] = ("en-us",),
+        stats: Optional[QueryRewriteStats] = None,
+    ):
+        self.language = language.lower()
+        self.max_history_length = max_history_length
+        self.max_question_length = max_question_length
+        self.languages = {language.lower() for language in languages}
+        self.stats = stats or QueryRewriteStats()
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[dict[str, Any]], language: str, stats: Optional[QueryRewriteStats] = None
+    ) -> Optional["QueryRewritePolicy"]:
+        if not config or not config.get("enabled"):
+            return None
+        return cls(
+            language=language,
+            max_history_length=config.get("maxHistoryLength", 1),
+            max_question_length=config.get("maxQuestionLength", 200),
+            languages=config.get("languages", ("en-us",)),
+            stats=stats,
+        )
+
+    def decide(self, history: Sequence[dict[str, Any]]) -> QueryRewriteDecision:
+        question = history[-1].get("content")
+        if len(history) > self.max_history_length:
+            return QueryRewriteDecision(True, f"history has more than {self.max_history_length} messages")
+        if not isinstance(question, str):
+            return QueryRewriteDecision(True, "question has non-text content")
+        if len(question) > self.max_question_length:
+            return QueryRewriteDecision(True, f"question is longer than {self.max_question_length} characters")
+        if self.language not in self.languages:
+            return QueryRewriteDecision(True, f"theme language {self.language} is translated by the rewrite")
+        return QueryRewriteDecision(False, "short first question, searched as asked")
+
+    def evaluate(self, history: Sequence[dict[str, Any]]) -> QueryRewriteDecision:
+        decision = self.decide(history)
+        self.stats.count(decision)
+        return decision
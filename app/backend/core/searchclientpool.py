@@ -0,0 +1,92 @@
+import asyncio
+from typing import Iterable, Union
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.search.documents.aio import SearchClient
+
+from core.log import Logger
+from core.singleflight import SingleFlight
+
+
+class SearchClientPool:
+    """
+    Keeps one long-lived SearchClient per search index, so that every theme reuses the same
+    connection pool instead of opening a new client (and TLS handshake) on each chat request.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        credential: Union[AsyncTokenCredential, AzureKeyCredential],
+        retire_after: float = 60,
+    ):
+        self.logging = Logger()
+        self.endpoint = endpoint
+        self.credential = credential
+        self.clients: dict[str, SearchClient] = {}
+        self.warmups = SingleFlight()
+        # Clients for indexes that are no longer referenced by any theme. They are closed once retire_after seconds
+        # have passed, so requests that were already using them can finish.
+        self.retire_after = retire_after
+        self.retired: list[SearchClient] = []
+        self.retirements: set[asyncio.Future] = set()
+
+    def get(self, index_name: str) -> SearchClient:
+        client = self.clients.get(index_name)
+        if client is None:
+            client = SearchClient(endpoint=self.endpoint, index_name=index_name, credential=self.credential)
+            self.clients[index_name] = client
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # No event loop to warm on, the first search opens the connection instead
+                return client
+            # Open the connection in the background, while the caller builds its prompt
+            self.warmups.start(index_name, lambda: self.warm_client(index_name, client))
+        return client
+
+    async def warm(self, index_name: str):
+        # Open the connection ahead of the first user request
+        client = self.get(index_name)
+        await self.warmups.do(index_name, lambda: self.warm_client(index_name, client))
+
+    async def warm_client(self, index_name: str, client: SearchClient):
+        try:
+            await client.get_document_count()
+        except Exception as e:
+            self.logging.warning(f"Unable to warm search client for index {index_name}: {str(e)}")
+
+    async def refresh(self, index_names: Iterable[str]):
+        wanted = {index_name for index_name in index_names if index_name}
+        retired = [self.clients.pop(index_name) for index_name in list(self.clients) if index_name not in wanted]
+        if retired:
+            self.retire(retired)
+        new_index_names = [index_name for index_name in wanted if index_name not in self.clients]
+        await asyncio.gather(*(self.warm(index_name) for index_name in new_index_names))
+        if new_index_names or retired:
+            self.logging.info(f"Search client pool refreshed: {len(new_index_names)} added, {len(retired)} retired")
+
+    def retire(self, clients: list[SearchClient]):
+        self.retired.extend(clients)
+        retirement = asyncio.ensure_future(self.close_retired(clients))
+        self.retirements.add(retirement)
+        retirement.add_done_callback(self.retirements.discard)
+
+    async def close_retired(self, clients: list[SearchClient]):
+        await asyncio.sleep(self.retire_after)
+        for client in clients:
+            self.retired.remove(client)
+            try:
+                await client.close()
+            except Exception as e:
+                self.logging.warning(f"Unable to close retired search client: {str(e)}")
+
+    async def close(self):
+        for retirement in list(self.retirements):
+            retirement.cancel()
+        for client in [*self.clients.values(), *self.retired]:
+            await client.close()
+        self.clients = {}
+        self.retired = []
+        self.retirements = set()
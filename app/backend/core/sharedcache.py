@@ -0,0 +1,180 @@
+import json
+import mmap
+import os
+import struct
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no fcntl, and runs a single worker locally
+    fcntl = None  # type: ignore[assignment]
+
+COUNTER_FORMAT = "<Q"
+COUNTER_SIZE = struct.calcsize(COUNTER_FORMAT)
+
+
+@dataclass
+class SharedCacheEntry:
+    version: int
+    value: Any
+    stored_at: float
+
+
+class SharedCache(ABC):
+    """
+    A cache shared by all the workers of the app. Every key has a monotonically increasing version,
+    bumped by each write and invalidation, so workers can cheaply check whether their local copy is current.
+    """
+
+    @abstractmethod
+    def version(self, key: str) -> int:
+        pass
+
+    @abstractmethod
+    def read(self, key: str, max_age: Optional[float] = None) -> Optional[SharedCacheEntry]:
+        pass
+
+    @abstractmethod
+    def write(self, key: str, value: Any, if_version: Optional[int] = None) -> Optional[int]:
+        """
+        Stores the value under a new version and returns that version.
+        If if_version is given and the key has changed since, nothing is written and None is returned.
+        Raises ValueError if the value isn't plain JSON.
+        """
+
+    @abstractmethod
+    def invalidate(self, key: str) -> int:
+        pass
+
+    def encode(self, key: str, entry: dict[str, Any]) -> str:
+        # Values must already be plain JSON (e.g. a DTO's to_dict()): anything else is a bug in the caller,
+        # and stringifying it would hand the other workers a different value than the writer published
+        try:
+            return json.dumps(entry, allow_nan=False)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Unable to store {key} in the shared cache: {str(e)}") from e
+
+
+class InMemorySharedCache(SharedCache):
+    """
+    Stand-in for a single process, e.g. for local development and tests
+    """
+
+    def __init__(self):
+        self.versions: dict[str, int] = {}
+        self.entries: dict[str, SharedCacheEntry] = {}
+
+    def version(self, key: str) -> int:
+        return self.versions.get(key, 0)
+
+    def read(self, key: str, max_age: Optional[float] = None) -> Optional[SharedCacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None or (max_age is not None and time.time() - entry.stored_at > max_age):
+            return None
+        return entry
+
+    def write(self, key: str, value: Any, if_version: Optional[int] = None) -> Optional[int]:
+        if if_version is not None and self.version(key) != if_version:
+            return None
+        # Round-trip through JSON, so values behave as they do when shared between processes
+        value = json.loads(self.encode(key, {"value": value}))["value"]
+        version = self.version(key) + 1
+        self.versions[key] = version
+        self.entries[key] = SharedCacheEntry(version=version, value=value, stored_at=time.time())
+        return version
+
+    def invalidate(self, key: str) -> int:
+        version = self.version(key) + 1
+        self.versions[key] = version
+        self.entries.pop(key, None)
+        return version
+
+
+class FileSharedCache(SharedCache):
+    """
+    Shares values between the worker processes of one host through files in a local directory.
+    Each key's version lives in a small memory-mapped counter file, so checking it costs no system call.
+    Values are written as JSON to a temporary file and atomically moved into place.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.counters: dict[str, mmap.mmap] = {}
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{key}.{suffix}")
+
+    def counter(self, key: str) -> mmap.mmap:
+        counter = self.counters.get(key)
+        if counter is None:
+            fd = os.open(self.path(key, "version"), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < COUNTER_SIZE:
+                    os.ftruncate(fd, COUNTER_SIZE)
+                counter = mmap.mmap(fd, COUNTER_SIZE)
+            finally:
+                os.close(fd)
+            self.counters[key] = counter
+        return counter
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        with open(self.path(key, "lock"), "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def version(self, key: str) -> int:
+        return struct.unpack_from(COUNTER_FORMAT, self.counter(key), 0)[0]
+
+    def set_version(self, key: str, version: int):
+        struct.pack_into(COUNTER_FORMAT, self.counter(key), 0, version)
+
+    def read(self, key: str, max_age: Optional[float] = None) -> Optional[SharedCacheEntry]:
+        version = self.version(key)
+        try:
+            with open(self.path(key, "json"), encoding="utf-8") as value_file:
+                data = json.load(value_file)
+        except (OSError, ValueError):
+            return None
+        # A value older than the counter has been invalidated (or is being replaced right now)
+        if data["version"] != version:
+            return None
+        if max_age is not None and time.time() - data["stored_at"] > max_age:
+            return None
+        return SharedCacheEntry(version=data["version"], value=data["value"], stored_at=data["stored_at"])
+
+    def write(self, key: str, value: Any, if_version: Optional[int] = None) -> Optional[int]:
+        with self.lock(key):
+            version = self.version(key)
+            if if_version is not None and version != if_version:
+                return None
+            version += 1
+            data = self.encode(key, {"version": version, "stored_at": time.time(), "value": value})
+            path = self.path(key, "json")
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as value_file:
+                value_file.write(data)
+            os.replace(temp_path, path)
+            # Publish the new version only once its value is in place
+            self.set_version(key, version)
+            return version
+
+    def invalidate(self, key: str) -> int:
+        with self.lock(key):
+            version = self.version(key) + 1
+            self.set_version(key, version)
+            try:
+                os.remove(self.path(key, "json"))
+            except FileNotFoundError:
+                pass
+            return version
@@ -0,0 +1,27 @@
+from typing import Any, Dict, List, Optional
+
+
+class ThemeRegistry:
+    """
+    In-memory index of the loaded themes, keyed by themeId, so a request can look up its theme in O(1).
+    """
+
+    def __init__(self):
+        self.themes: List[Dict[str, Any]] = []
+        self.themes_by_id: Dict[str, Dict[str, Any]] = {}
+        # Shared cache version the themes were loaded at, see core.sharedcache
+        self.version = 0
+
+    def replace(self, themes: List[Dict[str, Any]], version: int = 0):
+        # Build the new index before swapping it in, so readers always see a complete set of themes
+        themes_by_id = {theme["themeId"]: theme for theme in themes}
+        self.themes, self.themes_by_id, self.version = themes, themes_by_id, version
+
+    def get(self, theme_id: str) -> Optional[Dict[str, Any]]:
+        return self.themes_by_id.get(theme_id)
+
+    def all(self) -> List[Dict[str, Any]]:
+        return self.themes
+
+    def clear(self):
+        self.replace([])
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from uuid import UUID
 from typing import Dict, Any
-from core.theme.domain.theme import SubTheme
+from core.theme.domain.theme import SubTheme, Theme
 from core.theme.domain.theme_repository import ThemeRepository
 from core.log import Logger
 
@@ -39,25 +39,39 @@ class ListTheme:
     class Output:
         data: list[ThemeOutput]
 
+        def to_dict(self) -> list[Dict[str, Any]]:
+            return [theme.to_dict() for theme in self.data]
+
     def execute(self) -> Output:
         self.logging.info("Starting to execute ListTheme use case")
 
         try:
-            themes = self.repository.list()
-            data = [
-                ThemeOutput(
-                    themeId=theme.themeId,
-                    themeName=theme.themeName,
-                    language=theme.language,
-                    active=theme.active,
-                    subthemes=list(theme.subThemes),
-                    assistantConfig=theme.assistantConfig
-
-                )
-                for theme in themes
-            ]
-            self.logging.info(f"Successfully listed {len(data)} themes")
-            return self.Output(data=data)
+            return self.to_output(self.repository.list())
         except Exception as e:
-            self.logging.error("Failed to list themes", exc_info=True)
+            self.logging.exception("Failed to list themes")
             raise RuntimeError("An error occurred while listing themes") from e
+
+    async def execute_async(self) -> Output:
+        self.logging.info("Starting to execute ListTheme use case")
+
+        try:
+            return self.to_output(await self.repository.list_async())
+        except Exception as e:
+            self.logging.exception("Failed to list themes")
+            raise RuntimeError("An error occurred while listing themes") from e
+
+    def to_output(self, themes: list[Theme]) -> Output:
+        data = [
+            ThemeOutput(
+                themeId=theme.themeId,
+                themeName=theme.themeName,
+                language=theme.language,
+                active=theme.active,
+                subthemes=list(theme.subThemes),
+                assistantConfig=theme.assistantConfig
+
+            )
+            for theme in themes
+        ]
+        self.logging.info(f"Successfully listed {len(data)} themes")
+        return self.Output(data=data)
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import List
 from uuid import UUID
 
 from core.theme.domain.theme import Theme
@@ -8,3 +9,7 @@ class ThemeRepository(ABC):
     @abstractmethod
     def list(self) -> list[Theme]:
         raise NotImplementedError
+
+    @abstractmethod
+    async def list_async(self) -> List[Theme]:
+        raise NotImplementedError
@@ -4,7 +4,7 @@ from typing import Any, Callable, Dict
 
 from quart import abort, current_app, request
 
-from config import CONFIG_AUTH_CLIENT, CONFIG_SEARCH_CLIENT
+from config import CONFIG_AUTH_CLIENT, CONFIG_SEARCH_CLIENT, CONFIG_SEARCH_CLIENT_POOL
 from core.authentication import AuthError
 from error import error_response
 
@@ -20,10 +20,15 @@ def authenticated_path(route_fn: Callable[[str, Dict[str, Any]], Any]):
         # If authentication is enabled, validate the user can access the file
         auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
         search_client = current_app.config[CONFIG_SEARCH_CLIENT]
+        # Citations of a theme come from the theme's own index, so the indexes of the themes are checked too
+        search_client_pool = current_app.config.get(CONFIG_SEARCH_CLIENT_POOL)
+        theme_search_clients = list(search_client_pool.clients.values()) if search_client_pool else []
+        # /content names the file in its query string rather than in its path
+        path = path or request.args.get("file", default="", type=str)
         authorized = False
         try:
             auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
-            authorized = await auth_helper.check_path_auth(path, auth_claims, search_client)
+            authorized = await auth_helper.check_path_auth(path, auth_claims, search_client, theme_search_clients)
         except AuthError:
             abort(403)
         except Exception as error:
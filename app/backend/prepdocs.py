@@ -8,6 +8,7 @@ from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 
+from core.httpsession import HttpSessionManager
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
@@ -205,7 +206,10 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    http_session: Optional[HttpSessionManager] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -214,6 +218,7 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            http_session=http_session,
         )
     return image_embeddings_service
 
@@ -410,6 +415,8 @@ if __name__ == "__main__":
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    # Shared by the calls to AI Vision, so that the files reuse its connections
+    http_session = HttpSessionManager()
 
     search_info = loop.run_until_complete(
         setup_search_info(
@@ -475,7 +482,10 @@ if __name__ == "__main__":
             search_images=args.searchimages,
         )
         image_embeddings_service = setup_image_embeddings_service(
-            azure_credential=azd_credential, vision_endpoint=args.visionendpoint, search_images=args.searchimages
+            azure_credential=azd_credential,
+            vision_endpoint=args.visionendpoint,
+            search_images=args.searchimages,
+            http_session=http_session,
         )
 
         ingestion_strategy = FileStrategy(
@@ -491,5 +501,9 @@ if __name__ == "__main__":
             category=args.category,
         )
 
-    loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
-    loop.close()
+    try:
+        loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    finally:
+        # Close the connector even when the ingestion fails
+        loop.run_until_complete(http_session.close())
+        loop.close()
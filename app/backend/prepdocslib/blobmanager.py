@@ -119,7 +119,9 @@ class BlobManager:
             new_img.save(output, format="PNG")
             output.seek(0)
 
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
+            # Recorded so that the token cost of the image can be computed at query time without reading it
+            metadata = {"width": str(new_img.width), "height": str(new_img.height)}
+            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True, metadata=metadata)
             if not self.user_delegation_key:
                 self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
 
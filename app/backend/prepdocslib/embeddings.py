@@ -1,3 +1,4 @@
+from core.httpsession import HttpSessionManager
 from core.log import Logger
 from abc import ABC
 from typing import Awaitable, Callable, List, Optional, Union
@@ -221,30 +222,41 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[HttpSessionManager] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        self.http_session = http_session
 
     async def create_embeddings(self, blob_urls: List[str]) -> List[List[float]]:
+        if self.http_session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.create_embeddings_with(session, blob_urls)
+        return await self.create_embeddings_with(self.http_session.get_session(), blob_urls)
+
+    async def create_embeddings_with(self, session: aiohttp.ClientSession, blob_urls: List[str]) -> List[List[float]]:
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
         headers = {"Content-Type": "application/json"}
         params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
         headers["Authorization"] = "Bearer " + await self.token_provider()
 
         embeddings: List[List[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            for blob_url in blob_urls:
-                async for attempt in AsyncRetrying(
-                    retry=retry_if_exception_type(Exception),
-                    wait=wait_random_exponential(min=15, max=60),
-                    stop=stop_after_attempt(15),
-                    before_sleep=self.before_retry_sleep,
-                ):
-                    with attempt:
-                        body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
-                            resp_json = await resp.json()
-                            embeddings.append(resp_json["vector"])
+        for blob_url in blob_urls:
+            async for attempt in AsyncRetrying(
+                retry=retry_if_exception_type(Exception),
+                wait=wait_random_exponential(min=15, max=60),
+                stop=stop_after_attempt(15),
+                before_sleep=self.before_retry_sleep,
+            ):
+                with attempt:
+                    body = {"url": blob_url}
+                    async with session.post(url=endpoint, params=params, headers=headers, json=body) as resp:
+                        resp_json = await resp.json()
+                        embeddings.append(resp_json["vector"])
 
         return embeddings
 
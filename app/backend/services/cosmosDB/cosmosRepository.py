@@ -1,15 +1,20 @@
 from azure.cosmos import CosmosClient, PartitionKey
+import asyncio
 import pymongo
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from core.log import Logger
 
 
 class CosmosRepository:
-    def __init__(self, connection_string, database_name):
+    def __init__(self, connection_string, database_name, max_workers=4):
         # A conexão é inicializada usando a connection string
         self.client = pymongo.MongoClient(connection_string)
         self.db = self.client[database_name]
         self.logging = Logger()
+        # pymongo is blocking, so async callers run queries on this bounded pool instead of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cosmos")
         if database_name not in self.client.list_database_names():
             self.logging.error("Database '{}' not found.".format(database_name))
             raise Exception("Database '{}' not found.".format(database_name))
@@ -53,6 +58,14 @@ class CosmosRepository:
             filter, fields).skip((page-1)*limit).limit(limit))
         return documents
 
+    async def list_all_async(self, collection_name, filter, fields, page=1, limit=999):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(self.list_all, collection_name, filter, fields, page, limit))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
+
     def get_by_id(self, collection_name, item_id):
         collection = self.db.get_collection(collection_name)
         item = collection.find_one({"id": item_id})
@@ -1,12 +1,16 @@
 from core.log import Logger
 from typing import List
 from core.theme.domain.theme import SubTheme, Theme
+from core.theme.domain.theme_repository import ThemeRepository as ThemeRepositoryInterface
 from services.cosmosDB.cosmosRepository import CosmosRepository
 
 
 
-class ThemeRepository:
+class ThemeRepository(ThemeRepositoryInterface):
     collection_name = "themes"
+    fields = {
+        "_id": 1, "id": 1, "themeName": 1, "themeId": 1, "language": 1, "active": 1, "subThemes": 1, "assistantConfig": 1,
+    }
 
     def __init__(self, repository: CosmosRepository):
         self.repository = repository
@@ -15,9 +19,19 @@ class ThemeRepository:
     def list(self) -> List[Theme]:
         self.logging.info("Listing themes")
         try:
-            documents = self.repository.list_all(self.collection_name, {"active": True}, {
-                "_id": 1, "id": 1, "themeName": 1, "themeId": 1, "language": 1, "active": 1, "subThemes": 1, "assistantConfig": 1, 
-            })
+            documents = self.repository.list_all(self.collection_name, {"active": True}, self.fields)
+            list_of_themes = [Theme.from_dict(theme) for theme in documents]
+            self.logging.info(f"Found {len(list_of_themes)} active themes")
+            return list_of_themes
+        except Exception as e:
+            self.logging.error("Failed to list themes")
+            raise RuntimeError(
+                "Failed to retrieve themes from the database") from e
+
+    async def list_async(self) -> List[Theme]:
+        self.logging.info("Listing themes")
+        try:
+            documents = await self.repository.list_all_async(self.collection_name, {"active": True}, self.fields)
             list_of_themes = [Theme.from_dict(theme) for theme in documents]
             self.logging.info(f"Found {len(list_of_themes)} active themes")
             return list_of_themes
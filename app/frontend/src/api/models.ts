@@ -29,6 +29,7 @@ export type ChatAppRequestOverrides = {
     prompt_template_prefix?: string;
     prompt_template_suffix?: string;
     suggest_followup_questions?: boolean;
+    speculative_retrieval?: boolean;
     use_oid_security_filter?: boolean;
     use_groups_security_filter?: boolean;
     use_gpt4v?: boolean;
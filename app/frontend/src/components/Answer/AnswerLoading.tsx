@@ -4,7 +4,12 @@ import { animated, useSpring } from "@react-spring/web";
 import styles from "./Answer.module.css";
 import { AnswerIcon } from "./AnswerIcon";
 
-export const AnswerLoading = () => {
+interface Props {
+    // Progress of the retrieval streamed before the answer, shown instead of the generic message
+    stage?: string;
+}
+
+export const AnswerLoading = ({ stage }: Props) => {
     const animatedStyles = useSpring({
         from: { opacity: 0 },
         to: { opacity: 1 }
@@ -16,7 +21,7 @@ export const AnswerLoading = () => {
                 <AnswerIcon />
                 <Stack.Item grow>
                     <p className={styles.answerText}>
-                        Gerando resposta
+                        {stage ?? "Gerando resposta"}
                         <span className={styles.loadingdots} />
                     </p>
                 </Stack.Item>
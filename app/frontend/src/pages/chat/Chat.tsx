@@ -56,6 +56,7 @@ const Chat = () => {
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
     const [isStreaming, setIsStreaming] = useState<boolean>(false);
+    const [loadingStage, setLoadingStage] = useState<string | undefined>(undefined);
     const [error, setError] = useState<unknown>();
 
     const [activeCitation, setActiveCitation] = useState<string>();
@@ -191,6 +192,17 @@ const Chat = () => {
         try {
             setIsStreaming(true);
             for await (const event of readNDJSONStream(responseBody)) {
+                const stage = event["choices"] && event["choices"][0]["context"] && event["choices"][0]["context"]["stage"];
+                if (stage) {
+                    // Retrieval progress, streamed before the answer starts
+                    const stageContext = event["choices"][0]["context"];
+                    if (stage === "search_query") {
+                        setLoadingStage(stageContext["search_query"] ? `Pesquisando por "${stageContext["search_query"]}"` : "Pesquisando documentos");
+                    } else if (stage === "search_results") {
+                        setLoadingStage(`Lendo ${stageContext["result_count"]} documentos`);
+                    }
+                    continue;
+                }
                 if(event["choices"] && event["choices"][0] && event["choices"][0]["context"] && event["choices"][0]["context"]["data"]) {
                     setAnalysisPanelData(event["choices"][0]["context"]["data"]);
                 }
@@ -203,6 +215,10 @@ const Chat = () => {
                 } else if (event["choices"] && event["choices"][0]["context"]) {
                     // Update context with new keys from latest event
                     askResponse.choices[0].context = { ...askResponse.choices[0].context, ...event["choices"][0]["context"] };
+                    // Follow-up questions arrive one event each, show them without waiting for the end of the stream
+                    if (event["choices"][0]["context"]["followup_questions"]) {
+                        await updateState("");
+                    }
                 } else if (event["error"]) {
                     throw Error(event["error"]);
                 }
@@ -224,6 +240,7 @@ const Chat = () => {
 
         error && setError(undefined);
         setIsLoading(true);
+        setLoadingStage(undefined);
         setActiveCitation(undefined);
         setActiveAnalysisPanelTab(undefined);
 
@@ -358,7 +375,7 @@ const Chat = () => {
                                                 onThoughtProcessClicked={() => onToggleTab(AnalysisPanelTabs.ThoughtProcessTab, index)}
                                                 onSupportingContentClicked={() => onToggleTab(AnalysisPanelTabs.SupportingContentTab, index)}
                                                 onFollowupQuestionClicked={q => makeApiRequest(q)}
-                                                showFollowupQuestions={useSuggestFollowupQuestions && answers.length - 1 === index}
+                                                showFollowupQuestions={useSuggestFollowupQuestions && streamedAnswers.length - 1 === index}
                                                 showSupportingContent={showSupportingContent}
                                                 showThoughtProcess={showThoughtProcess}
                                             />
@@ -390,7 +407,7 @@ const Chat = () => {
                                 <>
                                     <UserChatMessage message={lastQuestionRef.current} />
                                     <div className={styles.chatMessageGptMinWidth}>
-                                        <AnswerLoading />
+                                        <AnswerLoading stage={loadingStage} />
                                     </div>
                                 </>
                             )}
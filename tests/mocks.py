@@ -38,6 +38,13 @@ class MockBlob:
     async def readinto(self, buffer: BytesIO):
         buffer.write(b"test")
 
+    @property
+    def size(self):
+        return len(b"test")
+
+    async def chunks(self):
+        yield b"test"
+
 
 class MockKeyVaultSecret:
     def __init__(self, value):
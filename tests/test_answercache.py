@@ -0,0 +1,130 @@
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from approaches.approach import ThoughtStep
+from approaches.chatapproach import ChatApproach
+from core.answercache import AnswerCache
+from core.sharedcache import InMemorySharedCache
+
+ANSWER = "Plans include Northwind Standard. <<What is covered?>>"
+
+
+async def mock_completion():
+    return ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 1695324963,
+            "model": "gpt-35-turbo",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": ANSWER}}],
+        }
+    )
+
+
+async def mock_stream():
+    for content in ["Plans include ", "Northwind Standard. ", "<<What is covered?>>"]:
+        yield ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content}}],
+            }
+        )
+
+
+async def mock_stream_coroutine():
+    return mock_stream()
+
+
+class MockAuthHelper:
+    def build_security_filters(self, overrides, auth_claims):
+        return f"oids/any(g:search.in(g, '{auth_claims['oid']}'))" if auth_claims.get("oid") else None
+
+
+class MockChatApproach(ChatApproach):
+    def __init__(self, answer_cache: AnswerCache):
+        self.auth_helper = MockAuthHelper()
+        self.answer_cache = answer_cache
+        self.theme_version = "v1"
+        self.calls = 0
+
+    @property
+    def system_message_chat_conversation(self) -> str:
+        return ""
+
+    async def run_until_final_call(self, history, overrides, auth_claims, theme, should_stream=False, stages=None):
+        self.calls += 1
+        extra_info = {"data_points": {"text": ["info1.txt: plans"]}, "thoughts": [ThoughtStep("Search", "plans")]}
+        return extra_info, mock_stream_coroutine() if should_stream else mock_completion()
+
+
+@pytest.fixture
+def shared_cache():
+    return InMemorySharedCache()
+
+
+@pytest.fixture
+def approach(shared_cache):
+    return MockChatApproach(AnswerCache(shared_cache))
+
+
+MESSAGES = [{"role": "user", "content": "What plans are there?"}]
+CONTEXT = {"overrides": {"theme_id": "theme-1", "suggest_followup_questions": True}, "auth_claims": {"oid": "a"}}
+
+
+async def collect(stream):
+    return [event async for event in stream]
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_non_streaming(approach):
+    first = await approach.run(MESSAGES, theme=None, context=CONTEXT)
+    second = await approach.run([{"role": "user", "content": " What plans  are there?"}], theme=None, context=CONTEXT)
+    assert approach.calls == 1
+    assert second["choices"][0]["message"]["content"] == first["choices"][0]["message"]["content"]
+    assert second["choices"][0]["context"]["followup_questions"] == ["What is covered?"]
+    assert second["choices"][0]["context"]["thoughts"][-1].title == "Answer cache"
+    assert approach.answer_cache.stats.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_replays_stream(approach):
+    streamed = await collect(await approach.run(MESSAGES, theme=None, stream=True, context=CONTEXT))
+    replayed = await collect(await approach.run(MESSAGES, theme=None, stream=True, context=CONTEXT))
+    assert approach.calls == 1
+
+    def content(events):
+        return "".join(event["choices"][0]["delta"].get("content") or "" for event in events)
+
+    assert content(replayed) == content(streamed) == "Plans include Northwind Standard. "
+    assert replayed[0]["choices"][0]["context"]["data_points"] == {"text": ["info1.txt: plans"]}
+    assert replayed[-1]["choices"][0]["context"] == {"followup_questions": ["What is covered?"]}
+
+    # A streamed answer is also replayed as JSON
+    replayed_json = await approach.run(MESSAGES, theme=None, context=CONTEXT)
+    assert replayed_json["choices"][0]["message"]["content"] == "Plans include Northwind Standard. "
+    assert approach.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_key_and_invalidation(approach, shared_cache):
+    await approach.run(MESSAGES, theme=None, context=CONTEXT)
+
+    # Other users get their own answers, as the security filter differs
+    await approach.run(MESSAGES, theme=None, context={**CONTEXT, "auth_claims": {"oid": "b"}})
+    assert approach.calls == 2
+
+    # A new theme version misses
+    approach.theme_version = "v2"
+    await approach.run(MESSAGES, theme=None, context=CONTEXT)
+    assert approach.calls == 3
+
+    # Index content changes invalidate every answer, also those cached by other workers
+    other_worker_cache = AnswerCache(shared_cache)
+    key = other_worker_cache.make_key("v2", None, {}, MESSAGES)
+    approach.answer_cache.invalidate()
+    assert other_worker_cache.make_key("v2", None, {}, MESSAGES) != key
+    await approach.run(MESSAGES, theme=None, context=CONTEXT)
+    assert approach.calls == 4
@@ -0,0 +1,105 @@
+import pytest
+from azure.core.credentials import AzureKeyCredential
+
+from approaches.approachfactory import ChatApproachFactory
+from core.modelhelper import get_message_key, token_count_cache
+from core.querycache import QueryRewriteCache
+from core.searchclientpool import SearchClientPool
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+def make_theme(theme_id: str, index_name: str, system_prompt: str) -> dict:
+    return {
+        "themeId": theme_id,
+        "themeName": theme_id,
+        "language": "en-us",
+        "active": True,
+        "subThemes": [],
+        "assistantConfig": {
+            "searchIndexName": index_name,
+            "systemMessageConversationPrompt": system_prompt,
+            "queryPromptTemplate": f"Query template for {theme_id}",
+            "queryPromptFewShots": [{"role": "user", "content": f"Example for {theme_id}"}],
+            "followUpQuestionsPrompt": f"Follow-up prompt for {theme_id}",
+        },
+    }
+
+
+@pytest.fixture
+def approach_factory():
+    return ChatApproachFactory(
+        search_client_pool=SearchClientPool(
+            endpoint="https://test-search-service.search.windows.net", credential=AzureKeyCredential("key")
+        ),
+        chat_approach_kwargs=dict(
+            auth_helper=None,
+            openai_client=None,
+            chatgpt_model="gpt-35-turbo",
+            chatgpt_deployment="chat",
+            embedding_deployment="embeddings",
+            embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+            embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+            sourcepage_field="",
+            content_field="",
+            query_language="en-us",
+            query_speller="lexicon",
+        ),
+        query_rewrite_cache=QueryRewriteCache(),
+    )
+
+
+def test_get_approach_binds_theme(approach_factory):
+    theme_a = make_theme("a", "index-a", "You help with A")
+    theme_b = make_theme("b", "index-b", "You help with B")
+
+    approach_a = approach_factory.get_approach(theme_a, 1)
+    approach_b = approach_factory.get_approach(theme_b, 1)
+
+    assert approach_a is not approach_b
+    assert approach_a.system_message_chat_conversation == "You help with A"
+    assert approach_a.query_prompt_template == "Query template for a"
+    assert approach_a.query_prompt_few_shots == ({"role": "user", "content": "Example for a"},)
+    assert approach_a.follow_up_questions_prompt_content == "Follow-up prompt for a"
+    assert approach_a.search_client is approach_factory.search_client_pool.get("index-a")
+    assert approach_b.system_message_chat_conversation == "You help with B"
+    assert approach_b.search_client is approach_factory.search_client_pool.get("index-b")
+
+
+def test_get_approach_cached_per_theme_version(approach_factory):
+    theme = make_theme("a", "index-a", "You help with A")
+    approach = approach_factory.get_approach(theme, 1)
+    assert approach_factory.get_approach(theme, 1) is approach
+    assert approach.theme_version == "1"
+
+    updated_theme = make_theme("a", "index-a", "You help with A, v2")
+    updated_approach = approach_factory.get_approach(updated_theme, 2)
+    assert updated_approach is not approach
+    assert updated_approach.system_message_chat_conversation == "You help with A, v2"
+    assert updated_approach.theme_version == "2"
+    assert len(approach_factory.approaches) == 1
+
+
+def test_get_approach_without_vision_falls_back_to_text(approach_factory):
+    theme = make_theme("a", "index-a", "You help with A")
+    assert approach_factory.get_approach(theme, 1, use_gpt4v=True) is approach_factory.get_approach(theme, 1)
+
+
+def test_get_approach_query_rewrite_cache_opt_in(approach_factory):
+    theme = make_theme("a", "index-a", "You help with A")
+    assert approach_factory.get_approach(theme, 1).query_rewrite_cache is None
+
+    cached_theme = make_theme("b", "index-b", "You help with B")
+    cached_theme["assistantConfig"]["cacheSearchQuery"] = True
+    approach = approach_factory.get_approach(cached_theme, 1)
+    assert approach.query_rewrite_cache is approach_factory.query_rewrite_cache
+    assert approach.theme_id == "b"
+
+
+def test_get_approach_warms_token_counts(approach_factory):
+    token_count_cache.clear()
+    approach_factory.get_approach(make_theme("a", "index-a", "You help with A"), 1)
+    few_shot = {"role": "user", "content": "Example for a"}
+    system_prompt = {"role": "system", "content": "You help with A"}
+    assert get_message_key(few_shot, "gpt-35-turbo") in token_count_cache
+    assert get_message_key(system_prompt, "gpt-35-turbo") in token_count_cache
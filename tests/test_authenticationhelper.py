@@ -1,11 +1,19 @@
+import asyncio
 import json
+import time
 
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
+from jose import jwt
 
+from core.answercache import INDEX_GENERATION_KEY
 from core.authentication import AuthenticationHelper, AuthError
+from core.groupcache import GroupMembershipCache
+from core.pathauthcache import PathAuthCache
+from core.sharedcache import InMemorySharedCache
 
 from .mocks import MockAsyncPageIterator
 
@@ -22,6 +30,8 @@ def create_authentication_helper(
     require_access_control: bool = False,
     enable_global_documents: bool = False,
     enable_unauthenticated_access: bool = False,
+    path_auth_cache=None,
+    group_cache=None,
 ):
     return AuthenticationHelper(
         search_index=MockSearchIndex,
@@ -33,6 +43,8 @@ def create_authentication_helper(
         require_access_control=require_access_control,
         enable_global_documents=enable_global_documents,
         enable_unauthenticated_access=enable_unauthenticated_access,
+        path_auth_cache=path_auth_cache,
+        group_cache=group_cache,
     )
 
 
@@ -65,6 +77,55 @@ async def test_get_auth_claims_overage_success(
     assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_cached(
+    mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_success
+):
+    group_cache = GroupMembershipCache()
+    helper = create_authentication_helper(group_cache=group_cache)
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+    # The listing mock only answers once, another token for the same user is served from the cache
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Other"})
+    assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+    assert group_cache.stats.to_dict() == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+    await helper.close()
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_groups_expire(monkeypatch, mock_confidential_client_overage):
+    now = 0.0
+    group_cache = GroupMembershipCache(ttl=300, refresh_after=240, timer=lambda: now)
+    helper = create_authentication_helper(group_cache=group_cache)
+    exchanged = []
+    listed_groups = [["GROUP_Y", "GROUP_Z"]]
+
+    async def mock_exchange_token(auth_token):
+        exchanged.append(auth_token)
+        return await AuthenticationHelper.exchange_token(helper, auth_token)
+
+    async def mock_validate_access_token(token):
+        return {"oid": "OID_X", "exp": time.time() + 3600}
+
+    async def mock_list_groups(graph_resource_access_token, session=None):
+        return list(listed_groups[-1])
+
+    monkeypatch.setattr(helper, "exchange_token", mock_exchange_token)
+    monkeypatch.setattr(helper, "validate_access_token", mock_validate_access_token)
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", mock_list_groups)
+    headers = {"Authorization": "Bearer Token"}
+    assert (await helper.get_auth_claims_if_enabled(headers))["groups"] == ["GROUP_Y", "GROUP_Z"]
+
+    # The token's claims are cached until it expires, but its overage groups only for the group cache TTL
+    listed_groups.append(["GROUP_Y"])
+    now = 100
+    assert (await helper.get_auth_claims_if_enabled(headers))["groups"] == ["GROUP_Y", "GROUP_Z"]
+    now = 301
+    assert (await helper.get_auth_claims_if_enabled(headers))["groups"] == ["GROUP_Y"]
+    assert exchanged == ["Token"]
+    await helper.close()
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_overage_unauthorized(
     mock_confidential_client_overage, mock_list_groups_unauthorized, mock_validate_token_success
@@ -74,6 +135,49 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(monkeypatch, mock_confidential_client_success):
+    helper = create_authentication_helper()
+    validated_tokens = []
+
+    async def mock_validate_access_token(token):
+        validated_tokens.append(token)
+        return {"oid": "OID_X", "exp": time.time() + (3600 if token == "Token" else -1)}
+
+    monkeypatch.setattr(helper, "validate_access_token", mock_validate_access_token)
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    auth_claims["groups"].append("GROUP_MODIFIED")
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert validated_tokens == ["Token"]
+
+    # Expired tokens aren't cached
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Expired"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Expired"})
+    assert validated_tokens == ["Token", "Expired", "Expired"]
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_coalesced(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    helper = create_authentication_helper()
+    exchanged_tokens = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        # Runs on the exchange threads, so blocking doesn't hold up the event loop
+        exchanged_tokens.append(kwargs["user_assertion"])
+        time.sleep(0.05)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    results = await asyncio.gather(
+        *(helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) for _ in range(5))
+    )
+    assert results == [{"oid": "OID_X", "groups": ["GROUP_Y"]}] * 5
+    assert exchanged_tokens == ["Token"]
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -479,3 +583,113 @@ async def test_check_path_auth_allowed_public_without_access_control(
     )
     assert filter is None
     assert called_search is False
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    shared_cache = InMemorySharedCache()
+    path_auth_cache = PathAuthCache(shared_cache, ttl=60, negative_ttl=10)
+    auth_helper = create_authentication_helper(require_access_control=True, path_auth_cache=path_auth_cache)
+    filters = []
+
+    async def mock_search(self, *args, **kwargs):
+        filters.append(kwargs.get("filter"))
+        if "Benefit_Options.pdf" in kwargs.get("filter"):
+            return MockAsyncPageIterator(data=[{"sourcefile": "Benefit_Options.pdf"}])
+        return MockAsyncPageIterator(data=[])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+
+    for path in ["Benefit_Options.pdf", "Benefit_Options.pdf#page=2", "Benefit_Options.pdf"]:
+        assert await auth_helper.check_path_auth(path, auth_claims, create_search_client()) is True
+    for _ in range(2):
+        assert await auth_helper.check_path_auth("Secret.pdf", auth_claims, create_search_client()) is False
+    assert len(filters) == 2
+    assert path_auth_cache.stats.to_dict()["hits"] == 3
+
+    # The groups are part of the key, in any order
+    other_claims = {"oid": "OID_X", "groups": ["GROUP_Z", "GROUP_Y"]}
+    assert await auth_helper.check_path_auth("Secret.pdf", other_claims, create_search_client()) is False
+    assert len(filters) == 2
+    assert await auth_helper.check_path_auth("Secret.pdf", {"oid": "OID_X"}, create_search_client()) is False
+    assert len(filters) == 3
+
+    # Denials expire sooner than approvals
+    key = path_auth_cache.make_key(auth_claims, "Secret.pdf")
+    now = path_auth_cache.decisions.timer()
+    assert path_auth_cache.get_expiry(key, False, now) == now + 10
+    assert path_auth_cache.get_expiry(key, True, now) == now + 60
+
+    # A new index generation invalidates the decisions
+    shared_cache.invalidate(INDEX_GENERATION_KEY)
+    assert await auth_helper.check_path_auth("Benefit_Options.pdf", auth_claims, create_search_client()) is True
+    assert len(filters) == 4
+
+
+@pytest.mark.asyncio
+async def test_preauthorize_paths(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    path_auth_cache = PathAuthCache(InMemorySharedCache())
+    auth_helper = create_authentication_helper(require_access_control=True, path_auth_cache=path_auth_cache)
+
+    async def mock_search(self, *args, **kwargs):
+        raise AssertionError("The path should be authorized from the cache")
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    auth_helper.preauthorize_paths(["Benefit_Options-2.pdf#page=2", "Benefit_Options.pdf", None], auth_claims)
+    assert await auth_helper.check_path_auth("Benefit_Options-2.pdf", auth_claims, create_search_client()) is True
+    assert await auth_helper.check_path_auth("Benefit_Options.pdf", auth_claims, create_search_client()) is True
+
+    # Without a security filter, every path is allowed and nothing is cached
+    auth_helper_without_access_control = create_authentication_helper(path_auth_cache=path_auth_cache)
+    path_auth_cache.clear()
+    auth_helper_without_access_control.preauthorize_paths(["Benefit_Options.pdf"], auth_claims)
+    assert len(path_auth_cache.decisions) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_theme_index(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    path_auth_cache = PathAuthCache(InMemorySharedCache())
+    auth_helper = create_authentication_helper(require_access_control=True, path_auth_cache=path_auth_cache)
+    searched_indexes = []
+
+    async def mock_search(self, *args, **kwargs):
+        searched_indexes.append(self._index_name)
+        if self._index_name == "last-index" and "'Theme.pdf'" in kwargs.get("filter"):
+            # A slow index doesn't hold up the one that allows access
+            await asyncio.sleep(3600)
+        found = self._index_name == "theme-index" and "'Theme.pdf'" in kwargs.get("filter")
+        return MockAsyncPageIterator(data=[{"sourcefile": "Theme.pdf"}] if found else [])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    theme_search_clients = [
+        SearchClient(endpoint="", index_name=index_name, credential=AzureKeyCredential(""))
+        for index_name in ["other-index", "theme-index", "last-index"]
+    ]
+
+    # A citation of a theme is found in the theme's index, without having been preauthorized
+    assert await asyncio.wait_for(
+        auth_helper.check_path_auth("Theme.pdf", auth_claims, create_search_client(), theme_search_clients), 1
+    )
+    assert searched_indexes == ["", "other-index", "theme-index", "last-index"]
+    assert not await auth_helper.check_path_auth("Other.pdf", auth_claims, create_search_client(), theme_search_clients)
+    assert path_auth_cache.decisions[path_auth_cache.make_key(auth_claims, "Theme.pdf")] is True
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_unknown_key(monkeypatch, mock_confidential_client_success):
+    helper = create_authentication_helper()
+    requested_kids = []
+
+    async def mock_get_key(kid):
+        requested_kids.append(kid)
+        return None
+
+    monkeypatch.setattr(helper.jwks_cache, "get_key", mock_get_key)
+    token = jwt.encode({"iss": helper.valid_issuers[0], "aud": "SERVER_APP"}, "secret", headers={"kid": "KEY_X"})
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(token)
+    assert exc_info.value.error == {"code": "invalid_header", "description": "Unable to find appropriate key"}
+    assert requested_kids == ["KEY_X"]
@@ -1,11 +1,15 @@
+import asyncio
 import json
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from approaches.approach import ThoughtStep
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.querycache import QueryRewriteCache
+from core.rewritepolicy import QueryRewritePolicy
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -360,3 +364,314 @@ async def test_search_results_filtering_by_scores(
     assert (
         len(filtered_results) == expected_result_count
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+class MockQueryCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs):
+        self.calls += 1
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "health plans"},
+                    }
+                ],
+            }
+        )
+
+
+class MockAuthHelper:
+    def build_security_filters(self, overrides, auth_claims):
+        return None
+
+    def preauthorize_paths(self, paths, auth_claims):
+        pass
+
+
+class MockOpenAIClient:
+    def __init__(self):
+        self.chat = type("Chat", (), {})()
+        self.chat.completions = MockQueryCompletions()
+
+
+@pytest.mark.asyncio
+async def test_query_rewrite_cache(monkeypatch):
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    openai_client = MockOpenAIClient()
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=MockAuthHelper(),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        theme_id="theme-1",
+        query_rewrite_cache=QueryRewriteCache(),
+    )
+    history = [{"role": "user", "content": "What are my health plans?"}]
+    overrides = {"retrieval_mode": "text"}
+
+    # The answer call is never awaited here, so only query generation calls are counted
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, overrides, {}, None)
+    chat_coroutine.close()
+    assert openai_client.chat.completions.calls == 1
+    assert "cached" not in extra_info["thoughts"][0].props
+    assert extra_info["thoughts"][1].description == "health plans"
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, overrides, {}, None)
+    chat_coroutine.close()
+    assert openai_client.chat.completions.calls == 1
+    assert extra_info["thoughts"][0].props["cached"] is True
+    assert extra_info["thoughts"][1].description == "health plans"
+
+
+def test_query_rewrite_cache_key():
+    cache = QueryRewriteCache()
+    messages = [{"role": "system", "content": "template"}, {"role": "user", "content": "question"}]
+    key = cache.make_key("theme-1", "gpt-35-turbo", "Generate  a\n query", messages)
+    assert key == cache.make_key("theme-1", "gpt-35-turbo", "Generate a query", messages)
+    assert key != cache.make_key("theme-2", "gpt-35-turbo", "Generate a query", messages)
+    assert key != cache.make_key("theme-1", "gpt-4", "Generate a query", messages)
+    assert key != cache.make_key("theme-1", "gpt-35-turbo", "Generate another query", messages)
+    assert key != cache.make_key(
+        "theme-1", "gpt-35-turbo", "Generate a query", messages + [{"role": "user", "content": "more"}]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "speculative_similarity, expected_path, expected_query",
+    [
+        (None, "discarded", "health plans"),
+        (0.5, "kept", "What are my health plans?"),
+    ],
+)
+async def test_speculative_retrieval(monkeypatch, speculative_similarity, expected_path, expected_query):
+    search_queries = []
+
+    async def mock_search_recording(*args, **kwargs):
+        search_queries.append(kwargs.get("search_text"))
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search_recording)
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=MockAuthHelper(),
+        openai_client=MockOpenAIClient(),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+    overrides = {"retrieval_mode": "text", "speculative_retrieval": True}
+    if speculative_similarity is not None:
+        overrides["speculative_similarity"] = speculative_similarity
+
+    stages: asyncio.Queue = asyncio.Queue()
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What are my health plans?"}], overrides, {}, None, stages=stages
+    )
+    chat_coroutine.close()
+
+    # The query reported to the client is the one that was searched
+    assert stages.get_nowait() == (
+        "search_query",
+        {"search_query": expected_query, "thoughts": extra_info["thoughts"][:1]},
+    )
+    search_step = extra_info["thoughts"][1]
+    assert search_step.props["speculative_retrieval"] == expected_path
+    assert search_step.props["query_similarity"] == pytest.approx(4 / 7, abs=0.001)
+    assert search_step.description == expected_query
+    # The speculative search may have been cancelled before it reached the index
+    assert search_queries[-1] == expected_query
+    assert search_queries.count("health plans") == (expected_path == "discarded")
+
+
+def test_get_query_similarity(chat_approach):
+    assert chat_approach.get_query_similarity("Health plans?", "health plans") == 1
+    assert chat_approach.get_query_similarity("What is PerksPlus?", "PerksPlus program") == pytest.approx(0.4)
+
+
+@pytest.mark.asyncio
+async def test_query_rewrite_policy_skips_rewrite(monkeypatch):
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    openai_client = MockOpenAIClient()
+    policy = QueryRewritePolicy.from_config({"enabled": True}, "en-us")
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=MockAuthHelper(),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        query_rewrite_policy=policy,
+    )
+    overrides = {"retrieval_mode": "text"}
+
+    history = [{"role": "user", "content": "What are my health plans?"}]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, overrides, {}, None)
+    chat_coroutine.close()
+    assert openai_client.chat.completions.calls == 0
+    query_step = extra_info["thoughts"][0]
+    assert query_step.title == "Prompt to generate search query"
+    assert query_step.description == []
+    assert query_step.props["skipped"] is True
+    assert extra_info["thoughts"][1].description == "What are my health plans?"
+
+    # Follow-up questions depend on the conversation, so they are rewritten
+    history = [
+        {"role": "user", "content": "What are my health plans?"},
+        {"role": "assistant", "content": "Northwind Standard and Plus."},
+        {"role": "user", "content": "Does the first cover eyes?"},
+    ]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, overrides, {}, None)
+    chat_coroutine.close()
+    assert openai_client.chat.completions.calls == 1
+    assert "skipped" not in extra_info["thoughts"][0].props
+    assert policy.stats.to_dict() == {"rewritten": 1, "skipped": 1}
+
+
+def test_get_delta_event(chat_approach):
+    chunk = ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 1695324963,
+            "model": "gpt-35-turbo",
+            "choices": [{"index": 0, "finish_reason": None, "delta": {"content": "Paris", "role": "assistant"}}],
+        }
+    )
+    assert chat_approach.get_delta_event(chunk) == {
+        "choices": [{"delta": {"role": "assistant", "content": "Paris"}, "finish_reason": None, "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+    empty_chunk = ChatCompletionChunk.model_validate({**chunk.model_dump(), "choices": []})
+    assert chat_approach.get_delta_event(empty_chunk) == {"choices": [], "object": "chat.completion.chunk"}
+
+    # The debug flag streams the whole chunk
+    chat_approach.stream_full_chunks = True
+    assert chat_approach.get_delta_event(chunk) == chunk.model_dump()
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_followup_questions(monkeypatch, chat_approach):
+    async def mock_stream():
+        for content in ["Paris. <", "<Spain?>", "> <<Ita", "ly?>>"]:
+            yield ChatCompletionChunk.model_validate(
+                {
+                    "id": "chatcmpl-1",
+                    "object": "chat.completion.chunk",
+                    "created": 1695324963,
+                    "model": "gpt-35-turbo",
+                    "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content}}],
+                }
+            )
+
+    async def mock_run_until_final_call(history, overrides, auth_claims, theme, should_stream, stages=None):
+        async def stream_coroutine():
+            return mock_stream()
+
+        return {"data_points": {"text": []}}, stream_coroutine()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+    events = [
+        event
+        async for event in chat_approach.run_with_streaming(
+            None, [{"role": "user", "content": "Capital?"}], {"suggest_followup_questions": True}, {}
+        )
+    ]
+    assert events[1]["choices"][0]["delta"]["content"] == "Paris. "
+    # Each question is streamed as soon as it closes, with the questions so far
+    assert [event["choices"][0]["context"]["followup_questions"] for event in events[2:]] == [
+        ["Spain?"],
+        ["Spain?", "Italy?"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_stages(monkeypatch, chat_approach):
+    search_done = asyncio.Event()
+
+    async def mock_stream():
+        yield ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": "Paris."}}],
+            }
+        )
+
+    async def mock_run_until_final_call(history, overrides, auth_claims, theme, should_stream, stages=None):
+        thoughts = [ThoughtStep("Prompt to generate search query", [])]
+        chat_approach.report_stage(stages, "search_query", {"search_query": "capital", "thoughts": thoughts})
+        # The stage is streamed while the search is still running
+        await search_done.wait()
+        thoughts.append(ThoughtStep("Search results", []))
+        chat_approach.report_stage(stages, "search_results", {"result_count": 0, "thoughts": thoughts[1:]})
+
+        async def stream_coroutine():
+            return mock_stream()
+
+        return {"data_points": {"text": []}, "thoughts": thoughts}, stream_coroutine()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+    stream = chat_approach.run_with_streaming(None, [{"role": "user", "content": "Capital?"}], {}, {})
+    event = await stream.__anext__()
+    assert event["choices"][0]["context"]["stage"] == "search_query"
+    assert event["choices"][0]["context"]["search_query"] == "capital"
+    assert len(event["choices"][0]["context"]["thoughts"]) == 1
+
+    search_done.set()
+    events = [event async for event in stream]
+    assert events[0]["choices"][0]["context"]["stage"] == "search_results"
+    assert len(events[0]["choices"][0]["context"]["thoughts"]) == 1
+    assert "stage" not in events[1]["choices"][0]["context"]
+    assert events[2]["choices"][0]["delta"]["content"] == "Paris."
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closed_early(monkeypatch, chat_approach):
+    cancelled = asyncio.Event()
+
+    async def mock_run_until_final_call(history, overrides, auth_claims, theme, should_stream, stages=None):
+        chat_approach.report_stage(stages, "search_query", {"search_query": "capital", "thoughts": []})
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+    stream = chat_approach.run_with_streaming(None, [{"role": "user", "content": "Capital?"}], {}, {})
+    await stream.__anext__()
+    # A client going away stops the retrieval
+    await stream.aclose()
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
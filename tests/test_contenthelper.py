@@ -0,0 +1,140 @@
+import datetime
+
+import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError
+from azure.storage.blob import BlobProperties, ContentSettings
+
+from core.contenthelper import download_content, get_mime_type
+
+CONTENT = b"0123456789"
+ETAG = '"0x8DC0000000000"'
+LAST_MODIFIED = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+class MockDownloader:
+    def __init__(self, offset, length):
+        end = len(CONTENT) if length is None else offset + length
+        self.data = CONTENT[offset:end]
+        self.size = len(self.data)
+        self.properties = BlobProperties(ETag=ETAG)
+        self.properties.content_settings = ContentSettings(content_type="application/octet-stream")
+        self.properties.last_modified = LAST_MODIFIED
+        self.properties.content_range = f"bytes {offset}-{end - 1}/{len(CONTENT)}"
+
+    async def chunks(self):
+        for start in range(0, self.size, 4):
+            yield self.data[start : start + 4]
+
+
+def make_error(error_type, status_code):
+    error = error_type("ConditionNotMet")
+    error.status_code = status_code
+    return error
+
+
+class MockStorage:
+    def __init__(self, etag=ETAG):
+        self.etag = etag
+        self.downloads = []
+
+    async def download(self, offset=None, length=None, etag=None, match_condition=None, if_modified_since=None):
+        self.downloads.append((offset, length))
+        if match_condition == MatchConditions.IfModified and etag == self.etag:
+            raise make_error(ResourceModifiedError, 304)
+        if match_condition == MatchConditions.IfNotModified and etag != self.etag:
+            raise make_error(ResourceModifiedError, 412)
+        if if_modified_since and if_modified_since >= LAST_MODIFIED:
+            raise make_error(ResourceModifiedError, 304)
+        if offset is not None and offset >= len(CONTENT):
+            raise make_error(HttpResponseError, 416)
+        return MockDownloader(offset or 0, length)
+
+    async def get_properties(self):
+        properties = BlobProperties()
+        properties.size = len(CONTENT)
+        return properties
+
+
+async def get_body(content):
+    return b"".join([chunk async for chunk in content.chunks()])
+
+
+@pytest.mark.asyncio
+async def test_download_content_whole_file():
+    storage = MockStorage()
+    content = await download_content(storage.download, storage.get_properties, {})
+    assert content.status == 200
+    assert await get_body(content) == CONTENT
+    assert content.headers == {
+        "Accept-Ranges": "bytes",
+        "ETag": ETAG,
+        "Last-Modified": "Wed, 01 May 2024 12:00:00 GMT",
+        "Content-Length": "10",
+    }
+    assert storage.downloads == [(None, None)]
+    assert get_mime_type("doc.pdf", content.downloader.properties) == "application/pdf"
+
+
+@pytest.mark.asyncio
+async def test_download_content_range():
+    storage = MockStorage()
+    content = await download_content(storage.download, storage.get_properties, {"Range": "bytes=2-5"})
+    assert content.status == 206
+    assert await get_body(content) == b"2345"
+    assert content.headers["Content-Range"] == "bytes 2-5/10"
+    assert content.headers["Content-Length"] == "4"
+    assert storage.downloads == [(2, 4)]
+
+    content = await download_content(storage.download, storage.get_properties, {"Range": "bytes=7-"})
+    assert content.headers["Content-Range"] == "bytes 7-9/10"
+    assert await get_body(content) == b"789"
+
+    content = await download_content(storage.download, storage.get_properties, {"Range": "bytes=-3"})
+    assert content.status == 206
+    assert content.headers["Content-Range"] == "bytes 7-9/10"
+    assert await get_body(content) == b"789"
+
+    content = await download_content(storage.download, storage.get_properties, {"Range": "bytes=20-"})
+    assert content.status == 416
+    assert content.headers == {"Content-Range": "bytes */10"}
+
+    # Several ranges are answered with the whole file
+    content = await download_content(storage.download, storage.get_properties, {"Range": "bytes=0-1,4-5"})
+    assert content.status == 200
+    assert await get_body(content) == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_download_content_if_range():
+    storage = MockStorage()
+    headers = {"Range": "bytes=2-5", "If-Range": ETAG}
+    content = await download_content(storage.download, storage.get_properties, headers)
+    assert content.status == 206
+    assert await get_body(content) == b"2345"
+
+    storage.etag = '"0x8DC0000000001"'
+    content = await download_content(storage.download, storage.get_properties, headers)
+    assert content.status == 200
+    assert await get_body(content) == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_download_content_not_modified():
+    storage = MockStorage()
+    content = await download_content(storage.download, storage.get_properties, {"If-None-Match": ETAG})
+    assert content.status == 304
+    assert content.downloader is None
+    assert content.headers == {"ETag": ETAG}
+    assert await get_body(content) == b""
+
+    content = await download_content(storage.download, storage.get_properties, {"If-None-Match": '"0x8DC0000000001"'})
+    assert content.status == 200
+
+    headers = {"If-Modified-Since": "Wed, 01 May 2024 12:00:00 GMT"}
+    content = await download_content(storage.download, storage.get_properties, headers)
+    assert content.status == 304
+
+    headers = {"If-Modified-Since": "Tue, 30 Apr 2024 12:00:00 GMT"}
+    content = await download_content(storage.download, storage.get_properties, headers)
+    assert content.status == 200
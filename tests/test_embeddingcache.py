@@ -0,0 +1,115 @@
+from array import array
+
+import openai
+import pytest
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.embeddingcache import EmbeddingCache
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+VECTOR = [0.5, -0.25, 0.125]
+
+
+class MockEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs):
+        self.calls += 1
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=VECTOR, index=0, object="embedding")],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=openai.types.create_embedding_response.Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self):
+        self.embeddings = MockEmbeddings()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_key():
+    cache = EmbeddingCache()
+    cache.set("ada", "embeddings", 1536, "health  plans\n", VECTOR)
+    assert await cache.get("ada", "embeddings", 1536, " health plans") == VECTOR
+    assert isinstance(cache.vectors[cache.make_key("ada", "embeddings", 1536, "health plans")], array)
+    assert await cache.get("ada", "other-deployment", 1536, "health plans") is None
+    assert await cache.get("ada", "embeddings", 256, "health plans") is None
+    assert await cache.get("large", "embeddings", 1536, "health plans") is None
+    assert cache.stats.to_dict() == {"hits": 1, "misses": 3, "hit_ratio": 0.25}
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_lru():
+    cache = EmbeddingCache(maxsize=2)
+    for text in ["a", "b", "c"]:
+        cache.set("ada", None, 1536, text, VECTOR)
+    assert await cache.get("ada", None, 1536, "a") is None
+    assert await cache.get("ada", None, 1536, "c") == VECTOR
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_persistent_tier(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    worker_a = EmbeddingCache(path=path)
+    worker_b = EmbeddingCache(path=path)
+
+    worker_a.set("ada", None, 1536, "health plans", VECTOR)
+    # Closing waits for the queued write
+    await worker_a.close()
+    assert await worker_b.get("ada", None, 1536, "health plans") == VECTOR
+    assert worker_b.persistent_stats.hits == 1
+    assert await worker_b.get("ada", None, 1536, "dental plans") is None
+    await worker_b.close()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_persistent_tier_pruned(tmp_path):
+    now = [1000.0]
+    path = str(tmp_path / "embeddings.sqlite3")
+    writer = EmbeddingCache(path=path, max_persistent_entries=2, ttl=60, timer=lambda: now[0])
+    for text in ["a", "b"]:
+        writer.set("ada", None, 1536, text, VECTOR)
+        now[0] += 1
+    # A read queued behind the writes waits for them
+    assert await writer.get("ada", None, 1536, "missing") is None
+    # Reading "a" makes "b" the least recently used
+    reader = EmbeddingCache(path=path, max_persistent_entries=2, ttl=60, timer=lambda: now[0])
+    assert await reader.get("ada", None, 1536, "a") == VECTOR
+    writer.set("ada", None, 1536, "c", VECTOR)
+    await writer.close()
+
+    reader = EmbeddingCache(path=path, ttl=60, timer=lambda: now[0])
+    assert await reader.get("ada", None, 1536, "b") is None
+    assert await reader.get("ada", None, 1536, "c") == VECTOR
+    now[0] += 60
+    assert await reader.get("ada", None, 1536, "a") is None
+    await reader.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached():
+    openai_client = MockOpenAIClient()
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        embedding_cache=EmbeddingCache(),
+    )
+
+    first = await chat_approach.compute_text_embedding("test query")
+    second = await chat_approach.compute_text_embedding("test query")
+    assert openai_client.embeddings.calls == 1
+    assert first.vector == second.vector == VECTOR
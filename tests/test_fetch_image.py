@@ -1,17 +1,20 @@
+import asyncio
 import os
 
 import aiohttp
 import pytest
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.core.pipeline.transport import (
     AioHttpTransportResponse,
     AsyncHttpTransport,
     HttpRequest,
 )
+from azure.storage.blob import BlobProperties
 from azure.storage.blob.aio import BlobServiceClient
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_image, fetch_images
 
 from .mocks import MockAzureCredential
 
@@ -99,3 +102,105 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+class MockBlobDownloader:
+    def __init__(self, content: bytes):
+        self.properties = BlobProperties(name="test", ETag="etag-1", metadata={"width": "800", "height": "1075"})
+        self.content = content
+
+    async def readall(self):
+        return self.content
+
+
+class MockImageContainerClient:
+    def __init__(self):
+        self.downloads: list[str] = []
+        self.not_modified: list[str] = []
+        self.running = 0
+        self.max_running = 0
+
+    def get_blob_client(self, blob_name):
+        return self.MockBlobClient(self, blob_name)
+
+    class MockBlobClient:
+        def __init__(self, container_client, blob_name):
+            self.container_client = container_client
+            self.blob_name = blob_name
+
+        async def download_blob(self, etag=None, match_condition=None):
+            container_client = self.container_client
+            container_client.downloads.append(self.blob_name)
+            container_client.running += 1
+            container_client.max_running = max(container_client.max_running, container_client.running)
+            await asyncio.sleep(0.01)
+            container_client.running -= 1
+            if self.blob_name.startswith("notfound"):
+                raise ResourceNotFoundError("not found")
+            if etag == "etag-1":
+                container_client.not_modified.append(self.blob_name)
+                error = ResourceModifiedError("ConditionNotMet")
+                error.status_code = 304
+                raise error
+            return MockBlobDownloader(self.blob_name.encode())
+
+
+def make_document(sourcepage: str) -> Document:
+    return Document(
+        id=sourcepage,
+        content="test content",
+        embedding=None,
+        sourcepage=sourcepage,
+        sourcefile="test.pdf",
+        theme="test",
+        subtheme="test",
+        originaldocsource="test.pdf",
+    )
+
+
+@pytest.mark.asyncio
+async def test_fetch_images():
+    blob_container_client = MockImageContainerClient()
+    results = [
+        make_document(sourcepage)
+        for sourcepage in ["a.pdf", "b.pdf", "a.pdf", "notfound.pdf", "", "c.pdf", "d.pdf", "b.pdf"]
+    ]
+    images = await fetch_images(blob_container_client, results, max_concurrency=2)
+
+    assert [image.sourcepage for image in images] == ["a.pdf", "b.pdf", "notfound.pdf", "c.pdf", "d.pdf"]
+    assert sorted(blob_container_client.downloads) == ["a.png", "b.png", "c.png", "d.png", "notfound.png"]
+    assert blob_container_client.max_running == 2
+    assert images[0].image_url == {"url": "data:image/png;base64,YS5wbmc=", "detail": "auto"}
+    assert images[2].image_url is None
+    # Dimensions recorded at ingestion, looked up by blob name
+    assert [image.dims for image in images] == [(800, 1075), (800, 1075), None, (800, 1075), (800, 1075)]
+    assert images[0].serialize_for_thoughts()["width"] == 800
+    thoughts = images[2].serialize_for_thoughts()
+    assert thoughts["sourcepage"] == "notfound.pdf"
+    assert thoughts["found"] is False
+    assert thoughts["latency_ms"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_cached(monkeypatch):
+    blob_container_client = MockImageContainerClient()
+    image_cache = ImageCache(revalidate_after=60)
+    results = [make_document("a.pdf"), make_document("notfound.pdf")]
+    monkeypatch.setattr("time.time", lambda: 1000)
+    images = await fetch_images(blob_container_client, results, image_cache=image_cache)
+    assert images[0].image_url["url"] == "data:image/png;base64,YS5wbmc="
+    assert image_cache.stats.misses == 1
+
+    # Served from memory
+    images = await fetch_images(blob_container_client, results, image_cache=image_cache)
+    assert images[0].image_url["url"] == "data:image/png;base64,YS5wbmc="
+    assert blob_container_client.downloads == ["a.png", "notfound.png", "notfound.png"]
+    assert image_cache.stats.hits == 1
+
+    # Revalidated with a conditional download once stale
+    monkeypatch.setattr("time.time", lambda: 1100)
+    images = await fetch_images(blob_container_client, results[:1], image_cache=image_cache)
+    assert images[0].image_url["url"] == "data:image/png;base64,YS5wbmc="
+    assert blob_container_client.not_modified == ["a.png"]
+    assert image_cache.stats.hits == 2
+    assert not image_cache.is_stale(await image_cache.get("a.png"))
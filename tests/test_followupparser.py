@@ -0,0 +1,55 @@
+import random
+import re
+
+import pytest
+
+from core.followupparser import FollowupQuestionParser
+
+
+def parse(deltas):
+    parser = FollowupQuestionParser()
+    content, questions = "", []
+    for delta in deltas:
+        content_part, completed = parser.feed(delta)
+        content += content_part
+        questions.extend(completed)
+    return content + parser.close(), questions
+
+
+def test_feed_emits_questions_as_they_close():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Paris is the capital. <") == ("Paris is the capital. ", [])
+    assert parser.feed("<What about Spain?>") == ("", [])
+    assert parser.feed("> <<And Italy?>> <<Portu") == ("", ["What about Spain?", "And Italy?"])
+    assert parser.feed("gal?>>") == ("", ["Portugal?"])
+    assert parser.close() == ""
+
+
+def test_feed_releases_held_content():
+    parser = FollowupQuestionParser()
+    assert parser.feed("1 <") == ("1 ", [])
+    assert parser.feed(" 2") == ("< 2", [])
+    assert parser.feed("<") == ("", [])
+    assert parser.close() == "<"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "The capital of France is Paris. [Benefit_Options-2.pdf]. <<What is the capital of Spain?>>",
+        "Answer <<One?>> <<Two?>>\n<<Three?>>",
+        "Answer <<>> <<a > b>> <<c>>",
+        "Answer << unclosed",
+        "Answer <<a<<b>> <c>> <<d>>>",
+        "No follow-ups at all < >",
+    ],
+)
+def test_feed_matches_extract_followup_questions(text):
+    expected = (text.split("<<")[0], re.findall(r"<<([^>>]+)>>", text))
+    assert parse([text]) == expected
+    # Delimiters split across the deltas in every way
+    assert parse(list(text)) == expected
+    rng = random.Random(text)
+    for _ in range(20):
+        cuts = sorted(rng.sample(range(1, len(text)), 5))
+        assert parse([text[i:j] for i, j in zip([0, *cuts], [*cuts, len(text)])]) == expected
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from core.groupcache import GroupMembershipCache
+
+
+class MockGraph:
+    def __init__(self, groups):
+        self.groups = groups
+        self.calls = 0
+
+    async def list_groups(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return list(self.groups)
+
+
+@pytest.fixture
+def clock():
+    return [1000.0]
+
+
+@pytest.mark.asyncio
+async def test_get_cached(clock):
+    graph = MockGraph(["GROUP_Y"])
+    group_cache = GroupMembershipCache(ttl=300, refresh_after=240, timer=lambda: clock[0])
+    assert await group_cache.get("OID_X", graph.list_groups) == ["GROUP_Y"]
+    groups = await group_cache.get("OID_X", graph.list_groups)
+    groups.append("GROUP_MODIFIED")
+    assert await group_cache.get("OID_X", graph.list_groups) == ["GROUP_Y"]
+    assert graph.calls == 1
+    assert group_cache.stats.to_dict() == {"hits": 2, "misses": 1, "hit_ratio": 0.6667}
+
+    # Other users are listed separately
+    assert await group_cache.get("OID_Z", graph.list_groups) == ["GROUP_Y"]
+    assert graph.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_get_refreshed_in_background(clock):
+    graph = MockGraph(["GROUP_Y"])
+    group_cache = GroupMembershipCache(ttl=300, refresh_after=240, timer=lambda: clock[0])
+    await group_cache.get("OID_X", graph.list_groups)
+
+    # Due for a refresh, the current groups are served while they are listed again
+    graph.groups = ["GROUP_Z"]
+    clock[0] += 250
+    assert await group_cache.get("OID_X", graph.list_groups) == ["GROUP_Y"]
+    await asyncio.sleep(0.01)
+    assert graph.calls == 2
+    assert await group_cache.get("OID_X", graph.list_groups) == ["GROUP_Z"]
+
+    # Expired groups are listed before being served
+    graph.groups = ["GROUP_W"]
+    clock[0] += 400
+    assert await group_cache.get("OID_X", graph.list_groups) == ["GROUP_W"]
+    assert graph.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_get_coalesced(clock):
+    graph = MockGraph(["GROUP_Y"])
+    group_cache = GroupMembershipCache(timer=lambda: clock[0])
+    results = await asyncio.gather(*(group_cache.get("OID_X", graph.list_groups) for _ in range(5)))
+    assert results == [["GROUP_Y"]] * 5
+    assert graph.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_session_reused():
+    group_cache = GroupMembershipCache()
+    session = group_cache.get_session()
+    assert group_cache.get_session() is session
+    await group_cache.close()
+    assert session.closed
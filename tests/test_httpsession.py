@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from core.groupcache import GroupMembershipCache
+from core.httpsession import HttpSessionManager
+from core.jwkscache import JwksCache
+
+
+class MockKeysResponse:
+    def __init__(self, keys):
+        self.status = 200
+        self.headers = {"Cache-Control": "max-age=86400"}
+        self.body = json.dumps({"keys": keys})
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+class MockSession:
+    def __init__(self, keys):
+        self.keys = keys
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return MockKeysResponse(self.keys)
+
+
+class MockHttpSessionManager:
+    def __init__(self, session):
+        self.session = session
+
+    def get_session(self):
+        return self.session
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_session_reused():
+    http_session = HttpSessionManager(limit=10, limit_per_host=2, keepalive_timeout=15, ttl_dns_cache=60)
+    session = http_session.get_session()
+    assert http_session.get_session() is session
+    assert session.connector.limit == 10
+    assert session.connector.limit_per_host == 2
+
+    await http_session.close()
+    assert session.closed
+    # A closed manager creates a new session when used again
+    assert http_session.get_session() is not session
+    await http_session.close()
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_injected_session():
+    session = MockSession([{"kid": "KEY_1", "kty": "RSA"}])
+    jwks_cache = JwksCache("https://keys", http_session=MockHttpSessionManager(session))
+    assert await jwks_cache.get_key("KEY_1") == {"kid": "KEY_1", "kty": "RSA"}
+    assert session.urls == ["https://keys"]
+
+
+@pytest.mark.asyncio
+async def test_group_cache_shared_session():
+    http_session = HttpSessionManager()
+    group_cache = GroupMembershipCache(http_session=http_session)
+    session = group_cache.get_session()
+    assert session is http_session.get_session()
+    # The shared session is closed by its owner, not by the cache
+    await group_cache.close()
+    assert not session.closed
+    await http_session.close()
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from core.imagecache import ImageCache
+
+
+@pytest.mark.asyncio
+async def test_image_cache_bounded_by_bytes():
+    image_cache = ImageCache(max_bytes=100)
+    image_cache.set("a.png", "etag-a", "a" * 40)
+    image_cache.set("b.png", "etag-b", "b" * 40)
+    assert (await image_cache.get("a.png")).data == "a" * 40
+    # a was used more recently, so b makes room for c
+    image_cache.set("c.png", "etag-c", "c" * 40)
+    assert await image_cache.get("b.png") is None
+    assert (await image_cache.get("a.png")).etag == "etag-a"
+    assert (await image_cache.get("c.png")).etag == "etag-c"
+    # Larger than the whole cache, so not cached at all
+    image_cache.set("d.png", "etag-d", "d" * 200)
+    assert await image_cache.get("d.png") is None
+    assert image_cache.images.currsize == 80
+
+
+@pytest.mark.asyncio
+async def test_image_cache_revalidation(monkeypatch):
+    image_cache = ImageCache(revalidate_after=60)
+    monkeypatch.setattr("time.time", lambda: 1000)
+    image_cache.set("a.png", "etag-a", "data")
+    image = await image_cache.get("a.png")
+    assert not image_cache.is_stale(image)
+    monkeypatch.setattr("time.time", lambda: 1061)
+    assert image_cache.is_stale(image)
+    image_cache.revalidated("a.png", image)
+    assert not image_cache.is_stale(await image_cache.get("a.png"))
+
+
+@pytest.mark.asyncio
+async def test_image_cache_spill(tmp_path):
+    spill_directory = str(tmp_path / "images")
+    image_cache = ImageCache(max_bytes=100, spill_directory=spill_directory, max_spill_bytes=100)
+    worker_directory = os.path.join(spill_directory, f"worker-{os.getpid()}")
+    image_cache.set("a.png", "etag-a", "a" * 60)
+    image_cache.set("b.png", "etag-b", "b" * 60)
+    assert "a.png" not in image_cache.images
+
+    # Read back from disk, evicting b in turn, and revalidated before it is served
+    image = await image_cache.get("a.png")
+    assert image.etag == "etag-a"
+    assert image.data == "a" * 60
+    assert image_cache.is_stale(image)
+    assert image_cache.spill_stats.hits == 1
+    assert "b.png" not in image_cache.images
+
+    # The spill directory is bounded too: spilling c removes the file of b
+    image_cache.set("c.png", "etag-c", "c" * 60)
+    assert await image_cache.get("b.png") is None
+    assert image_cache.spill_stats.misses == 1
+    assert image_cache.spilled_bytes <= 100
+    assert len(os.listdir(worker_directory)) == 1
+
+    # Files spilled by an earlier worker with the same pid are found, and count towards the limit
+    restarted_cache = ImageCache(max_bytes=100, spill_directory=spill_directory, max_spill_bytes=100)
+    assert restarted_cache.spilled_bytes == image_cache.spilled_bytes
+    await restarted_cache.clear()
+    assert os.listdir(worker_directory) == []
+    await image_cache.close()
+    await restarted_cache.close()
+    assert os.listdir(spill_directory) == []
+
+
+@pytest.mark.asyncio
+async def test_image_cache_spill_workers(tmp_path):
+    spill_directory = str(tmp_path / "images")
+    # Left by a worker that exited
+    orphan_directory = tmp_path / "images" / "worker-999999999"
+    orphan_directory.mkdir(parents=True)
+    (orphan_directory / "image.b64").write_text("etag\ndata")
+
+    worker_a = ImageCache(max_bytes=50, spill_directory=spill_directory, max_spill_bytes=200)
+    assert not orphan_directory.exists()
+    # Files of 50 bytes, one image fits in memory
+    for name in "abc":
+        worker_a.set(f"{name}.png", f"etag-{name}", name * 43)
+    # Waits for the queued spills
+    assert await worker_a.get("missing.png") is None
+    assert worker_a.spilled_bytes == 100
+
+    # A second worker spills to its own directory, and the limit is shared between both
+    worker_b = ImageCache(max_bytes=50, spill_directory=spill_directory, max_spill_bytes=200, worker_pid=os.getppid())
+    assert sorted(os.listdir(spill_directory)) == sorted([f"worker-{os.getpid()}", f"worker-{os.getppid()}"])
+    assert await worker_b.get("a.png") is None
+    worker_a.set("d.png", "etag-d", "d" * 43)
+    assert await worker_a.get("missing.png") is None
+    assert worker_a.spilled_bytes == 100
+    assert await worker_a.get("a.png") is None
+    await worker_a.close()
+    await worker_b.close()
@@ -1,8 +1,15 @@
 import base64
+from io import BytesIO
 
 import pytest
+from PIL import Image
 
-from core.imageshelper import calculate_image_token_cost, get_image_dims
+from core.imageshelper import (
+    calculate_image_token_cost,
+    get_image_dims,
+    get_image_dims_from_bytes,
+    get_image_dims_from_metadata,
+)
 
 
 @pytest.fixture
@@ -23,6 +30,8 @@ def test_calculate_image_token_cost(small_image, large_image):
     assert calculate_image_token_cost(small_image) == 255
     assert calculate_image_token_cost(large_image, "low") == 85
     assert calculate_image_token_cost(large_image, "high") == 1105
+    # Known dimensions are used rather than those of the image
+    assert calculate_image_token_cost(small_image, "high", (2050, 1238)) == 1105
     with pytest.raises(ValueError, match="Invalid value for detail parameter."):
         assert calculate_image_token_cost(large_image, "medium")
 
@@ -32,3 +41,35 @@ def test_get_image_dims_small(small_image, large_image):
     assert get_image_dims(large_image) == (2050, 1238)
     with pytest.raises(ValueError, match="Image must be a base64 string."):
         assert get_image_dims("http://domain.com/image.png")
+
+
+def make_image_uri(format: str, size: tuple[int, int], **kwargs) -> str:
+    output = BytesIO()
+    Image.new("RGB", size, "white").save(output, format=format, **kwargs)
+    img = base64.b64encode(output.getvalue()).decode("utf-8")
+    return f"data:image/{format.lower()};base64,{img}"
+
+
+def test_get_image_dims_jpeg():
+    assert get_image_dims(make_image_uri("JPEG", (640, 480))) == (640, 480)
+    # The dimensions come after a large metadata segment
+    assert get_image_dims(make_image_uri("JPEG", (300, 200), exif=b"\0" * 60000)) == (300, 200)
+    assert get_image_dims(make_image_uri("JPEG", (300, 200), progressive=True)) == (300, 200)
+
+
+def test_get_image_dims_other_formats():
+    # Formats without a header parser are decoded
+    assert get_image_dims(make_image_uri("GIF", (30, 20))) == (30, 20)
+
+
+def test_get_image_dims_from_bytes(large_image):
+    header = base64.b64decode(large_image.split(",")[1][:44])
+    assert get_image_dims_from_bytes(header) == (2050, 1238)
+    assert get_image_dims_from_bytes(header[:20]) is None
+    assert get_image_dims_from_bytes(b"GIF89a") is None
+
+
+def test_get_image_dims_from_metadata():
+    assert get_image_dims_from_metadata({"width": "800", "height": "1075"}) == (800, 1075)
+    assert get_image_dims_from_metadata({}) is None
+    assert get_image_dims_from_metadata(None) is None
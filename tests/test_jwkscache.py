@@ -0,0 +1,116 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from core.jwkscache import JwksCache, JwksError
+
+KEY_1 = {"kty": "RSA", "kid": "KEY_1", "use": "sig", "n": "n1", "e": "AQAB"}
+KEY_2 = {"kty": "RSA", "kid": "KEY_2", "use": "sig", "n": "n2", "e": "AQAB"}
+
+
+class MockJwksEndpoint:
+    def __init__(self, keys, max_age=86400):
+        self.keys = keys
+        self.max_age = max_age
+        self.calls = 0
+
+    async def download(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return {"keys": list(self.keys)}, self.max_age
+
+
+@pytest.fixture
+def clock():
+    return [1000.0]
+
+
+def test_get_max_age():
+    jwks_cache = JwksCache("https://keys", default_max_age=3600, min_max_age=300)
+    assert jwks_cache.get_max_age({"Cache-Control": "max-age=86400, private"}) == 86400
+    assert jwks_cache.get_max_age({"Cache-Control": "max-age=10"}) == 300
+    assert jwks_cache.get_max_age({}) == 3600
+    assert jwks_cache.get_max_age({"Cache-Control": ""}) == 3600
+
+
+@pytest.mark.asyncio
+async def test_get_key_cached(monkeypatch, clock):
+    endpoint = MockJwksEndpoint([KEY_1])
+    jwks_cache = JwksCache("https://keys", timer=lambda: clock[0])
+    monkeypatch.setattr(jwks_cache, "download", endpoint.download)
+
+    keys = await asyncio.gather(*(jwks_cache.get_key("KEY_1") for _ in range(5)))
+    assert keys == [KEY_1] * 5
+    assert endpoint.calls == 1
+
+    clock[0] += 3600
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+    assert endpoint.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_get_key_background_refresh(monkeypatch, clock):
+    endpoint = MockJwksEndpoint([KEY_1], max_age=600)
+    jwks_cache = JwksCache("https://keys", timer=lambda: clock[0])
+    monkeypatch.setattr(jwks_cache, "download", endpoint.download)
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+
+    # Expired keys are served while they are refreshed
+    clock[0] += 601
+    endpoint.keys = [KEY_2]
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+    assert jwks_cache.refreshes.in_flight("https://keys")
+    await asyncio.sleep(0.01)
+    assert endpoint.calls == 2
+    assert jwks_cache.keys == {"KEY_2": KEY_2}
+
+
+@pytest.mark.asyncio
+async def test_get_key_background_refresh_error(monkeypatch, clock, caplog):
+    endpoint = MockJwksEndpoint([KEY_1], max_age=600)
+    jwks_cache = JwksCache("https://keys", timer=lambda: clock[0])
+    monkeypatch.setattr(jwks_cache, "download", endpoint.download)
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+
+    async def mock_download_error():
+        raise aiohttp.ClientConnectionError("Connection refused")
+
+    monkeypatch.setattr(jwks_cache, "download", mock_download_error)
+    clock[0] += 601
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+    await asyncio.sleep(0.01)
+    # The failure is logged, and the last good keys are kept
+    assert "Error refreshing the keys from https://keys" in caplog.text
+    assert jwks_cache.keys == {"KEY_1": KEY_1}
+
+
+@pytest.mark.asyncio
+async def test_get_key_unknown_kid(monkeypatch, clock):
+    endpoint = MockJwksEndpoint([KEY_1])
+    jwks_cache = JwksCache("https://keys", min_refetch_interval=60, timer=lambda: clock[0])
+    monkeypatch.setattr(jwks_cache, "download", endpoint.download)
+    assert await jwks_cache.get_key("KEY_1") == KEY_1
+
+    # Rotated keys are fetched again, at most once per interval
+    endpoint.keys = [KEY_1, KEY_2]
+    assert await jwks_cache.get_key("KEY_2") is None
+    assert endpoint.calls == 1
+    clock[0] += 60
+    keys = await asyncio.gather(*(jwks_cache.get_key("KEY_2") for _ in range(3)))
+    assert keys == [KEY_2] * 3
+    assert endpoint.calls == 2
+    assert await jwks_cache.get_key("UNKNOWN") is None
+    assert endpoint.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_get_key_invalid_keys(monkeypatch, clock):
+    jwks_cache = JwksCache("https://keys")
+
+    async def download():
+        return {"error": "invalid"}, 3600
+
+    monkeypatch.setattr(jwks_cache, "download", download)
+    with pytest.raises(JwksError, match="invalid_keys"):
+        await jwks_cache.get_key("KEY_1")
@@ -1,4 +1,4 @@
-from core.messagebuilder import MessageBuilder
+from core.messagebuilder import HistoryPacker, MessageBuilder
 
 
 def test_messagebuilder():
@@ -47,3 +47,28 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_history_packer(monkeypatch):
+    history = [
+        {"role": "user", "content": "What happens in a performance review?"},  # 10 tokens
+        {"role": "assistant", "content": "The supervisor will discuss your performance."},  # 11 tokens
+        {"role": "user", "content": "Is there a dress code?"},  # 9 tokens
+        {"role": "assistant", "content": "Yes, look sharp!"},  # 8 tokens
+    ]
+    packer = HistoryPacker(history, "gpt-35-turbo")
+    counted = []
+    count_tokens_for_message = packer.builder.count_tokens_for_message
+
+    def count_tokens(message):
+        counted.append(message["content"])
+        return count_tokens_for_message(message)
+
+    monkeypatch.setattr(packer.builder, "count_tokens_for_message", count_tokens)
+
+    assert packer.pack(0) == []
+    assert packer.pack(20) == history[2:]
+    assert packer.pack(1000) == history
+    assert packer.pack(20) == history[2:]
+    # Each message is normalized and counted once, however many times the history is packed
+    assert sorted(counted) == sorted(message["content"] for message in history)
@@ -1,9 +1,11 @@
 import pytest
 
 from core.modelhelper import (
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    token_count_cache,
 )
 
 
@@ -63,6 +65,22 @@ def test_num_tokens_from_messages_list():
     assert num_tokens_from_messages(message, model) == 265
 
 
+def test_num_tokens_from_messages_image_dims(monkeypatch):
+    # Images whose dimensions are known are budgeted without being read
+    def fail(image_uri):
+        raise AssertionError("image read")
+
+    monkeypatch.setattr("core.imageshelper.get_image_dims", fail)
+    message = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "Describe this picture:"},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA", "detail": "auto"}},
+        ],
+    }
+    assert num_tokens_from_messages(message, "gpt-4", [(2050, 1238)]) == 1115
+
+
 def test_num_tokens_from_messages_error():
     message = {
         # 1 token : 1 token
@@ -91,3 +109,23 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_get_encoding_loaded_once():
+    get_encoding.cache_clear()
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-35-turbo")
+    assert get_encoding.cache_info().misses == 1
+
+
+def test_num_tokens_from_messages_cached(monkeypatch):
+    message = {"role": "user", "content": "How many tokens are cached?"}
+    token_count_cache.clear()
+    expected = num_tokens_from_messages(message, "gpt-35-turbo")
+
+    def fail(*args):
+        raise AssertionError("Token count should have been cached")
+
+    monkeypatch.setattr("core.modelhelper.count_tokens_for_message", fail)
+    assert num_tokens_from_messages(dict(message), "gpt-35-turbo") == expected
+    with pytest.raises(AssertionError):
+        num_tokens_from_messages(message, "gpt-4")
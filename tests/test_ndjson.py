@@ -0,0 +1,80 @@
+import asyncio
+import dataclasses
+import json
+
+import pytest
+
+from approaches.approach import ThoughtStep
+from core.ndjson import NdjsonEncoder, coalesce
+
+
+def token_event(content, **delta):
+    return {
+        "id": "chatcmpl-1",
+        "choices": [{"delta": {"content": content, **delta}, "finish_reason": None, "index": 0}],
+        "created": 1,
+        "model": "gpt-35-turbo",
+        "object": "chat.completion.chunk",
+    }
+
+
+def test_encode_token_deltas():
+    encoder = NdjsonEncoder()
+    for content in ["Hello", " wor\nld", 'I ❤️ 🐍 "quoted"', "", "\x00"]:
+        event = token_event(content)
+        assert encoder.encode(event) == json.dumps(event, ensure_ascii=False) + "\n"
+    assert len(encoder.templates) == 1
+
+    # Values of a different type are a different shape
+    for role in ["assistant", None, True, 1]:
+        event = token_event("Hello", role=role)
+        assert encoder.encode(event) == json.dumps(event, ensure_ascii=False) + "\n"
+    assert len(encoder.templates) == 5
+
+
+def test_encode_other_events():
+    encoder = NdjsonEncoder()
+    event = {
+        "choices": [
+            {
+                "delta": {"role": "assistant"},
+                "context": {"thoughts": [ThoughtStep("Prompt to generate answer", [{"role": "user"}], {"k": 1})]},
+                "finish_reason": None,
+                "index": 0,
+            }
+        ],
+        "object": "chat.completion.chunk",
+    }
+    expected = json.dumps(event, ensure_ascii=False, default=dataclasses.asdict)
+    assert encoder.encode(event) == expected + "\n"
+    # Nested values that aren't scalars are serialized in full
+    event = token_event("Hello")
+    event["choices"][0]["content_filter_results"] = {"hate": {"filtered": False}}
+    assert encoder.encode(event) == json.dumps(event, ensure_ascii=False) + "\n"
+    assert len(encoder.templates) == 0
+
+    with pytest.raises(TypeError):
+        encoder.encode({"a": object()})
+
+
+async def lines_with_delays(lines):
+    for line, delay in lines:
+        await asyncio.sleep(delay)
+        yield line
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    lines = [("a\n", 0), ("b\n", 0), ("c\n", 0), ("d\n", 0.2), ("e\n", 0)]
+    result = [chunk async for chunk in coalesce(lines_with_delays(lines), max_latency=0.05)]
+    assert result == ["a\nb\nc\n", "d\ne\n"]
+
+    # Writes each line once the buffer is full
+    result = [chunk async for chunk in coalesce(lines_with_delays(lines), max_latency=0.05, max_size=4)]
+    assert result == ["a\nb\n", "c\n", "d\ne\n"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_disabled():
+    lines = [("a\n", 0), ("b\n", 0)]
+    assert [chunk async for chunk in coalesce(lines_with_delays(lines), max_latency=0)] == ["a\n", "b\n"]
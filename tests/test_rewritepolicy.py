@@ -0,0 +1,33 @@
+from core.rewritepolicy import QueryRewritePolicy
+
+QUESTION = [{"role": "user", "content": "What are my health plans?"}]
+
+
+def test_from_config_disabled():
+    assert QueryRewritePolicy.from_config(None, "en-us") is None
+    assert QueryRewritePolicy.from_config({"enabled": False}, "en-us") is None
+
+
+def test_decide():
+    policy = QueryRewritePolicy.from_config({"enabled": True, "maxQuestionLength": 30}, "en-US")
+    assert policy.decide(QUESTION).rewrite is False
+    assert policy.decide([{"role": "user", "content": "x" * 31}]).reason == "question is longer than 30 characters"
+    assert policy.decide(QUESTION * 3).rewrite is True
+    # Questions with images always go through the rewrite
+    decision = policy.decide([{"role": "user", "content": [{"type": "text", "text": "Plans?"}]}])
+    assert decision.rewrite is True
+    assert decision.reason == "question has non-text content"
+
+
+def test_decide_language():
+    assert QueryRewritePolicy.from_config({"enabled": True}, "pt-br").decide(QUESTION).rewrite is True
+    policy = QueryRewritePolicy.from_config({"enabled": True, "languages": ["pt-BR"]}, "pt-br")
+    assert policy.decide(QUESTION).rewrite is False
+
+
+def test_evaluate_counts():
+    policy = QueryRewritePolicy.from_config({"enabled": True, "maxHistoryLength": 3}, "en-us")
+    policy.evaluate(QUESTION)
+    policy.evaluate(QUESTION * 3)
+    policy.evaluate(QUESTION * 5)
+    assert policy.stats.to_dict() == {"rewritten": 1, "skipped": 2}
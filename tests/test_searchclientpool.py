@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+from core.searchclientpool import SearchClientPool
+
+
+@pytest.fixture
+def search_client_pool(monkeypatch):
+    async def mock_get_document_count(self, *args, **kwargs):
+        self.warm_count = getattr(self, "warm_count", 0) + 1
+        return 0
+
+    async def mock_close(self):
+        self.closed = True
+
+    monkeypatch.setattr(SearchClient, "get_document_count", mock_get_document_count)
+    monkeypatch.setattr(SearchClient, "close", mock_close)
+    return SearchClientPool(
+        endpoint="https://test-search-service.search.windows.net",
+        credential=AzureKeyCredential("key"),
+        retire_after=0.05,
+    )
+
+
+def test_get_reuses_client(search_client_pool):
+    client = search_client_pool.get("index-a")
+    assert client._index_name == "index-a"
+    assert search_client_pool.get("index-a") is client
+    assert search_client_pool.get("index-b") is not client
+
+
+@pytest.mark.asyncio
+async def test_refresh_retires_and_closes_unused_clients(search_client_pool):
+    await search_client_pool.refresh(["index-a", "index-b", None])
+    assert set(search_client_pool.clients) == {"index-a", "index-b"}
+    client_b = search_client_pool.get("index-b")
+
+    await search_client_pool.refresh(["index-a"])
+    assert set(search_client_pool.clients) == {"index-a"}
+    assert search_client_pool.retired == [client_b]
+    assert not hasattr(client_b, "closed")
+
+    # Requests that picked up the retired client before the refresh can still use it for a while
+    await search_client_pool.refresh(["index-a"])
+    assert not hasattr(client_b, "closed")
+
+    await asyncio.sleep(0.1)
+    assert client_b.closed
+    assert search_client_pool.retired == []
+
+
+@pytest.mark.asyncio
+async def test_get_warms_new_clients(search_client_pool):
+    client = search_client_pool.get("index-a")
+    assert search_client_pool.warmups.in_flight("index-a")
+    await asyncio.sleep(0)
+    assert client.warm_count == 1
+
+    # A refresh reuses the warmed client, and doesn't warm it again
+    await search_client_pool.refresh(["index-a"])
+    assert search_client_pool.get("index-a") is client
+    assert client.warm_count == 1
+
+
+@pytest.mark.asyncio
+async def test_close(search_client_pool):
+    client = search_client_pool.get("index-a")
+    await search_client_pool.refresh(["index-b"])
+    assert search_client_pool.retired == [client]
+    await search_client_pool.close()
+    assert client.closed
+    assert search_client_pool.retired == []
+    assert search_client_pool.clients == {}
@@ -0,0 +1,76 @@
+import pytest
+
+from core.sharedcache import FileSharedCache, InMemorySharedCache
+
+
+@pytest.fixture(params=["file", "memory"])
+def shared_cache(request, tmp_path):
+    if request.param == "file":
+        return FileSharedCache(str(tmp_path))
+    return InMemorySharedCache()
+
+
+def test_write_and_read(shared_cache):
+    assert shared_cache.version("themes") == 0
+    assert shared_cache.read("themes") is None
+
+    assert shared_cache.write("themes", [{"themeId": "a"}]) == 1
+    entry = shared_cache.read("themes")
+    assert entry.version == 1
+    assert entry.value == [{"themeId": "a"}]
+
+    assert shared_cache.write("themes", [{"themeId": "b"}]) == 2
+    assert shared_cache.read("themes").value == [{"themeId": "b"}]
+
+
+def test_invalidate_bumps_version(shared_cache):
+    shared_cache.write("themes", [{"themeId": "a"}])
+    assert shared_cache.invalidate("themes") == 2
+    assert shared_cache.version("themes") == 2
+    assert shared_cache.read("themes") is None
+
+
+def test_write_if_version(shared_cache):
+    version = shared_cache.version("themes")
+    shared_cache.invalidate("themes")
+    # The themes were invalidated while this writer was loading them
+    assert shared_cache.write("themes", [{"themeId": "stale"}], if_version=version) is None
+    assert shared_cache.read("themes") is None
+    assert shared_cache.write("themes", [{"themeId": "fresh"}], if_version=version + 1) == version + 2
+
+
+def test_read_max_age(shared_cache, monkeypatch):
+    shared_cache.write("themes", [{"themeId": "a"}])
+    assert shared_cache.read("themes", max_age=60) is not None
+    monkeypatch.setattr("core.sharedcache.time.time", lambda: 10**12)
+    assert shared_cache.read("themes", max_age=60) is None
+
+
+def test_file_cache_shared_between_instances(tmp_path):
+    # Two instances on the same directory stand in for two worker processes
+    worker_a = FileSharedCache(str(tmp_path))
+    worker_b = FileSharedCache(str(tmp_path))
+    worker_a.version("themes")
+    worker_b.version("themes")
+
+    worker_a.write("themes", [{"themeId": "a"}])
+    assert worker_b.version("themes") == 1
+    assert worker_b.read("themes").value == [{"themeId": "a"}]
+
+    worker_b.invalidate("themes")
+    assert worker_a.version("themes") == 2
+    assert worker_a.read("themes") is None
+
+    # A recycled worker starts from the current version
+    assert FileSharedCache(str(tmp_path)).version("themes") == 2
+
+
+def test_write_rejects_non_json_values(shared_cache):
+    shared_cache.write("themes", [{"themeId": "a"}])
+    with pytest.raises(ValueError):
+        shared_cache.write("themes", [{"themeId": object()}])
+    with pytest.raises(ValueError):
+        shared_cache.write("themes", [{"temperature": float("nan")}])
+    # The previous value is left in place
+    assert shared_cache.version("themes") == 1
+    assert shared_cache.read("themes").value == [{"themeId": "a"}]
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_flight():
+    single_flight = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def load():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return calls
+
+    waiters = [asyncio.ensure_future(single_flight.do("themes", load)) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert single_flight.in_flight("themes")
+    release.set()
+    assert await asyncio.gather(*waiters) == [1] * 5
+    assert calls == 1
+    assert not single_flight.in_flight("themes")
+
+    # Once finished, the next call starts a new flight
+    assert await single_flight.do("themes", load) == 2
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller():
+    single_flight = SingleFlight()
+
+    async def load():
+        await asyncio.sleep(0)
+        raise ValueError("Cosmos DB not configured")
+
+    results = await asyncio.gather(
+        single_flight.do("themes", load), single_flight.do("themes", load), return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not single_flight.in_flight("themes")
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_flight():
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def load():
+        await release.wait()
+        return "themes"
+
+    cancelled = asyncio.ensure_future(single_flight.do("themes", load))
+    waiter = asyncio.ensure_future(single_flight.do("themes", load))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+    assert await waiter == "themes"
+
+
+@pytest.mark.asyncio
+async def test_start_runs_in_background():
+    single_flight = SingleFlight()
+
+    async def load():
+        raise ValueError("boom")
+
+    future = single_flight.start("themes", load)
+    assert single_flight.start("themes", load) is future
+    with pytest.raises(ValueError):
+        await future
+    await asyncio.sleep(0)
+    assert not single_flight.in_flight("themes")
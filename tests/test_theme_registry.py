@@ -0,0 +1,76 @@
+from typing import List
+
+import pytest
+
+from core.theme.application.theme_registry import ThemeRegistry
+from core.theme.application.use_cases.list_themes import ListTheme
+from core.theme.domain.theme import Theme
+from core.theme.domain.theme_repository import ThemeRepository
+
+THEME = {
+    "themeId": "theme-1",
+    "themeName": "Theme 1",
+    "language": "en-us",
+    "active": True,
+    "subThemes": [{"subthemeName": "Sub", "subthemeId": "sub-1", "allowedForGroups": []}],
+    "assistantConfig": {"searchIndexName": "index-1"},
+}
+
+
+class MockThemeRepository(ThemeRepository):
+    def __init__(self):
+        self.sync_calls = 0
+        self.async_calls = 0
+
+    def list(self) -> List[Theme]:
+        self.sync_calls += 1
+        return [Theme.from_dict(THEME)]
+
+    async def list_async(self) -> List[Theme]:
+        self.async_calls += 1
+        return [Theme.from_dict(THEME)]
+
+
+def test_theme_registry():
+    registry = ThemeRegistry()
+    assert registry.get("theme-1") is None
+
+    registry.replace([THEME, {**THEME, "themeId": "theme-2"}])
+    assert registry.get("theme-1") is THEME
+    assert registry.get("theme-2")["themeId"] == "theme-2"
+    assert len(registry.all()) == 2
+
+    registry.clear()
+    assert registry.get("theme-1") is None
+    assert registry.all() == []
+
+
+@pytest.mark.asyncio
+async def test_list_theme_execute_async():
+    repository = MockThemeRepository()
+    response = await ListTheme(repository).execute_async()
+    assert repository.async_calls == 1
+    assert repository.sync_calls == 0
+    assert [theme.to_dict() for theme in response.data] == [THEME]
+
+
+class FailingThemeRepository(ThemeRepository):
+    def list(self) -> List[Theme]:
+        raise ConnectionError("cosmos unavailable")
+
+    async def list_async(self) -> List[Theme]:
+        raise ConnectionError("cosmos unavailable")
+
+
+@pytest.mark.asyncio
+async def test_list_theme_execute_async_error(caplog):
+    with pytest.raises(RuntimeError) as exc_info:
+        await ListTheme(FailingThemeRepository()).execute_async()
+    assert isinstance(exc_info.value.__cause__, ConnectionError)
+    assert "Failed to list themes" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_list_theme_output_to_dict():
+    response = await ListTheme(MockThemeRepository()).execute_async()
+    assert response.to_dict() == [THEME]